@@ -60,6 +60,10 @@ directories = os.listdir()
 if "original" in directories:
     print("Warning: \"Original\" directory detected, original firmware might be shadowed")
 
+rolled_back_to = ota_utils.check_trial()
+if rolled_back_to:
+    print("New version didn't start %d times, switched back to \"%s\"" % (ota_utils.MAX_TRIAL_BOOTS, rolled_back_to))
+
 try:
     with open("_ota_status", "r") as f:
         status = f.read()
@@ -15,12 +15,62 @@ class SargsConfig:
     # To enable Captive portal
     CAPTIVE_PORTAL_ENABLED = True
 
+    # CO2 ppm above which the yellow and the red light are on
+    CO2_THRESHOLD_MEDIUM = 1000
+    CO2_THRESHOLD_HIGH = 1400
+
+    # Seconds between CO2 sensor readings
+    CO2_SAMPLE_PERIOD_S = 5
+
+    # Seconds between MQTT telemetry messages
+    TELEMETRY_PUBLISH_INTERVAL_S = 300
+
+    # The CO2 samples are aggregated over windows of this many seconds, each window is reported with the statistics
+    # listed in TELEMETRY_STATISTICS, out of "mean", "min", "max", "stddev" and "count"
+    TELEMETRY_WINDOW_S = 60
+    TELEMETRY_STATISTICS = "mean,min,max"
+
+    # Format of the MQTT telemetry: "json" (ThingsBoard telemetry) or "binary", see original/telemetry.py
+    TELEMETRY_ENCODING = "json"
+
+    # Add event loop and heap metrics (see original/profiler.py) to the MQTT telemetry
+    METRICS_TELEMETRY_ENABLED = False
+
+    # Download updates from this LAN mirror (tools/ota-mirror), e.g. "http://192.168.1.10:8080", before falling back
+    # to GitHub. The mirror is trusted with the firmware, only set one you control.
+    OTA_MIRROR_URL = None
+
+    # Let the backend change the settings below and send commands over MQTT (see original/remote.py)
+    REMOTE_CONFIG_ENABLED = True
+
     _json_mapping = {
         # JSON field, Class attribute, type
         "WIFI_ENABLED": ("wifiEnabled", bool),
         "WIFI_SSID": ("wifiSsid", str),
         "WIFI_PASSWORD": ("wifiPassword", str),
         "CAPTIVE_PORTAL_ENABLED": ("captivePortalEnabled", bool),
+        "CO2_THRESHOLD_MEDIUM": ("co2ThresholdMedium", int),
+        "CO2_THRESHOLD_HIGH": ("co2ThresholdHigh", int),
+        "CO2_SAMPLE_PERIOD_S": ("co2SamplePeriod", int),
+        "TELEMETRY_PUBLISH_INTERVAL_S": ("telemetryPublishInterval", int),
+        "TELEMETRY_WINDOW_S": ("telemetryWindow", int),
+        "TELEMETRY_STATISTICS": ("telemetryStatistics", str),
+        "TELEMETRY_ENCODING": ("telemetryEncoding", str),
+        "METRICS_TELEMETRY_ENABLED": ("metricsTelemetryEnabled", bool),
+        "OTA_MIRROR_URL": ("otaMirrorUrl", str),
+        "REMOTE_CONFIG_ENABLED": ("remoteConfigEnabled", bool),
+    }
+
+    # settings the backend may change over MQTT, with the range of numbers it may set them to
+    _remote_settings = {
+        "CO2_THRESHOLD_MEDIUM": (400, 5000),
+        "CO2_THRESHOLD_HIGH": (400, 5000),
+        "CO2_SAMPLE_PERIOD_S": (2, 3600),
+        "TELEMETRY_PUBLISH_INTERVAL_S": (10, 24 * 3600),
+        "TELEMETRY_WINDOW_S": (10, 3600),
+        "TELEMETRY_STATISTICS": None,
+        "TELEMETRY_ENCODING": None,
+        "METRICS_TELEMETRY_ENABLED": None,
     }
 
     def __setattr__(self, name, value) -> None:
@@ -33,6 +83,47 @@ class SargsConfig:
 
         super().__setattr__(name, value)
 
+    def update_remote(self, values, validators=None):
+        """
+        Applies the settings the backend sent, {JSON field: value}, and returns the names of those that changed.
+        Fields that can't be changed remotely are ignored, invalid values are logged and skipped. validators maps
+        setting names to functions returning whether a value is valid, for what only the firmware knows (e.g. the
+        telemetry encodings).
+        """
+        changed = []
+        previous = {}
+        for name, limits in self._remote_settings.items():
+            (config_field, config_type) = self._json_mapping[name]
+            if config_field not in values or values[config_field] == getattr(self, name):
+                continue
+            value = values[config_field]
+            previous[name] = getattr(self, name)
+            try:
+                if limits and not (isinstance(value, int) and limits[0] <= value <= limits[1]):
+                    raise Exception('Invalid configuration value for "%s", must be between %d and %d' % (
+                        name, limits[0], limits[1]))
+                valid = validators[name] if validators and name in validators else None
+                if valid and not (isinstance(value, config_type) and valid(value)):
+                    raise Exception('Invalid configuration value for "%s": %s' % (name, value))
+                setattr(self, name, value)
+            except Exception as e:
+                self.logger.warning(str(e))
+                continue
+            changed.append(name)
+        # the thresholds are checked as a pair, the backend may change both at once
+        thresholds = [name for name in ("CO2_THRESHOLD_MEDIUM", "CO2_THRESHOLD_HIGH") if name in changed]
+        if thresholds and self.CO2_THRESHOLD_MEDIUM >= self.CO2_THRESHOLD_HIGH:
+            self.logger.warning("Invalid CO2 thresholds %d and %d, the medium one must be below the high one" % (
+                self.CO2_THRESHOLD_MEDIUM, self.CO2_THRESHOLD_HIGH))
+            for name in thresholds:
+                setattr(self, name, previous[name])
+                changed.remove(name)
+        return changed
+
+    def remote_settings(self):
+        """The settings the backend may change, {JSON field: value}"""
+        return {self._json_mapping[name][0]: getattr(self, name) for name in self._remote_settings}
+
     def save(self):
         try:
             with open("config.json") as config_file:
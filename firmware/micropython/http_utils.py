@@ -1,14 +1,402 @@
 import ussl
 import usocket
+import uasyncio
+import uerrno
+import ustruct
+import urandom
+import network
 import logging
+from utime import ticks_ms, ticks_add, ticks_diff
 
 log = logging.getLogger("http_utils")
 
+USER_AGENT = "open-lv/air-guard"
 
-def open_url(url, redirect_tries_left=1):
+DNS_PORT = 53
+# used when DHCP didn't give us a DNS server
+FALLBACK_DNS_SERVER = "1.1.1.1"
+DNS_TIMEOUT_MS = 5000
+DNS_POLL_MS = 20
+DNS_MIN_TTL_S = 60
+DNS_MAX_TTL_S = 3600
+
+NTP_HOST = "pool.ntp.org"
+NTP_PORT = 123
+NTP_TIMEOUT_MS = 1000
+# seconds from the NTP epoch (1900-01-01) to the MicroPython epoch (2000-01-01)
+NTP_DELTA_S = 3155673600
+
+DEFAULT_TIMEOUT_MS = 10000
+READ_CHUNK_SIZE = 512
+MAX_HEADER_LINE = 1024
+
+
+class HTTPError(Exception):
+    def __init__(self, status, msg=None):
+        super().__init__(msg or "HTTP status %d" % status)
+        self.status = status
+
+
+class NotFoundError(HTTPError):
+    def __init__(self, msg=None):
+        super().__init__(404, msg)
+
+
+# hostname -> (address, expiry ticks_ms)
+_dns_cache = {}
+
+
+def _is_ip_address(host):
+    parts = host.split(".")
+    return len(parts) == 4 and all(p.isdigit() for p in parts)
+
+
+def _dns_server():
+    try:
+        server = network.WLAN(network.STA_IF).ifconfig()[3]
+        if server != "0.0.0.0":
+            return server
+    except OSError:
+        pass
+    return FALLBACK_DNS_SERVER
+
+
+def _dns_query(query_id, hostname):
+    q = bytearray(ustruct.pack("!HHHHHH", query_id, 0x0100, 1, 0, 0, 0))
+    for label in hostname.split("."):
+        q.append(len(label))
+        q += label.encode()
+    q += b"\x00"
+    q += ustruct.pack("!HH", 1, 1)  # A record, IN class
+    return q
+
+
+def _skip_name(data, pos):
+    while True:
+        length = data[pos]
+        if length == 0:
+            return pos + 1
+        if length & 0xc0 == 0xc0:
+            # compression pointer, always ends the name
+            return pos + 2
+        pos += length + 1
+
+
+def _dns_parse_response(data, query_id):
+    """Returns (address, ttl_s) of the first A record in a DNS response, or None if this isn't our response"""
+    (response_id, flags, qdcount, ancount) = ustruct.unpack_from("!HHHH", data, 0)
+    if response_id != query_id or not flags & 0x8000:
+        return None
+    if flags & 0x000f:
+        raise OSError(uerrno.ENOENT, "DNS error %d" % (flags & 0x000f))
+    pos = 12
+    for _ in range(qdcount):
+        pos = _skip_name(data, pos) + 4
+    for _ in range(ancount):
+        pos = _skip_name(data, pos)
+        (rtype, rclass, ttl, rdlength) = ustruct.unpack_from("!HHIH", data, pos)
+        pos += 10
+        if rtype == 1 and rclass == 1 and rdlength == 4:
+            return "%d.%d.%d.%d" % tuple(data[pos:pos + 4]), ttl
+        pos += rdlength
+    raise OSError(uerrno.ENOENT, "no A record")
+
+
+async def resolve(hostname, timeout_ms=DNS_TIMEOUT_MS):
+    """
+    Resolves hostname to an IPv4 address without blocking the event loop. usocket.getaddrinfo() blocks for as long
+    as the DNS server takes to answer, so the query is sent over a non-blocking UDP socket instead.
+    """
+    if _is_ip_address(hostname):
+        return hostname
+    cached = _dns_cache.get(hostname)
+    if cached and ticks_diff(cached[1], ticks_ms()) > 0:
+        return cached[0]
+
+    query_id = urandom.getrandbits(16)
+    s = usocket.socket(usocket.AF_INET, usocket.SOCK_DGRAM)
+    try:
+        s.setblocking(False)
+        s.sendto(_dns_query(query_id, hostname), usocket.getaddrinfo(_dns_server(), DNS_PORT)[0][-1])
+        deadline = ticks_add(ticks_ms(), timeout_ms)
+        while True:
+            try:
+                result = _dns_parse_response(s.recv(512), query_id)
+                if result:
+                    break
+            except OSError as e:
+                if e.errno == uerrno.ENOENT:
+                    raise OSError(uerrno.ENOENT, "Unable to resolve %s" % hostname)
+                if e.errno != uerrno.EAGAIN:
+                    raise
+            if ticks_diff(ticks_ms(), deadline) >= 0:
+                raise OSError(uerrno.ETIMEDOUT, "Unable to resolve %s (no Internet?)" % hostname)
+            await uasyncio.sleep_ms(DNS_POLL_MS)
+    finally:
+        s.close()
+
+    (address, ttl) = result
+    ttl = min(max(ttl, DNS_MIN_TTL_S), DNS_MAX_TTL_S)
+    _dns_cache[hostname] = (address, ticks_add(ticks_ms(), ttl * 1000))
+    return address
+
+
+async def ntp_time(host=NTP_HOST, timeout_ms=NTP_TIMEOUT_MS):
+    """
+    Returns the time from an NTP server in seconds since the MicroPython epoch. Like resolve(), ntptime.settime()
+    would block while it waits for the answer, so the query is sent over a non-blocking UDP socket instead.
+    """
+    address = await resolve(host)
+    query = bytearray(48)
+    # version 3, client mode
+    query[0] = 0x1b
+    s = usocket.socket(usocket.AF_INET, usocket.SOCK_DGRAM)
+    try:
+        s.setblocking(False)
+        s.sendto(query, usocket.getaddrinfo(address, NTP_PORT)[0][-1])
+        deadline = ticks_add(ticks_ms(), timeout_ms)
+        while True:
+            try:
+                data = s.recv(48)
+                if len(data) == 48:
+                    break
+            except OSError as e:
+                if e.errno != uerrno.EAGAIN:
+                    raise
+            if ticks_diff(ticks_ms(), deadline) >= 0:
+                raise OSError(uerrno.ETIMEDOUT, "no answer from NTP server %s" % host)
+            await uasyncio.sleep_ms(DNS_POLL_MS)
+    finally:
+        s.close()
+    # the transmit timestamp
+    return ustruct.unpack_from("!I", data, 40)[0] - NTP_DELTA_S
+
+
+def split_url(url):
+    """Returns (https, hostname, port, path) of an http:// or https:// URL"""
+    (proto, _, rest) = url.partition("//")
+    https = proto == "https:"
+    if not https and proto != "http:":
+        raise ValueError("Unsupported URL %s" % url)
+    (host, _, path) = rest.partition("/")
+    port = 443 if https else 80
+    if ":" in host:
+        host, port = host.split(":")
+        port = int(port)
+    return https, host, port, "/" + path
+
+
+class HTTPResponse:
+    """
+    Response of request(). The body is read with read()/readinto(), which take care of Content-Length and chunked
+    transfer encoding. Always close() the response, it owns the connection.
+    """
+
+    def __init__(self, stream, timeout_ms):
+        self.stream = stream
+        self.timeout_ms = timeout_ms
+        self.status = None
+        self.headers = {}
+        self.buf = b""
+        self.eof = False
+        # bytes left in the body (or in the current chunk when chunked), None if the body ends at EOF
+        self.remaining = None
+        self.chunked = False
+        self.chunk_ended = False
+        self.done = False
+
+    async def _fill(self):
+        """Reads more data from the connection into buf, returns False at EOF"""
+        if self.eof:
+            return False
+        while True:
+            data = await uasyncio.wait_for_ms(self.stream.read(READ_CHUNK_SIZE), self.timeout_ms)
+            # a non-blocking TLS socket returns None while it has only part of a record
+            if data is not None:
+                break
+        if not data:
+            self.eof = True
+            return False
+        self.buf += data
+        return True
+
+    async def _readline(self):
+        while True:
+            idx = self.buf.find(b"\n")
+            if idx >= 0:
+                line = self.buf[:idx + 1]
+                self.buf = self.buf[idx + 1:]
+                return line
+            if len(self.buf) > MAX_HEADER_LINE:
+                raise ValueError("HTTP header line too long")
+            if not await self._fill():
+                line = self.buf
+                self.buf = b""
+                return line
+
+    async def _read_head(self):
+        line = await self._readline()
+        if not line:
+            raise ValueError("Unexpected EOF in HTTP status line")
+        (_, status, _) = (line.decode("latin1") + " ").split(" ", 2)
+        self.status = int(status)
+        while True:
+            line = await self._readline()
+            if not line:
+                raise ValueError("Unexpected EOF in HTTP headers")
+            if line == b"\r\n" or line == b"\n":
+                break
+            (name, _, value) = line.decode("latin1").partition(":")
+            self.headers[name.strip().lower()] = value.strip()
+
+        if self.status in (204, 304):
+            self.remaining = 0
+        elif self.headers.get("transfer-encoding", "").lower() == "chunked":
+            self.chunked = True
+            self.remaining = 0
+        elif "content-length" in self.headers:
+            self.remaining = int(self.headers["content-length"])
+
+    async def _next_chunk(self):
+        """Moves to the next chunk of a chunked body once the current one is consumed, False after the last one"""
+        if self.done:
+            return False
+        if not self.chunked or self.remaining:
+            return True
+        if self.chunk_ended:
+            # CRLF after the data of the previous chunk
+            await self._readline()
+        size = int((await self._readline()).split(b";")[0].strip(), 16)
+        self.chunk_ended = True
+        if size == 0:
+            # skip trailers
+            while (await self._readline()).strip():
+                pass
+            self.done = True
+            return False
+        self.remaining = size
+        return True
+
+    async def readinto(self, buf):
+        """Reads up to len(buf) bytes of the body, returns 0 at the end of the body"""
+        if not await self._next_chunk():
+            return 0
+        n = len(buf)
+        if self.remaining is not None:
+            if self.remaining == 0:
+                return 0
+            n = min(n, self.remaining)
+        if not self.buf and not await self._fill():
+            if self.remaining:
+                raise ValueError("Unexpected EOF in HTTP body")
+            return 0
+        n = min(n, len(self.buf))
+        buf[:n] = self.buf[:n]
+        self.buf = self.buf[n:]
+        if self.remaining is not None:
+            self.remaining -= n
+        return n
+
+    async def read(self, n=-1):
+        """Reads n bytes of the body (fewer only at its end), or all of it if n is negative"""
+        data = b""
+        buf = bytearray(READ_CHUNK_SIZE)
+        while n < 0 or len(data) < n:
+            want = READ_CHUNK_SIZE if n < 0 else min(READ_CHUNK_SIZE, n - len(data))
+            size = await self.readinto(memoryview(buf)[:want])
+            if not size:
+                break
+            data += buf[:size]
+        return data
+
+    async def close(self):
+        try:
+            await self.stream.aclose()
+        except OSError:
+            pass
+
+
+async def open_connection(hostname, port, https=False, timeout_ms=DEFAULT_TIMEOUT_MS):
+    """Returns a uasyncio stream connected to hostname, TLS wrapped for https"""
+    address = await resolve(hostname)
+    (stream, _) = await uasyncio.wait_for_ms(uasyncio.open_connection(address, port), timeout_ms)
+    if https:
+        try:
+            # the handshake runs as part of the first reads/writes on the non-blocking socket, so the stream is
+            # upgraded in place instead of blocking in wrap_socket()
+            stream.s = ussl.wrap_socket(stream.s, server_hostname=hostname, do_handshake=False)
+        except Exception:
+            await stream.aclose()
+            raise
+        log.debug("%s SSL certificate is not validated" % hostname)
+    return stream
+
+
+async def request(method, url, headers=None, body=None, timeout_ms=DEFAULT_TIMEOUT_MS, max_redirects=3):
+    """
+    Sends an HTTP/1.1 request without blocking the event loop and returns the HTTPResponse once its headers have been
+    received. Redirects are followed, HTTPError is raised for other statuses outside 2xx/304.
+    """
+    while True:
+        (https, hostname, port, path) = split_url(url)
+        stream = await open_connection(hostname, port, https, timeout_ms)
+        response = HTTPResponse(stream, timeout_ms)
+        try:
+            default_port = 443 if https else 80
+            head = "%s %s HTTP/1.1\r\nHost: %s\r\nUser-Agent: %s\r\nConnection: close\r\n" % (
+                method, path, hostname if port == default_port else "%s:%d" % (hostname, port), USER_AGENT)
+            if headers:
+                for name, value in headers.items():
+                    head += "%s: %s\r\n" % (name, value)
+            if body is not None:
+                head += "Content-Length: %d\r\n" % len(body)
+            stream.write(head.encode() + b"\r\n")
+            if body is not None:
+                stream.write(body)
+            await uasyncio.wait_for_ms(stream.drain(), timeout_ms)
+            await response._read_head()
+        except Exception:
+            await response.close()
+            raise
+
+        status = response.status
+        if status in (301, 302, 303, 307, 308) and "location" in response.headers:
+            await response.close()
+            if max_redirects <= 0:
+                raise HTTPError(status, "Too many redirects")
+            max_redirects -= 1
+            location = response.headers["location"]
+            if location.startswith("/"):
+                location = "%s://%s:%d%s" % ("https" if https else "http", hostname, port, location)
+            log.debug("Redirected to %s" % location)
+            url = location
+            if status == 303:
+                method = "GET"
+                body = None
+            continue
+
+        if 200 <= status < 300 or status == 304:
+            return response
+        await response.close()
+        if status == 404:
+            raise NotFoundError("%s not found" % url)
+        raise HTTPError(status)
+
+
+async def get(url, **kwargs):
+    return await request("GET", url, **kwargs)
+
+
+def open_url(url, redirect_tries_left=1, headers=None, timeout_ms=DEFAULT_TIMEOUT_MS):
+    """
+    Blocking GET returning the socket positioned at the start of the body, only for code which runs without the
+    event loop (e.g. OTA from boot). Use request() everywhere else. headers are sent on redirects too; with a Range
+    header the server must answer "206 Partial Content". Connecting and every read raise OSError after timeout_ms
+    without progress, so a stalled download fails instead of hanging.
+    """
     proto, _, hostname, urlpath = url.split("/", 3)
     try:
-        port = 443
+        port = 443 if proto == "https:" else 80
         if ":" in hostname:
             hostname, port = hostname.split(":")
             port = int(port)
@@ -19,6 +407,7 @@ def open_url(url, redirect_tries_left=1):
 
     s = usocket.socket(ai[0], ai[1], ai[2])
     try:
+        s.settimeout(timeout_ms / 1000)
         s.connect(ai[-1])
 
         if proto == "https:":
@@ -26,7 +415,11 @@ def open_url(url, redirect_tries_left=1):
             log.warning("Warning: %s SSL certificate is not validated" % hostname)
 
         # MicroPython rawsocket module supports file interface directly
-        s.write("GET /%s HTTP/1.0\r\nHost: %s:%s\r\nUser-Agent: open-lv/air-guard\r\n\r\n" % (urlpath, hostname, port))
+        s.write("GET /%s HTTP/1.0\r\nHost: %s:%s\r\nUser-Agent: %s\r\n" % (urlpath, hostname, port, USER_AGENT))
+        if headers:
+            for name, value in headers.items():
+                s.write("%s: %s\r\n" % (name, value))
+        s.write("\r\n")
         l = s.readline()
         protover, status, msg = l.split(None, 2)
         if status.startswith(b"3"):
@@ -40,9 +433,9 @@ def open_url(url, redirect_tries_left=1):
                     raise ValueError("Unexpected EOF in finding Location")
                 if l.startswith(b"Location:") or l.startswith(b"location:"):
                     s.close()
-                    return open_url(l[10:].decode("ascii").rstrip(), redirect_tries_left)
+                    return open_url(l[10:].decode("ascii").rstrip(), redirect_tries_left, headers, timeout_ms)
 
-        if status != b"200":
+        if status != (b"206" if headers and "Range" in headers else b"200"):
             if status == b"404":
                 raise NotFoundError("404 not found")
             raise ValueError(status)
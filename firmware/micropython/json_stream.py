@@ -0,0 +1,211 @@
+"""
+Pull-style JSON tokenizer for documents too large to load with ujson, e.g. the GitHub releases list. The stream is read
+in small chunks and only the values the caller asks for are kept, so memory use doesn't depend on the document size.
+
+    tokens = Tokenizer(stream)
+    for _ in tokens.array():
+        for key in tokens.object():
+            if key == "tag_name":
+                tag = tokens.value()
+            else:
+                tokens.skip()
+"""
+
+BEGIN_OBJECT = 1
+END_OBJECT = 2
+BEGIN_ARRAY = 3
+END_ARRAY = 4
+STRING = 5
+NUMBER = 6
+LITERAL = 7
+END = 8
+
+# tuples of byte values, MicroPython doesn't support `int in bytes`
+_WHITESPACE = tuple(b" \t\r\n,:")
+_NUMBER_CHARS = tuple(b"0123456789+-.eE")
+_LETTERS = tuple(b"abcdefghijklmnopqrstuvwxyz")
+_ESCAPES = {
+    ord('"'): '"',
+    ord("\\"): "\\",
+    ord("/"): "/",
+    ord("b"): "\b",
+    ord("f"): "\f",
+    ord("n"): "\n",
+    ord("r"): "\r",
+    ord("t"): "\t",
+}
+_LITERALS = {
+    "true": True,
+    "false": False,
+    "null": None,
+}
+
+
+class Tokenizer:
+    """
+    stream      - object with read(n), e.g. a socket returned by http_utils.open_url()
+    chunk_size  - bytes read from the stream at once
+    max_string  - strings longer than this (in bytes) are consumed but returned as None
+    """
+
+    def __init__(self, stream, chunk_size=512, max_string=256):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.max_string = max_string
+        self.chunk = b""
+        self.pos = 0
+        self.peeked = None
+        # set while skipping a value, its strings aren't kept
+        self.skipping = False
+
+    def _fill(self):
+        """Reads the next chunk, returns False at the end of the stream"""
+        self.chunk = self.stream.read(self.chunk_size) or b""
+        self.pos = 0
+        return len(self.chunk) > 0
+
+    def _byte(self):
+        if self.pos >= len(self.chunk) and not self._fill():
+            return -1
+        b = self.chunk[self.pos]
+        self.pos += 1
+        return b
+
+    def _string(self):
+        out = bytearray()
+        truncated = self.skipping
+        while True:
+            if self.pos >= len(self.chunk) and not self._fill():
+                raise ValueError("Unterminated JSON string")
+            quote = self.chunk.find(b'"', self.pos)
+            backslash = self.chunk.find(b"\\", self.pos)
+            end = len(self.chunk)
+            if quote >= 0:
+                end = quote
+            if 0 <= backslash < end:
+                end = backslash
+            if not truncated:
+                out += self.chunk[self.pos:end]
+                if len(out) > self.max_string:
+                    truncated = True
+                    out = bytearray()
+            self.pos = end
+            if end == len(self.chunk):
+                continue
+            self.pos += 1
+            if end == quote:
+                break
+            # escape sequence
+            b = self._byte()
+            if b == ord("u"):
+                code = int(bytes(self._byte() for _ in range(4)), 16)
+                if not truncated:
+                    out += chr(code).encode()
+            elif b in _ESCAPES:
+                if not truncated:
+                    out += _ESCAPES[b].encode()
+            else:
+                raise ValueError("Invalid JSON escape")
+        if truncated or len(out) > self.max_string:
+            return None
+        return out.decode()
+
+    def _scalar(self, first, chars):
+        out = bytearray([first])
+        while True:
+            if self.pos >= len(self.chunk) and not self._fill():
+                break
+            b = self.chunk[self.pos]
+            if b not in chars:
+                break
+            out.append(b)
+            self.pos += 1
+        return out.decode()
+
+    def next(self):
+        """Returns the next token as (kind, value), (END, None) at the end of the document"""
+        if self.peeked:
+            token = self.peeked
+            self.peeked = None
+            return token
+
+        b = self._byte()
+        while b >= 0 and b in _WHITESPACE:
+            b = self._byte()
+        if b < 0:
+            return END, None
+        if b == ord("{"):
+            return BEGIN_OBJECT, None
+        if b == ord("}"):
+            return END_OBJECT, None
+        if b == ord("["):
+            return BEGIN_ARRAY, None
+        if b == ord("]"):
+            return END_ARRAY, None
+        if b == ord('"'):
+            return STRING, self._string()
+        if b in _NUMBER_CHARS:
+            number = self._scalar(b, _NUMBER_CHARS)
+            if "." in number or "e" in number or "E" in number:
+                return NUMBER, float(number)
+            return NUMBER, int(number)
+        literal = self._scalar(b, _LETTERS)
+        if literal not in _LITERALS:
+            raise ValueError("Invalid JSON literal %s" % literal)
+        return LITERAL, _LITERALS[literal]
+
+    def peek(self):
+        if not self.peeked:
+            self.peeked = self.next()
+        return self.peeked
+
+    def _expect(self, kind):
+        token = self.next()
+        if token[0] != kind:
+            raise ValueError("Unexpected JSON token %d, expected %d" % (token[0], kind))
+
+    def object(self):
+        """Iterates over the keys of the next value, which must be an object. Consume each key's value in the loop."""
+        self._expect(BEGIN_OBJECT)
+        while True:
+            (kind, key) = self.next()
+            if kind == END_OBJECT:
+                return
+            if kind != STRING:
+                raise ValueError("Invalid JSON object key")
+            yield key
+
+    def array(self):
+        """Iterates over the next value, which must be an array. Consume each element in the loop."""
+        self._expect(BEGIN_ARRAY)
+        while True:
+            if self.peek()[0] == END_ARRAY:
+                self.next()
+                return
+            yield
+
+    def value(self):
+        """Returns the next value if it is a string, number or literal, skips it and returns None otherwise"""
+        (kind, value) = self.peek()
+        if kind in (BEGIN_OBJECT, BEGIN_ARRAY):
+            self.skip()
+            return None
+        return self.next()[1]
+
+    def skip(self):
+        """Skips the next value, including everything nested in it"""
+        depth = 0
+        self.skipping = True
+        try:
+            while True:
+                (kind, _) = self.next()
+                if kind in (BEGIN_OBJECT, BEGIN_ARRAY):
+                    depth += 1
+                elif kind in (END_OBJECT, END_ARRAY):
+                    depth -= 1
+                elif kind == END:
+                    raise ValueError("Unexpected end of JSON")
+                if depth <= 0:
+                    return
+        finally:
+            self.skipping = False
@@ -0,0 +1,68 @@
+import logging
+import struct
+
+log = logging.getLogger("bundle")
+
+runtime_dir = __file__[:__file__.rindex("/")]
+
+ENCODING_RAW = 0
+ENCODING_GZIP = 1
+
+
+class Bundle:
+    """
+    Read-only access to the asset bundle created by tools/flasher/pack-assets.py. The index is read once and the
+    bundle file is kept open, so reading an asset is a seek instead of a filesystem lookup and open().
+    """
+
+    MAGIC = b"AGB1"
+
+    def __init__(self, fn):
+        self.f = open(fn, "rb")
+        if self.f.read(4) != self.MAGIC:
+            self.f.close()
+            raise ValueError("%s is not an asset bundle" % fn)
+        (count, ) = struct.unpack("<H", self.f.read(2))
+        # name -> (offset, length, encoding)
+        self.index = {}
+        for _ in range(count):
+            name = self.f.read(self.f.read(1)[0]).decode()
+            self.index[name] = struct.unpack("<IIB", self.f.read(9))
+
+    def find(self, name):
+        """Returns (offset, length, encoding) of an asset, or None if it isn't in the bundle"""
+        return self.index.get(name)
+
+    def names(self, prefix=""):
+        return [name for name in self.index if name.startswith(prefix)]
+
+    def readinto(self, entry, buf, pos=0):
+        """Reads the asset data starting at pos into buf, returns the number of bytes read"""
+        (offset, length, _) = entry
+        size = min(len(buf), length - pos)
+        if size <= 0:
+            return 0
+        self.f.seek(offset + pos)
+        return self.f.readinto(memoryview(buf)[:size])
+
+    def read(self, entry):
+        buf = bytearray(entry[1])
+        self.readinto(entry, buf)
+        return buf
+
+
+_bundle = None
+_bundle_loaded = False
+
+
+def get():
+    """Returns the bundle shipped with this firmware, or None when running from loose files (e.g. development)"""
+    global _bundle, _bundle_loaded
+    if not _bundle_loaded:
+        _bundle_loaded = True
+        try:
+            _bundle = Bundle(runtime_dir + "/assets.bundle")
+            log.info("%d assets in bundle" % len(_bundle.index))
+        except (OSError, ValueError) as e:
+            log.info("asset bundle not available, using loose files: %s" % e)
+    return _bundle
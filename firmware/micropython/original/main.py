@@ -3,15 +3,20 @@ import gc
 import uasyncio
 
 import logging
+import ota_utils
 from . import sargsui
 from . import sargs
 from . import plot
 from . import utils
 from . import portal
-import time
+from . import profiler
 
 log = logging.getLogger("main")
 
+# running this long after setup confirms a freshly installed version, see ota_utils.check_trial()
+CONFIRM_VERSION_AFTER_S = 120
+WATCHDOG_FEED_S = 30
+
 sargs = sargs.setup()
 
 
@@ -20,23 +25,32 @@ async def measurements():
         measurement = await sargs.perform_co2_measurement()
         sargs.handle_co2_measurement(measurement)
 
-        if measurement <= 1000:
+        # the backend may change the thresholds and the sample period at any time, see remote.py
+        if measurement <= sargs.config.CO2_THRESHOLD_MEDIUM:
             sargs.led_yellow.off()
             sargs.led_red.off()
 
             sargs.led_green.on()
-        elif measurement <= 1400:
+        elif measurement <= sargs.config.CO2_THRESHOLD_HIGH:
             sargs.led_green.off()
             sargs.led_red.off()
 
             sargs.led_yellow.on()
-        elif measurement > 1400:
+        else:
             sargs.led_green.off()
             sargs.led_yellow.off()
 
             sargs.led_red.on()
 
-        await uasyncio.sleep(5)
+        await uasyncio.sleep(sargs.config.CO2_SAMPLE_PERIOD_S)
+
+
+async def confirm_version():
+    await uasyncio.sleep(CONFIRM_VERSION_AFTER_S)
+    ota_utils.confirm_version()
+    # the trial's watchdog can't be stopped
+    while ota_utils.feed_watchdog():
+        await uasyncio.sleep(WATCHDOG_FEED_S)
 
 
 def set_global_exception():
@@ -79,43 +93,13 @@ async def setup():
 
     log.info("mem_free=%d" % gc.mem_free())
     log.info("Setting up tasks")
-    uasyncio.create_task(sargs.run())
-    uasyncio.create_task(metrics()())
+    prof = profiler.get()
+    uasyncio.create_task(prof.run())
+    uasyncio.create_task(prof.track("ui", sargs.run()))
+    uasyncio.create_task(confirm_version())
 
     log.info("mem_free=%d" % gc.mem_free())
-    await measurements()
-
-
-def metrics():
-    ncalls = 0
-    max_d = 0
-    min_d = 100_000_000
-    tot_d = 0
-    st = 'Max {}us Min {}us Avg {}us No. of calls {} Freq {}'
-
-    async def func():
-        nonlocal ncalls, max_d, min_d, tot_d
-        while True:
-            tstart = time.ticks_us()
-            t_last = None
-            while time.ticks_diff(t := time.ticks_us(), tstart) < 10_000_000:
-                await uasyncio.sleep(0)
-                if ncalls:
-                    dt = time.ticks_diff(t, t_last)
-                    max_d = max(max_d, dt)
-                    min_d = min(min_d, dt)
-                    tot_d += dt
-                ncalls += 1
-                t_last = t
-            log.info(st.format(max_d, min_d, tot_d // ncalls, ncalls, ncalls // 10))
-            gc.collect()
-            log.info('mem_free = {}'.format(gc.mem_free()))
-            ncalls = 0
-            max_d = 0
-            min_d = 100_000_000
-            tot_d = 0
-
-    return func
+    await uasyncio.create_task(prof.track("measurements", measurements()))
 
 
 def run():
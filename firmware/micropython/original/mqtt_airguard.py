@@ -1,29 +1,298 @@
-from umqtt.simple import MQTTClient
 import logging
-from utime import ticks_ms
+import uasyncio
+import uerrno
+import ustruct
+import http_utils
+from utime import ticks_ms, ticks_add, ticks_diff
 
 
-class AirGuardIotMQTTClient(MQTTClient):
-    """Implements the Air Guard MQTT client API."""
+class MQTTException(Exception):
+    pass
 
-    def __init__(self, username, password):
-        self.log = logging.getLogger("mqtt_client")
 
-        super().__init__(client_id=username,
-                         server="mqtt.gaisasargs.lv",
-                         user=username,
-                         password=password)
+def _string(s):
+    if isinstance(s, str):
+        s = s.encode()
+    return ustruct.pack("!H", len(s)) + s
+
+
+def _packet(first_byte, body):
+    """An MQTT packet: fixed header with the remaining length, then body"""
+    header = bytearray((first_byte,))
+    n = len(body)
+    while True:
+        header.append((n & 0x7f) | (0x80 if n > 0x7f else 0))
+        n >>= 7
+        if not n:
+            break
+    return header + body
+
+
+class AirGuardIotMQTTClient:
+    """
+    Implements the Air Guard MQTT client API on uasyncio streams, so that the network never blocks the event loop.
+    run() is the client's task: it connects, sends the messages queued by publish() and keeps the connection alive,
+    reconnecting with a backoff when it drops. Everything else only queues messages.
+
+    on_connected() is called after each connect, on_message(topic, msg) for the messages of the topics subscribed to.
+    """
+
+    SERVER = "mqtt.gaisasargs.lv"
+    PORT = 1883
+    # the broker drops the connection if nothing is sent for 1.5 times this
+    KEEPALIVE_S = 120
+    # connecting, CONNACK and writes
+    TIMEOUT_MS = 10000
+    RECONNECT_MIN_S = 10
+    RECONNECT_MAX_S = 300
+    # messages waiting to be sent, the oldest are dropped beyond this
+    MAX_QUEUED = 10
+    # readings per telemetry message
+    MAX_BATCH = 30
+    # how long send_telemetry() waits for the broker to acknowledge a batch before the readings are spooled
+    DELIVERY_TIMEOUT_MS = 60000
+
+    def __init__(self, username, password, server=SERVER, port=PORT, on_connected=None, on_message=None):
+        self.log = logging.getLogger("mqtt_client")
+        self.client_id = username
+        self.server = server
+        self.port = port
+        self.user = username
+        self.password = password
 
         self.log.info("AirGuardIotMQTTClient initialized, server=%s, user=%s", self.server, self.user)
 
-        self.publish_interval_s = 60
-        self.next_publish_time_ms = 0
-
-    def send_telemetry(self, payload):
-        """Send JSON payload to the telemetry endpoint v1/devices/me/telemetry"""
-        if ticks_ms() > self.next_publish_time_ms:
-            self.next_publish_time_ms = ticks_ms() + self.publish_interval_s * 1000
-            self.log.info("publishing sensor measurements payload: %s", payload)
-            self.connect()
-            self.publish("v1/devices/me/telemetry", payload)
-            self.disconnect()
+        self.on_connected = on_connected
+        self.on_message = on_message
+        self.is_connected = False
+        self.stream = None
+        # [packet id, topic, message, qos, dup] waiting to be sent, oldest first
+        self.outbox = []
+        # packet id -> the same for QoS 1 messages sent but not acknowledged yet, resent after reconnecting
+        self.unacked = {}
+        self.next_pid = 1
+        # topic filter -> qos, subscribed again on every connection
+        self.subscriptions = {}
+        self.subscribed = False
+        # packet ids of the received QoS 1 messages waiting for PUBACK
+        self.acks = []
+        self.last_sent_ms = 0
+        self.ping_pending = False
+        # set when there is something to send or the connection failed
+        self._wake = uasyncio.Event()
+        # set when a message has been sent or acknowledged
+        self._delivered = uasyncio.Event()
+        self._error = None
+
+    def publish(self, topic, msg, qos=0):
+        """Queues a message, run() sends it once connected. QoS 1 messages are resent until the broker has them."""
+        if isinstance(msg, str):
+            msg = msg.encode()
+        pid = 0
+        if qos:
+            pid = self.next_pid
+            self.next_pid = self.next_pid % 0xffff + 1
+        self.outbox.append([pid, topic, msg, qos, False])
+        if len(self.outbox) > self.MAX_QUEUED:
+            self.log.warning("mqtt send queue full, dropping a message to %s" % self.outbox.pop(0)[1])
+        self._wake.set()
+
+    def subscribe(self, topic, qos=0):
+        """Subscribes to topic (wildcards allowed) on this and every following connection"""
+        self.subscriptions[topic] = qos
+        self.subscribed = False
+        self._wake.set()
+
+    def pending(self):
+        """Number of messages queued or waiting for an acknowledgement"""
+        return len(self.outbox) + len(self.unacked)
+
+    async def wait_delivered(self, timeout_ms):
+        """Waits until everything published so far has been delivered, returns False if that took over timeout_ms"""
+        deadline = ticks_add(ticks_ms(), timeout_ms)
+        while self.pending():
+            remaining_ms = ticks_diff(deadline, ticks_ms())
+            if remaining_ms <= 0:
+                return False
+            try:
+                await uasyncio.wait_for_ms(self._delivered.wait(), remaining_ms)
+            except uasyncio.TimeoutError:
+                return False
+            self._delivered.clear()
+        return True
+
+    async def run(self):
+        """The client's task, runs until cancelled"""
+        retry_s = self.RECONNECT_MIN_S
+        while True:
+            try:
+                await self._connect()
+                retry_s = self.RECONNECT_MIN_S
+                await self._serve()
+            except (MQTTException, OSError, EOFError, uasyncio.TimeoutError) as e:
+                self.log.error("mqtt connection failed: %s, re-connecting in %ds" % (repr(e), retry_s))
+            finally:
+                await self.close()
+            await uasyncio.sleep(retry_s)
+            retry_s = min(retry_s * 2, self.RECONNECT_MAX_S)
+
+    async def _connect(self):
+        self.stream = await http_utils.open_connection(self.server, self.port, timeout_ms=self.TIMEOUT_MS)
+        # clean session, user name and password
+        body = b"\x00\x04MQTT\x04\xc2" + ustruct.pack("!H", self.KEEPALIVE_S)
+        body += _string(self.client_id) + _string(self.user) + _string(self.password)
+        await self._send(_packet(0x10, body))
+        (first_byte, body) = await uasyncio.wait_for_ms(self._read_packet(), self.TIMEOUT_MS)
+        if first_byte != 0x20 or len(body) != 2:
+            raise MQTTException("unexpected packet 0x%02x instead of CONNACK" % first_byte)
+        if body[1]:
+            raise MQTTException("connection refused, return code %d" % body[1])
+        self.is_connected = True
+        self.ping_pending = False
+        self.subscribed = False
+        self.acks = []
+        self._error = None
+        self.log.info("connected to %s" % self.server)
+        # what the previous connection didn't get acknowledged goes first
+        if self.unacked:
+            resend = sorted(self.unacked.values(), key=lambda m: m[0])
+            for m in resend:
+                m[4] = True
+            self.outbox = resend + self.outbox
+            self.unacked = {}
+        if self.on_connected:
+            self.on_connected()
+
+    async def _serve(self):
+        """Sends the queued messages and pings while idle, the incoming packets are read by _receive()"""
+        receiver = uasyncio.create_task(self._receive())
+        try:
+            while True:
+                if self._error:
+                    raise self._error
+                if self.acks:
+                    await self._send(b"\x40\x02" + ustruct.pack("!H", self.acks.pop(0)))
+                    continue
+                if not self.subscribed and self.subscriptions:
+                    await self._send_subscribe()
+                    continue
+                if self.outbox:
+                    await self._send_publish(self.outbox.pop(0))
+                    continue
+                idle_ms = self.KEEPALIVE_S * 1000 // 2 - ticks_diff(ticks_ms(), self.last_sent_ms)
+                if idle_ms <= 0:
+                    if self.ping_pending:
+                        raise OSError(uerrno.ETIMEDOUT, "no PINGRESP")
+                    self.ping_pending = True
+                    await self._send(b"\xc0\x00")
+                    continue
+                try:
+                    await uasyncio.wait_for_ms(self._wake.wait(), idle_ms)
+                except uasyncio.TimeoutError:
+                    pass
+                self._wake.clear()
+        finally:
+            receiver.cancel()
+
+    async def _send_publish(self, m):
+        (pid, topic, msg, qos, dup) = m
+        body = _string(topic)
+        if qos:
+            body += ustruct.pack("!H", pid)
+            # registered before sending, the PUBACK may arrive before the write returns
+            self.unacked[pid] = m
+        await self._send(_packet(0x30 | (0x08 if dup else 0) | qos << 1, body + msg))
+        if not qos:
+            self._delivered.set()
+
+    async def _send_subscribe(self):
+        body = ustruct.pack("!H", self.next_pid)
+        self.next_pid = self.next_pid % 0xffff + 1
+        for topic, qos in self.subscriptions.items():
+            body += _string(topic) + bytes((qos,))
+        self.subscribed = True
+        await self._send(_packet(0x82, body))
+
+    async def _send(self, packet):
+        self.stream.write(packet)
+        await uasyncio.wait_for_ms(self.stream.drain(), self.TIMEOUT_MS)
+        self.last_sent_ms = ticks_ms()
+
+    async def _read_packet(self):
+        """Returns (first byte, body) of the next incoming packet, the packet type is in the upper 4 bits"""
+        first_byte = (await self.stream.readexactly(1))[0]
+        n = 0
+        shift = 0
+        while True:
+            b = (await self.stream.readexactly(1))[0]
+            n |= (b & 0x7f) << shift
+            if not b & 0x80:
+                break
+            shift += 7
+        return first_byte, (await self.stream.readexactly(n)) if n else b""
+
+    async def _receive(self):
+        try:
+            while True:
+                (first_byte, body) = await self._read_packet()
+                packet_type = first_byte & 0xf0
+                if packet_type == 0x30:
+                    self._handle_publish(first_byte, body)
+                elif packet_type == 0x40:
+                    # PUBACK
+                    if self.unacked.pop(ustruct.unpack("!H", body)[0], None):
+                        self._delivered.set()
+                elif packet_type == 0x90:
+                    # SUBACK, a return code per topic
+                    if b"\x80" in body[2:]:
+                        self.log.warning("broker refused a subscription of %s" % ", ".join(self.subscriptions))
+                elif packet_type == 0xd0:
+                    # PINGRESP
+                    self.ping_pending = False
+        except (OSError, EOFError) as e:
+            # _serve() raises it
+            self._error = e
+            self._wake.set()
+
+    def _handle_publish(self, first_byte, body):
+        (n,) = ustruct.unpack_from("!H", body)
+        topic = bytes(body[2:2 + n]).decode()
+        pos = 2 + n
+        if first_byte & 0x06:
+            # QoS 1, acknowledged by _serve()
+            self.acks.append(ustruct.unpack_from("!H", body, pos)[0])
+            self._wake.set()
+            pos += 2
+        if self.on_message:
+            try:
+                self.on_message(topic, body[pos:])
+            except Exception as e:
+                self.log.exc(e, "error handling a message to %s" % topic)
+
+    async def close(self):
+        self.is_connected = False
+        if self.stream:
+            (stream, self.stream) = (self.stream, None)
+            try:
+                await stream.aclose()
+            except OSError:
+                pass
+
+    async def send_telemetry(self, queue, encoder, latest_values=None):
+        """
+        Publishes the queued readings (see telemetry.TelemetryQueue) in batches of up to MAX_BATCH, oldest first,
+        encoded by one of the telemetry encoders. latest_values (a dict, e.g. {"firmwareVersion": "1.2.3"}) goes with
+        the newest reading. Each batch is removed from the queue once the broker has acknowledged it.
+        """
+        while len(queue):
+            n = min(len(queue), self.MAX_BATCH)
+            # the queue may drop its oldest records while the batch is in flight
+            for record in queue.peek(n):
+                last_seq = record[2]
+            for (topic, payload) in encoder.messages(queue, n, latest_values if n == len(queue) else None):
+                self.log.info("publishing %d readings to %s, %d bytes" % (n, topic, len(payload)))
+                self.publish(topic, payload, qos=1)
+            while not await self.wait_delivered(self.DELIVERY_TIMEOUT_MS):
+                # still queued in the client, sent once the connection is back
+                queue.failed()
+            queue.sent(last_seq)
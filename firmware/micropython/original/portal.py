@@ -7,6 +7,8 @@ import tinyweb
 import os
 import binascii
 
+from . import bundle
+from . import profiler
 from . import sargs
 from . import sargsui
 
@@ -28,6 +30,33 @@ def decode_station_authmode(authmode):
 runtime_dir = __file__[:__file__.rindex("/")]
 
 
+async def send_static_file(response, path, content_type):
+    """Sends a gzipped web portal file, path being relative to the static directory (e.g. "/index.html")"""
+    assets = bundle.get()
+    if assets is None:
+        await response.send_file(runtime_dir + "/static" + path + ".gz", content_type=content_type,
+                                 content_encoding="gzip")
+        return
+
+    entry = assets.find("static" + path)
+    if entry is None:
+        raise tinyweb.HTTPException(404)
+    response.add_header('Content-Length', str(entry[1]))
+    response.add_header('Content-Type', content_type)
+    if entry[2] == bundle.ENCODING_GZIP:
+        response.add_header('Content-Encoding', 'gzip')
+    response.add_header('Cache-Control', 'max-age=2592000, public')
+    await response._send_headers()
+    buf = bytearray(response.buffer_size)
+    pos = 0
+    while True:
+        size = assets.readinto(entry, buf, pos)
+        if size == 0:
+            break
+        await response.send(buf, sz=size)
+        pos += size
+
+
 class CaptiveWebserver(tinyweb.webserver):
     def __init__(self, ip_addr, request_timeout=3, max_concurrency=3, backlog=16, buffer_size=512, debug=False):
         super().__init__(request_timeout, max_concurrency, backlog, buffer_size, debug)
@@ -80,8 +109,7 @@ class Portal:
 
     @server.route('/')
     async def index(request, response):
-        await response.send_file(runtime_dir + '/static/index.html.gz', content_type="text/html; charset=UTF-8",
-                                 content_encoding="gzip")
+        await send_static_file(response, '/index.html', "text/html; charset=UTF-8")
 
     @server.resource('/api/state')
     def sargsState(data):
@@ -108,6 +136,10 @@ class Portal:
             }
         }
 
+    @server.resource('/api/metrics')
+    def metrics(data):
+        return profiler.get().snapshot()
+
     @server.resource('/api/stations')
     async def stations(data):
         access_points = sargs.Sargs.sargs_instance.get_wifi_ap_list()
@@ -129,7 +161,7 @@ class Portal:
         yield "]"
 
     @server.resource('/api/ota/prepare', method='POST')
-    def ota_prepare(data:dist):
+    def ota_prepare(data: dict):
         if not data.get('version_name') or not isinstance(data.get('version_name'), str):
             return {
                        "error": '"version_name" must be of type "string"'
@@ -165,14 +197,20 @@ class Portal:
             content_type = 'text/css'
         if path.endswith('.svg'):
             content_type = 'image/svg+xml'
-        await response.send_file(runtime_dir + "/static" + path + ".gz", content_type=content_type + "; charset=UTF-8",
-                                 content_encoding="gzip")
+        await send_static_file(response, path, content_type + "; charset=UTF-8")
 
     def setup(self):
         self.server.run(host="0.0.0.0", port=80, loop_forever=False)
         self.is_running = True
 
 
+def add_bundle_static_routes(portal, assets):
+    for name in assets.names("static/"):
+        path = name[6:]
+        print("Adding static route: {0}".format(path))
+        portal.server.add_route(path, Portal.serveStaticFile)
+
+
 def add_static_routes(portal, dir="static"):
     for record in os.listdir(runtime_dir + "/" + dir):
         try:
@@ -195,5 +233,9 @@ def add_static_routes(portal, dir="static"):
 
 def setup():
     portal = Portal()
-    add_static_routes(portal)
+    assets = bundle.get()
+    if assets is not None:
+        add_bundle_static_routes(portal, assets)
+    else:
+        add_static_routes(portal)
     portal.setup()
@@ -0,0 +1,217 @@
+import gc
+import logging
+
+import uasyncio
+from utime import ticks_ms, ticks_us, ticks_diff
+
+log = logging.getLogger("profiler")
+
+# upper bounds of the scheduler gap histogram buckets, the last bucket counts everything above
+GAP_BUCKETS_US = (1000, 2000, 5000, 10000, 20000, 50000, 100000, 200000, 500000)
+
+
+class TaskStats:
+    """Time a coroutine spent running between two awaits"""
+
+    def __init__(self, name):
+        self.name = name
+        self.resumes = 0
+        self.total_us = 0
+        self.max_us = 0
+
+    def add(self, us):
+        self.resumes += 1
+        self.total_us += us
+        if us > self.max_us:
+            self.max_us = us
+
+    def to_json(self):
+        return {
+            "resumes": self.resumes,
+            "totalUs": self.total_us,
+            "maxUs": self.max_us,
+        }
+
+
+class _TrackedCoro:
+    """
+    Wraps a coroutine and times every send()/throw() the scheduler does on it, i.e. every slice the task runs without
+    yielding. Works as a coroutine for both uasyncio (which only needs send/throw) and CPython asyncio.
+    """
+
+    def __init__(self, coro, stats):
+        self.coro = coro
+        self.stats = stats
+
+    def send(self, value):
+        t = ticks_us()
+        try:
+            return self.coro.send(value)
+        finally:
+            self.stats.add(ticks_diff(ticks_us(), t))
+
+    def throw(self, exc, *args):
+        t = ticks_us()
+        try:
+            return self.coro.throw(exc)
+        finally:
+            self.stats.add(ticks_diff(ticks_us(), t))
+
+    def close(self):
+        self.coro.close()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.send(None)
+
+    def __await__(self):
+        return self
+
+
+class Profiler:
+    """
+    Event loop latency and heap profiler.
+
+    A sampler task sleeps SAMPLE_PERIOD_MS at a time; how late it wakes up is the scheduler gap, i.e. how long some
+    other task kept the loop busy. Each sample also records the free heap low-water mark and whether the collector ran
+    since the previous sample (allocated heap shrank), in which case the gap is an upper bound of the GC pause.
+    Tasks started with track() additionally report how long each of their slices ran, which shows the task to blame.
+    """
+
+    SAMPLE_PERIOD_MS = 100
+    LOG_PERIOD_MS = 60 * 1000
+
+    def __init__(self):
+        self.tasks = {}
+        self.started_ticks_ms = ticks_ms()
+        self.samples = 0
+        self.gap_histogram = [0] * (len(GAP_BUCKETS_US) + 1)
+        self.gap_total_us = 0
+        self.gap_max_us = 0
+        self.mem_free_min = gc.mem_free()
+        self.last_mem_alloc = gc.mem_alloc()
+        self.gc_count = 0
+        self.gc_gap_max_us = 0
+        self.collect_count = 0
+        self.collect_max_us = 0
+
+    def track(self, name, coro):
+        """Returns coro wrapped so that its running time is accounted to name, pass it to uasyncio.create_task()"""
+        stats = self.tasks.get(name)
+        if stats is None:
+            stats = self.tasks[name] = TaskStats(name)
+        return _TrackedCoro(coro, stats)
+
+    def collect(self):
+        """gc.collect() with its pause recorded"""
+        t = ticks_us()
+        gc.collect()
+        us = ticks_diff(ticks_us(), t)
+        self.collect_count += 1
+        if us > self.collect_max_us:
+            self.collect_max_us = us
+        self.last_mem_alloc = gc.mem_alloc()
+
+    def _record_gap(self, gap_us):
+        self.samples += 1
+        self.gap_total_us += gap_us
+        if gap_us > self.gap_max_us:
+            self.gap_max_us = gap_us
+        for i, bound in enumerate(GAP_BUCKETS_US):
+            if gap_us < bound:
+                self.gap_histogram[i] += 1
+                return
+        self.gap_histogram[-1] += 1
+
+    def _record_heap(self, gap_us):
+        mem_free = gc.mem_free()
+        if mem_free < self.mem_free_min:
+            self.mem_free_min = mem_free
+        mem_alloc = gc.mem_alloc()
+        if mem_alloc < self.last_mem_alloc:
+            self.gc_count += 1
+            if gap_us > self.gc_gap_max_us:
+                self.gc_gap_max_us = gap_us
+        self.last_mem_alloc = mem_alloc
+
+    def slowest_task(self):
+        """Returns the TaskStats with the longest single slice, or None"""
+        slowest = None
+        for stats in self.tasks.values():
+            if slowest is None or stats.max_us > slowest.max_us:
+                slowest = stats
+        return slowest
+
+    async def run(self):
+        period_us = self.SAMPLE_PERIOD_MS * 1000
+        next_log_ticks_ms = ticks_ms() + self.LOG_PERIOD_MS
+        last = ticks_us()
+        while True:
+            await uasyncio.sleep_ms(self.SAMPLE_PERIOD_MS)
+            now = ticks_us()
+            gap_us = max(0, ticks_diff(now, last) - period_us)
+            last = now
+            self._record_gap(gap_us)
+            self._record_heap(gap_us)
+
+            if ticks_diff(ticks_ms(), next_log_ticks_ms) >= 0:
+                next_log_ticks_ms = ticks_ms() + self.LOG_PERIOD_MS
+                self.log_summary()
+
+    def log_summary(self):
+        slowest = self.slowest_task()
+        log.info("loop gap max %dus avg %dus, mem_free %d (min %d), gc %d, slowest task %s %dus" % (
+            self.gap_max_us, self.gap_total_us // max(1, self.samples), gc.mem_free(), self.mem_free_min,
+            self.gc_count + self.collect_count, slowest.name if slowest else None, slowest.max_us if slowest else 0))
+
+    def snapshot(self):
+        """All metrics, as served by /api/metrics"""
+        return {
+            "uptimeMs": ticks_diff(ticks_ms(), self.started_ticks_ms),
+            "loop": {
+                "samplePeriodMs": self.SAMPLE_PERIOD_MS,
+                "samples": self.samples,
+                "gapMaxUs": self.gap_max_us,
+                "gapAvgUs": self.gap_total_us // max(1, self.samples),
+                "gapHistogram": {
+                    "boundsUs": GAP_BUCKETS_US,
+                    "counts": self.gap_histogram,
+                },
+            },
+            "heap": {
+                "memFree": gc.mem_free(),
+                "memFreeMin": self.mem_free_min,
+                "memAlloc": gc.mem_alloc(),
+            },
+            "gc": {
+                "collections": self.gc_count,
+                "maxGapUs": self.gc_gap_max_us,
+                "explicitCollections": self.collect_count,
+                "explicitMaxUs": self.collect_max_us,
+            },
+            "tasks": {name: stats.to_json() for name, stats in self.tasks.items()},
+        }
+
+    def summary(self):
+        """Compact metrics for the MQTT telemetry payload"""
+        slowest = self.slowest_task()
+        return {
+            "gapMaxUs": self.gap_max_us,
+            "memFreeMin": self.mem_free_min,
+            "gc": self.gc_count + self.collect_count,
+            "slowTask": slowest.name if slowest else None,
+            "slowTaskMaxUs": slowest.max_us if slowest else 0,
+        }
+
+
+_profiler = None
+
+
+def get():
+    """Returns the device profiler, created on first use"""
+    global _profiler
+    if _profiler is None:
+        _profiler = Profiler()
+    return _profiler
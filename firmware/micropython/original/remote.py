@@ -0,0 +1,109 @@
+import logging
+import machine
+import re
+import uasyncio
+import ujson
+from . import telemetry
+
+# ThingsBoard device API, "me" is the device the MQTT client is logged in as
+# shared attributes: the settings the backend set for this device, pushed as they change
+ATTRIBUTES_TOPIC = "v1/devices/me/attributes"
+ATTRIBUTES_REQUEST_TOPIC = "v1/devices/me/attributes/request/%d"
+ATTRIBUTES_RESPONSE_TOPIC = "v1/devices/me/attributes/response/+"
+# commands: {"method": ..., "params": ...}, answered on the response topic with the same id
+RPC_REQUEST_TOPIC = "v1/devices/me/rpc/request/+"
+RPC_RESPONSE_TOPIC = "v1/devices/me/rpc/response/%s"
+
+# the values of the string settings the firmware understands, others are rejected instead of saved
+VALIDATORS = {
+    "TELEMETRY_ENCODING": lambda value: value in telemetry.ENCODERS,
+    "TELEMETRY_STATISTICS": telemetry.valid_statistics,
+}
+
+
+class RemoteControl:
+    """
+    Configuration and commands from the backend over MQTT. The settings in SargsConfig._remote_settings are taken
+    from the device's shared attributes, requested on every connect and pushed when they change, applied right away
+    and saved to config.json. They are reported back as client attributes. Commands (RPC):
+
+        getConfig               returns the settings
+        update {"version": v}   installs version v, or the latest release without params
+        reboot
+    """
+
+    # how long a command that restarts the device waits for its response to be sent
+    RESPONSE_TIMEOUT_MS = 5000
+
+    def __init__(self, sargs, client):
+        self.log = logging.getLogger("remote")
+        self.sargs = sargs
+        self.config = sargs.config
+        self.client = client
+        self.next_request_id = 1
+        client.subscribe(ATTRIBUTES_TOPIC)
+        client.subscribe(ATTRIBUTES_RESPONSE_TOPIC)
+        client.subscribe(RPC_REQUEST_TOPIC)
+
+    def on_connected(self):
+        keys = ",".join(self.config.remote_settings())
+        self.client.publish(ATTRIBUTES_REQUEST_TOPIC % self.next_request_id, '{"sharedKeys": "%s"}' % keys)
+        self.next_request_id += 1
+
+    def on_message(self, topic, msg):
+        try:
+            data = ujson.loads(msg)
+        except ValueError:
+            self.log.warning("invalid message to %s" % topic)
+            return
+        if topic == ATTRIBUTES_TOPIC:
+            self.apply_config(data)
+        elif topic.startswith(ATTRIBUTES_RESPONSE_TOPIC[:-1]):
+            self.apply_config(data.get("shared", {}))
+        elif topic.startswith(RPC_REQUEST_TOPIC[:-1]):
+            request_id = topic[len(RPC_REQUEST_TOPIC) - 1:]
+            result = self.handle_command(data.get("method"), data.get("params"))
+            self.client.publish(RPC_RESPONSE_TOPIC % request_id, ujson.dumps(result), qos=1)
+
+    def apply_config(self, values):
+        changed = self.config.update_remote(values, VALIDATORS)
+        if not changed:
+            return
+        self.log.info("settings changed remotely: %s" % ", ".join(changed))
+        if "TELEMETRY_ENCODING" in changed or "TELEMETRY_STATISTICS" in changed:
+            self.sargs.telemetry_encoder = telemetry.encoder(self.config.TELEMETRY_ENCODING,
+                                                             self.config.TELEMETRY_STATISTICS)
+        if "TELEMETRY_WINDOW_S" in changed and self.sargs.telemetry_queue is not None:
+            # from the next window on
+            self.sargs.telemetry_queue.window_s = self.config.TELEMETRY_WINDOW_S
+        try:
+            self.config.save()
+        except OSError as e:
+            self.log.error("failed to save the settings: %s" % repr(e))
+        self.client.publish(ATTRIBUTES_TOPIC, ujson.dumps(self.config.remote_settings()), qos=1)
+
+    def handle_command(self, method, params):
+        """Returns the response to a command"""
+        self.log.info("command %s received" % method)
+        if method == "getConfig":
+            return self.config.remote_settings()
+        if method == "update":
+            version = params.get("version") if isinstance(params, dict) else None
+            if version is None:
+                version = self.sargs.latest_version
+                if not version or version == self.sargs.version:
+                    return {"error": "no newer version known"}
+            elif not isinstance(version, str) or not re.match("^[0-9]\\.[0-9]+\\.[0-9]+$", version):
+                return {"error": 'invalid "version"'}
+            uasyncio.create_task(self._after_response(lambda: self.sargs.prepare_ota(version)))
+            return {"version": version}
+        if method == "reboot":
+            uasyncio.create_task(self._after_response(machine.reset))
+            return {}
+        return {"error": "unknown method %s" % method}
+
+    async def _after_response(self, action):
+        # the response is published after handle_command() returns
+        await uasyncio.sleep(0)
+        await self.client.wait_delivered(self.RESPONSE_TIMEOUT_MS)
+        action()
@@ -1,5 +1,4 @@
 import binascii
-import gc
 import logging
 import machine
 import mhz19
@@ -9,14 +8,18 @@ import ota_utils
 from . import mqtt_airguard
 from . import sargsui
 from . import portal
+from . import profiler
+from . import versioncheck
+from . import telemetry
+from . import remote
 import sys
 import time
 import uasyncio
+import ujson
 import urequests
 from machine import Pin, I2C, UART, ADC, reset
 from uasyncio import CancelledError
 from uasyncio import Task
-from umqtt.simple import MQTTException
 from .utils import *
 from utime import ticks_ms
 import network_manager
@@ -40,7 +43,7 @@ EYE_BRIGHTNESS = 128
 class Sargs:
     sargs_instance = None
 
-    UPDATE_CHECK_PERIOD = 1000 * 60 * 60  # once an hour
+    LATEST_RELEASE_URL = "https://gaisasargs.lv/latest_release"
     INTERNET_CONNECTION_TIMEOUT = 10
 
     led_red = LEDPWMSignal(Pin(33, Pin.OUT), on_duty=HAND_BRIGHTNESS)
@@ -49,7 +52,8 @@ class Sargs:
     led_left_eye = LEDPWMSignal(Pin(23, Pin.OUT), on_duty=EYE_BRIGHTNESS)
     led_right_eye = LEDPWMSignal(Pin(19, Pin.OUT), on_duty=EYE_BRIGHTNESS)
 
-    btn_arm = Signal(Pin(35, Pin.IN, Pin.PULL_UP), invert=True)
+    btn_pin = Pin(35, Pin.IN, Pin.PULL_UP)
+    buttons = None
 
     ldr_adc = ADC(Pin(34))
     pin_lcd_data = Pin(21, pull=Pin.PULL_UP)
@@ -70,10 +74,19 @@ class Sargs:
     _ap_if = network.WLAN(network.AP_IF)
 
     mqtt_client = None
+    _mqtt_task: uasyncio.Task = None
+    remote_control = None
+    telemetry_queue = None
+    _telemetry_task: uasyncio.Task = None
+    # how often the telemetry task checks whether a publish is due, and the first retry of setting the clock
+    TELEMETRY_POLL_S = 10
+    # setting the clock is retried with a backoff up to this, NTP may be blocked on the network
+    NTP_MAX_RETRY_S = 3600
 
     exit_requested = False
 
     version = "XXX"
+    latest_version = None
 
     machine_id = binascii.hexlify(machine.unique_id()).decode("ascii")
     machine_id_short = machine_id[:6]
@@ -82,6 +95,12 @@ class Sargs:
 
     def __init__(self):
         self.log = logging.getLogger("sargs")
+        self.buttons = ButtonService(self.btn_pin, invert=True)
+        self.version_checker = versioncheck.VersionChecker(self.LATEST_RELEASE_URL)
+        if self.config.WIFI_ENABLED:
+            # readings are queued while offline too, and published once connected
+            self.telemetry_queue = telemetry.TelemetryQueue(self.config.TELEMETRY_WINDOW_S)
+            self.telemetry_encoder = telemetry.encoder(self.config.TELEMETRY_ENCODING, self.config.TELEMETRY_STATISTICS)
 
         # flash.sh/release process stores version in airguardversion.py file
         try:
@@ -115,7 +134,7 @@ class Sargs:
             self.screen = display
             self.screen.drawFill(0)
             self.screen.flush()
-            self.ui = sargsui.SargsUI(self.screen, self.btn_arm, self.buzzer,
+            self.ui = sargsui.SargsUI(self.screen, self.buttons, self.buzzer,
                                       self.ldr_adc, self.led_left_eye, self.led_right_eye)
 
             self.log.info("LCD initialized")
@@ -171,15 +190,46 @@ class Sargs:
 
     def handle_co2_measurement(self, m):
         self.co2_measurement = m
-        if self.mqtt_client:
-            try:
-                payload = '{ "co2": %d, "temperature": %d, firmwareVersion: "%s" }' % (
-                    self.co2_measurement, self.co2_sensor.get_cached_temperature_reading(), self.version)
-                self.mqtt_client.send_telemetry(payload)
-            except (MQTTException, OSError) as e:
-                self.log.error("error during mqtt publishing: %s" % repr(e))
-                self.log.info("re-connecting to mqtt")
-                self.connect_mqtt()
+        self.ui.record_co2_measurement(m)
+        if self.telemetry_queue is not None:
+            self.telemetry_queue.add(m, self.co2_sensor.get_cached_temperature_reading())
+
+    async def _publish_telemetry(self):
+        """Hands the queued readings to the MQTT client every publish interval, the client's task sends them"""
+        # mqtt_client is unset when the network disconnects, before the cancellation reaches this task
+        client = self.mqtt_client
+        retry_s = self.TELEMETRY_POLL_S
+        clock_retry_ms = ticks_ms()
+        published_ms = None
+        while True:
+            # readings taken before the clock is set are published without their time, see telemetry.JsonEncoder
+            if not telemetry.clock_is_set() and time.ticks_diff(ticks_ms(), clock_retry_ms) >= 0:
+                if not await self._set_clock():
+                    clock_retry_ms = time.ticks_add(ticks_ms(), retry_s * 1000)
+                    retry_s = min(retry_s * 2, self.NTP_MAX_RETRY_S)
+            # the interval may be changed remotely in the meantime
+            interval_ms = self.config.TELEMETRY_PUBLISH_INTERVAL_S * 1000
+            if published_ms is None or time.ticks_diff(ticks_ms(), published_ms) >= interval_ms:
+                latest_values = {"firmwareVersion": self.version}
+                if self.config.METRICS_TELEMETRY_ENABLED:
+                    latest_values["metrics"] = profiler.get().summary()
+                await client.send_telemetry(self.telemetry_queue, self.telemetry_encoder, latest_values)
+                published_ms = ticks_ms()
+            await uasyncio.sleep(self.TELEMETRY_POLL_S)
+
+    async def _set_clock(self):
+        """Sets the clock from NTP so that readings can be timestamped, returns False if that failed"""
+        try:
+            t = await http_utils.ntp_time()
+        except OSError as e:
+            self.log.warning("failed to set the clock from NTP: %s" % repr(e))
+            return False
+        before = time.time()
+        tm = time.gmtime(t)
+        machine.RTC().datetime((tm[0], tm[1], tm[2], tm[6] + 1, tm[3], tm[4], tm[5], 0))
+        self.telemetry_queue.clock_set(time.time() - before)
+        self.log.info("clock set from NTP")
+        return True
 
     def update_wifi_settings(self, wifi_ssid, wifi_password):
         self.config.WIFI_SSID = wifi_ssid
@@ -198,7 +248,14 @@ class Sargs:
             else:
                 # TODO: Enable this only if users opt-in.
                 self.mqtt_client = mqtt_airguard.AirGuardIotMQTTClient(self.machine_id, self.machine_id)
+                if self.config.REMOTE_CONFIG_ENABLED:
+                    self.remote_control = remote.RemoteControl(self, self.mqtt_client)
+                    self.mqtt_client.on_connected = self.remote_control.on_connected
+                    self.mqtt_client.on_message = self.remote_control.on_message
                 self.log.info("mqtt initialized")
+                self._mqtt_task = uasyncio.create_task(profiler.get().track("mqtt", self.mqtt_client.run()))
+                self._telemetry_task = uasyncio.create_task(
+                    profiler.get().track("telemetry", self._publish_telemetry()))
 
         except ImportError:
             self.log.info("mqtt requires valid configuration")
@@ -255,95 +312,84 @@ class Sargs:
         self.prepare_ota(self.latest_version)
 
     def prepare_ota(self, version_name):
+        # the version directory this module runs from stays as the fallback
+        ota_utils.prepare_update(version_name, __name__.split(".")[0])
         self.log.info("Written new main.py for OTA")
-        with open("main.py") as f:
-            f.write("""
-
-import ota
-ota = ota.OTA()
-ota.perform_update("%s")
-
-""" % version_name)
 
         self.log.info("OTA information saved, restarting...")
         machine.reset()
 
+    def _parse_release_tag(self, tag):
+        if not tag or not tag.startswith("micropython-"):
+            raise Exception("Invalid version response: %s" % tag)
+        return tag[12:]
+
     async def get_latest_version(self):
-        reader = None
         try:
-            # this method is blocking due to usocket.getaddrinfo
-            # that resolved DNS name
-            reader = http_utils.open_url("https://gaisasargs.lv/latest_release")
-            await uasyncio.sleep_ms(0)
-            line = reader.read(24).splitlines()[0]
-            reader.close()
-            await uasyncio.sleep_ms(0)
+            return self._parse_release_tag(await self.version_checker.check())
+        except Exception as e:
+            self.log.exc(e, "Error while checking \"%s\" update" % self.LATEST_RELEASE_URL)
 
-            latest_version = line.decode('latin1').rstrip()
+        return None
 
-            if not latest_version.startswith("micropython-"):
-                raise Exception("Invalid version response: %s" % latest_version)
+    def set_latest_version(self, latest_version):
+        update_available = latest_version != self.version
 
-            return latest_version[12:]
-        except Exception as e:
-            self.log.exc(e, "Error while checking \"https://gaisasargs.lv/latest_release\" update")
-        finally:
-            if reader:
-                reader.close()
+        self.ui.update_available = update_available
+        self.ui.latest_version = latest_version
+        self.latest_version = latest_version
 
-        return None
+        if update_available:
+            self.log.info("New update available!")
+            self.log.info("Current version: %s, latest version: %s" % (self.version, self.latest_version))
 
     async def _check_internet(self):
         self.log.info("Internet connectivity checker started")
-        last_version_check_time = -self.UPDATE_CHECK_PERIOD
+        try:
+            # known from a check before the last reboot, until the next check confirms it
+            self.set_latest_version(self._parse_release_tag(self.version_checker.latest_version))
+        except Exception:
+            pass
 
         while True:
             try:
                 reader, writer = await uasyncio.wait_for(uasyncio.open_connection('1.1.1.1', 53),
                                                          self.INTERNET_CONNECTION_TIMEOUT)
                 await writer.aclose()
-                self.ui.internet_state = sargsui.InternetState.CONNECTED
+                self.ui.set_internet_state(sargsui.InternetState.CONNECTED)
 
-                if (time.ticks_ms() - last_version_check_time) > self.UPDATE_CHECK_PERIOD:
-                    last_version_check_time = time.ticks_ms()
+                if self.version_checker.is_due():
                     latest_version = await self.get_latest_version()
 
                     if latest_version:
-                        update_available = latest_version != self.version
-
-                        self.ui.update_available = update_available
-                        self.ui.latest_version = latest_version
-                        self.latest_version = latest_version
-                        last_version_check_time = time.ticks_ms()
-
-                        if update_available:
-                            self.log.info("New update available!")
-                            self.log.info(
-                                "Current version: %s, latest version: %s" % (self.version, self.latest_version))
+                        self.set_latest_version(latest_version)
                     else:
                         self.log.info("Could not fetch update information")
 
                 await uasyncio.sleep(30)
             except CancelledError:
                 self.log.info("Internet connectivity checker cancelled")
-                self.ui.internet_state = sargsui.InternetState.DISCONNECTED
+                self.ui.set_internet_state(sargsui.InternetState.DISCONNECTED)
                 raise
             except Exception as e:
                 self.log.info("error during internet connectivity check: %s. Retrying in 30 seconds" % repr(e))
-                self.ui.internet_state = sargsui.InternetState.DISCONNECTED
+                self.ui.set_internet_state(sargsui.InternetState.DISCONNECTED)
                 await uasyncio.sleep(30)
 
     def _on_network_manager_connected(self):
         self.ui.set_wifi_state(sargsui.WiFiState.CONNECTED)
         self.ui.set_display_ip_address(self._sta_if.ifconfig()[0])
         self.connect_mqtt()
-        self._internet_checker_task = uasyncio.create_task(self._check_internet())
+        self._internet_checker_task = uasyncio.create_task(profiler.get().track("internet", self._check_internet()))
 
     def _on_network_manager_disconnected(self):
         self.ui.set_wifi_state(sargsui.WiFiState.DISCONNECTED)
         self.ui.set_display_ip_address(None)
         if self.mqtt_client:
+            self._telemetry_task.cancel()
+            self._mqtt_task.cancel()
             self.mqtt_client = None
+            self.telemetry_queue.failed()
         self._internet_checker_task.cancel()
 
     def _on_network_manager_connecting(self):
@@ -378,7 +424,7 @@ ota.perform_update("%s")
         return measurement
 
     async def run(self):
-        gc.collect()
+        profiler.get().collect()
         """
         This task is executed in the context of a thread that's separate from main.py.
         It should handle re-drawing screen, handling WiFi status polling, 
@@ -409,11 +455,12 @@ ota.perform_update("%s")
             await uasyncio.sleep(0.1)
         self.log.info("background thread started")
         await self.buzzer.startup_beep()
+        uasyncio.create_task(profiler.get().track("buttons", self.ui.forward_button_events()))
         while not self.exit_requested:
             try:
                 while not self.exit_requested:
                     await self.run_screen()
-                    await uasyncio.sleep_ms(0)  # not more than 60FPS
+                    await self.ui.wait_next_frame()
             except KeyboardInterrupt as e:
                 self.log.info("KeyboardInterrupt, exiting Sargs thread")
                 self.exit_requested = True
@@ -4,9 +4,12 @@ import sys
 import time
 
 import uasyncio
-from utime import ticks_ms
-from .utils import ButtonEventHandler, EyeAnimation, Buzzer
+from utime import ticks_ms, ticks_add, ticks_diff
+from .utils import ButtonService, EyeAnimation, Buzzer
+from . import bundle
 from . import plot
+from . import sprites
+from . import timeseries
 
 # uPy doesn't seem to support enums, this is probably better than passing constants around
 
@@ -74,10 +77,39 @@ class SargsUI:
 
     MAIN_SUBSCREENS = ["draw_main_large_heart_screen", "draw_main_small_heart_screen",
                        "draw_15min_plot_screen", "draw_1h_plot_screen", "draw_12h_plot_screen", "draw_24h_plot_screen",
+                       "draw_7d_plot_screen",
                        "draw_network_screen", "draw_credits_screen",
                        ]
+    # frame period of each screen in ms. Screens that are missing are only redrawn on events (button press,
+    # new measurement, state change) or when they are entered
+    SCREEN_FRAME_MS = {
+        ScreenState.INIT_SCREEN: 50,
+        ScreenState.INTRO_SCREEN: 50,
+        ScreenState.WARMUP_SCREEN: 50,
+        ScreenState.OPEN_WINDOW_SCREEN: 50,
+        ScreenState.LARGE_PPM_SCREEN: 300,
+        ScreenState.CALIBRATION_SCREEN: 1000,
+        ScreenState.OTA_UPDATE_SCREEN: 1000,
+    }
+    MAIN_SUBSCREEN_FRAME_MS = {
+        "draw_main_large_heart_screen": 50,
+        "draw_main_small_heart_screen": 50,
+        "draw_network_screen": 1000,
+        "draw_credits_screen": 30,
+    }
+    # period of sampling the LDR and advancing eye animations, independent of the screen frame rate
+    HOUSEKEEPING_PERIOD_MS = 50
+
+    # main sub-screens showing a plot, mapped to the index of the plot
+    PLOT_SUBSCREENS = {
+        "draw_15min_plot_screen": 0,
+        "draw_1h_plot_screen": 1,
+        "draw_12h_plot_screen": 2,
+        "draw_24h_plot_screen": 3,
+        "draw_7d_plot_screen": 4,
+    }
 
-    def __init__(self, screen, btn_signal, buzzer, ldr, left_eye, right_eye):
+    def __init__(self, screen, buttons, buzzer, ldr, left_eye, right_eye):
 
         self.heart_frame = 0
         self.heart_next_ticks_ms = 0
@@ -96,11 +128,8 @@ class SargsUI:
         self.display_ip_address = None
         self.cal_sel_btn = 1
         self.ota_sel_btn = 1
-        self.main_screen_btn_handler = None
-        self.cal_screen_btn_handler = None
-        self.ota_screen_btn_handler = None
-        self.cal_screen_negedge_count = 0
-        self.ota_screen_negedge_count = 0
+        # button event of the current frame, see ButtonService.poll()
+        self.btn_event = None
         self.cal_screen_act_time = 0
         self.ota_screen_act_time = 0
 
@@ -115,14 +144,23 @@ class SargsUI:
         self.HIGH_CO2_ALERT_DEBOUNCE_MS = 5 * 60 * 1000
         self.high_co2_alert_time = 0
         self.prev_co2_level = CO2Level.LOW
-        self.frame_display_ms = 50
-
-        self.plots = [
-            ("15 min", plot.CO2Plotter(15, 128, 48)),
-            ("1 h", plot.CO2Plotter(60, 128, 48)),
-            ("12 h", plot.CO2Plotter(60 * 12, 128, 48)),
-            ("24 h", plot.CO2Plotter(60 * 24, 128, 48))
-        ]
+        # frame scheduling, see wait_next_frame()
+        self.wake = uasyncio.Event()
+        self.next_frame_ticks_ms = None
+        # (screen, main subscreen) the current frame schedule is for
+        self.scheduled_screen = None
+        # content key of the frame currently shown on the display, see _content_key()
+        self.shown_content_key = None
+        self.skip_draw = False
+
+        self.co2_history = timeseries.TimeSeriesStore([
+            ("15 min", 15),
+            ("1 h", 60),
+            ("12 h", 60 * 12),
+            ("24 h", 60 * 24),
+            ("7 d", 60 * 24 * 7),
+        ], 128)
+        self.plots = [(t.name, plot.CO2Plotter(t, 128, 48)) for t in self.co2_history.tiers]
 
         self.init_screen_frame = 0
 
@@ -148,7 +186,7 @@ class SargsUI:
         self.log = logging.getLogger("screen")
         self.buzzer: Buzzer = buzzer
         self.screen = screen
-        self.btn_signal = btn_signal
+        self.buttons: ButtonService = buttons
         self.ldr = ldr
         self.led_left_eye = left_eye
         self.led_right_eye = right_eye
@@ -156,46 +194,60 @@ class SargsUI:
         self.led_left_eye.on()
         self.led_right_eye.on()
 
-        self.main_screen_btn_handler = ButtonEventHandler(self.btn_signal)
-        self.cal_screen_btn_handler = ButtonEventHandler(self.btn_signal)
-        self.ota_screen_btn_handler = ButtonEventHandler(self.btn_signal)
-
         self.runtime_dir = __file__[:__file__.rindex("/")]
+        self.bundle = bundle.get()
+        # pre-decoded sprites can only be used if the display firmware supports blitting raw 1-bpp images
+        if hasattr(self.screen, "drawRaw"):
+            self.sprites = sprites.SpriteCache(self.bundle, self.runtime_dir)
+        else:
+            self.log.warning("display does not support drawRaw, sprites will be decoded from PNG files")
+            self.sprites = None
 
         self.update_available = False
         self.update_prompt_shown = False
         self.latest_version = None
 
     def set_co2_measurement(self, m):
-        self.co2_measurement = m
-        for p in self.plots:
-            p[1].add_measurement(m)
+        if m != self.co2_measurement:
+            self.co2_measurement = m
+            self.wake.set()
+
+    def record_co2_measurement(self, m):
+        """Adds a new sensor reading to the CO2 history, should be called once per reading"""
+        self.co2_history.add_measurement(m)
+        self.wake.set()
 
     def set_temperature_measurement(self, m):
-        self.temperature_measurement = m
+        if m != self.temperature_measurement:
+            self.temperature_measurement = m
+            self.wake.set()
 
     def set_wifi_state(self, s):
         self.wifi_state = s
+        self.wake.set()
 
     def set_internet_state(self, s):
-        self.internet_state = s
+        if s != self.internet_state:
+            self.internet_state = s
+            self.wake.set()
 
     def set_display_ip_address(self, ip):
         self.display_ip_address = ip
+        self.wake.set()
 
     def set_co2_level(self, l):
-        self.co2_level = l
+        if l != self.co2_level:
+            self.co2_level = l
+            self.wake.set()
 
     def select_main_screen(self):
         self.current_screen = ScreenState.MAIN_SCREEN
         self.calibration_requested = False
-        self.frame_display_ms = 0
 
     def select_last_main_subscreen(self):
         self.main_selected_subscreen = len(self.MAIN_SUBSCREENS) - 2
 
     def select_cal_screen(self):
-        self.cal_screen_negedge_count = 0
         self.cal_screen_act_time = ticks_ms()
         self.current_screen = ScreenState.CALIBRATION_SCREEN
 
@@ -223,14 +275,47 @@ class SargsUI:
             choices = [EyeAnimation.LEFT_TO_RIGHT, EyeAnimation.RIGHT_TO_LEFT, EyeAnimation.BLINK]
             self.eye_animation = EyeAnimation(self.led_left_eye, self.led_right_eye, random.choice(choices))
 
+    async def forward_button_events(self):
+        """Wakes up the UI loop on button edges, runs as a separate task"""
+        while True:
+            await self.buttons.flag.wait()
+            self.wake.set()
+
+    def _screen_selection(self):
+        return self.current_screen, self.main_selected_subscreen
+
+    def _frame_period_ms(self):
+        if self.current_screen == ScreenState.MAIN_SCREEN:
+            return self.MAIN_SUBSCREEN_FRAME_MS.get(self.MAIN_SUBSCREENS[self.main_selected_subscreen])
+        return self.SCREEN_FRAME_MS.get(self.current_screen)
+
+    async def wait_next_frame(self):
+        """Sleeps until the next frame or housekeeping tick is due, the button is used or displayed data changes"""
+        timeout = self.HOUSEKEEPING_PERIOD_MS
+        now = ticks_ms()
+        for deadline in (self.next_frame_ticks_ms, self.buttons.longpress_deadline()):
+            if deadline is not None:
+                timeout = min(timeout, max(0, ticks_diff(deadline, now)))
+        if timeout == 0 or self.wake.is_set():
+            await uasyncio.sleep_ms(0)
+            return
+        try:
+            await uasyncio.wait_for_ms(self.wake.wait(), timeout)
+        except uasyncio.TimeoutError:
+            pass
+
     async def update(self):
+        self.btn_event = self.buttons.poll()
+        woken = self.wake.is_set() or self.btn_event is not None
+        self.wake.clear()
+
         self.process_ldr()
         await uasyncio.sleep_ms(0)
         if self.eye_animation and not self.eye_animation.tick():
             self.eye_animation = None
 
         if self.eye_animation is None:
-            if self.btn_signal.value():
+            if self.buttons.value():
                 self.trigger_random_eye_animation()
             elif ticks_ms() > self.eye_next_blink_ticks_ms:
                 # choose a random animation for ~1/4 of the blinks
@@ -253,8 +338,37 @@ class SargsUI:
         if self.update_available and not self.update_prompt_shown and not is_ota_screen:
             self.select_ota_screen()
 
-        self.screen.drawFill(0)
-        await uasyncio.sleep_ms(0)
+        # the screen is only updated when its next frame is due, something has changed or a new screen was selected
+        frame_due = self.next_frame_ticks_ms is not None and ticks_diff(ticks_ms(), self.next_frame_ticks_ms) >= 0
+        if woken or frame_due or self._screen_selection() != self.scheduled_screen:
+            self.scheduled_screen = self._screen_selection()
+            changed = await self.draw_frame()
+            if changed or self._screen_selection() != self.scheduled_screen:
+                # the screen function switched (sub)screens or changed a selection, draw the result right away
+                self.next_frame_ticks_ms = ticks_ms()
+            else:
+                period = self._frame_period_ms()
+                self.next_frame_ticks_ms = ticks_add(ticks_ms(), period) if period is not None else None
+
+        # if CO2 level has just become high
+        if self.co2_level == CO2Level.HIGH and self.prev_co2_level != self.co2_level:
+            # end we haven't alerted for some time
+            if (ticks_ms() - self.high_co2_alert_time) > self.HIGH_CO2_ALERT_DEBOUNCE_MS:
+                self.log.info("high co2 level alert triggered")
+                await self.buzzer.high_co2_level_alert()
+                self.high_co2_alert_time = ticks_ms()
+        self.prev_co2_level = self.co2_level
+
+    async def draw_frame(self):
+        """Returns True if the screen function changed the content while handling the button, e.g. a selection"""
+        # when the content of the screen has not changed since the last flush, the screen functions still run
+        # (they handle input and screen transitions), but clearing, PNG decoding and flushing are skipped. Anything
+        # else they draw is identical to what's already in the framebuffer
+        content_key = self._content_key()
+        self.skip_draw = content_key is not None and content_key == self.shown_content_key
+        if not self.skip_draw:
+            self.screen.drawFill(0)
+            await uasyncio.sleep_ms(0)
 
         screen_fn_map = {
             ScreenState.INIT_SCREEN: self.draw_init_screen,
@@ -269,20 +383,34 @@ class SargsUI:
         }
         if self.current_screen in screen_fn_map.keys():
             await screen_fn_map[self.current_screen]()
-        self.screen.flush()
-        await uasyncio.sleep_ms(0)
-
-        # if CO2 level has just become high
-        if self.co2_level == CO2Level.HIGH and self.prev_co2_level != self.co2_level:
-            # end we haven't alerted for some time
-            if (ticks_ms() - self.high_co2_alert_time) > self.HIGH_CO2_ALERT_DEBOUNCE_MS:
-                self.log.info("high co2 level alert triggered")
-                await self.buzzer.high_co2_level_alert()
-                self.high_co2_alert_time = ticks_ms()
-        self.prev_co2_level = self.co2_level
+        if not self.skip_draw:
+            self.screen.flush()
+            self.shown_content_key = content_key
+            await uasyncio.sleep_ms(0)
+        # animation frames advance the key on every frame, only changes made by input need an immediate frame
+        return self.btn_event is not None and self._content_key() != content_key
 
-        if self.frame_display_ms > 0:
-            await uasyncio.sleep_ms(self.frame_display_ms)
+    def _content_key(self):
+        """
+        Returns a tuple of everything the content of the current screen depends on, or None for screens that
+        change on every frame (animations)
+        """
+        screen = self.current_screen
+        if screen == ScreenState.MAIN_SCREEN:
+            subscreen = self.MAIN_SUBSCREENS[self.main_selected_subscreen]
+            if subscreen == "draw_main_large_heart_screen":
+                return (screen, subscreen, self.large_heart_frame, self.co2_measurement, self.temperature_measurement)
+            if subscreen == "draw_main_small_heart_screen":
+                return (screen, subscreen, self.heart_frame, self.co2_measurement, self.temperature_measurement)
+            if subscreen in self.PLOT_SUBSCREENS:
+                return (screen, subscreen, self.plots[self.PLOT_SUBSCREENS[subscreen]][1].tier.version)
+            if subscreen == "draw_network_screen":
+                return (screen, subscreen, self.wifi_state, self.internet_state, self.display_ip_address)
+        elif screen == ScreenState.CALIBRATION_SCREEN:
+            return (screen, self.cal_sel_btn, self.calibration_requested)
+        elif screen == ScreenState.OTA_UPDATE_SCREEN:
+            return (screen, self.ota_sel_btn, self.ota_update_requested, self.latest_version)
+        return None
 
     async def draw_init_screen(self):
         explosion_range = list(range(0, 11))
@@ -309,11 +437,11 @@ class SargsUI:
             self.current_screen = ScreenState.WARMUP_SCREEN
 
     async def draw_main_screen(self):
-        if self.main_screen_btn_handler.longpress():
+        if self.btn_event == ButtonService.LONGPRESS:
             await self.buzzer.short_beep()
             self.log.info("switching to cal screen")
             self.select_cal_screen()
-        elif self.main_screen_btn_handler.negedge():
+        elif self.btn_event == ButtonService.RELEASE:
             await self.buzzer.short_beep()
             self.main_selected_subscreen += 1
             if self.main_selected_subscreen == len(self.MAIN_SUBSCREENS):
@@ -322,7 +450,6 @@ class SargsUI:
         if self.co2_level == CO2Level.MEDIUM or self.co2_level == CO2Level.HIGH:
             self.current_screen = ScreenState.OPEN_WINDOW_SCREEN
             await self.buzzer.short_beep()
-            self.frame_display_ms = 50
             self.eye_animation = EyeAnimation(self.led_left_eye, self.led_right_eye,
                                           [EyeAnimation.FADE_IN, EyeAnimation.FADE_OUT])
 
@@ -390,7 +517,6 @@ class SargsUI:
             self.current_screen = ScreenState.LARGE_PPM_SCREEN
             self.open_window_frame = 0
             self.large_ppm_enter_ticks_ms = ticks_ms()
-            self.frame_display_ms = 300
 
     async def draw_large_ppm_screen(self):
         ppm_t = str(self.co2_measurement)
@@ -415,7 +541,6 @@ class SargsUI:
             self.eye_animation = EyeAnimation(self.led_left_eye, self.led_right_eye,
                                               [EyeAnimation.FADE_IN, EyeAnimation.FADE_OUT])
             self.current_screen = ScreenState.OPEN_WINDOW_SCREEN
-            self.frame_display_ms = 50
 
     async def draw_hcenter_text(self, y, text):
         """Draws a horizontally centered line of text at specified offset from top"""
@@ -425,27 +550,22 @@ class SargsUI:
         await uasyncio.sleep_ms(0)
 
     async def draw_calibration_screen(self):
-
-        # don't react to the negative edge of the long-press that was used to enter this screen
-        if self.cal_screen_negedge_count == 0 and self.cal_screen_btn_handler.negedge():
-            self.cal_screen_negedge_count += 1
-
         # go back to main screen after 30 seconds of inactivity
         screen_timeout = (ticks_ms() - self.cal_screen_act_time) > 30 * 1000
-        if not self.calibration_requested and screen_timeout and not self.cal_screen_btn_handler.signal.value():
+        if not self.calibration_requested and screen_timeout and not self.buttons.value():
             self.log.info("returning to main screen due to timeout")
             self.select_main_screen()
 
-        if not self.calibration_requested and self.cal_screen_negedge_count > 0:
-            # select yes/no on button release
-            if self.cal_screen_btn_handler.negedge():
+        if not self.calibration_requested:
+            # select yes/no on button release (the long press used to enter this screen doesn't generate one)
+            if self.btn_event == ButtonService.RELEASE:
                 await self.buzzer.short_beep()
                 self.cal_screen_act_time = ticks_ms()
                 self.cal_sel_btn += 1
                 if self.cal_sel_btn == 3:
                     self.cal_sel_btn = 1
 
-            if self.cal_screen_btn_handler.longpress():
+            if self.btn_event == ButtonService.LONGPRESS:
                 if self.cal_sel_btn == 2:
                     # yes selected, request calibration
                     self.log.info("user cal requested")
@@ -539,7 +659,15 @@ class SargsUI:
         self.credits_next_ticks_ms = ticks_ms() + 5
 
     async def drawPng(self, x_pos, y_pos, fn):
-        self.screen.drawPng(x_pos, y_pos, self.runtime_dir + fn)
+        if self.skip_draw:
+            return
+        name = fn[1:]
+        if self.sprites is None or not self.sprites.draw(self.screen, x_pos, y_pos, name):
+            entry = self.bundle.find(name) if self.bundle else None
+            if entry:
+                self.screen.drawPng(x_pos, y_pos, self.bundle.read(entry))
+            else:
+                self.screen.drawPng(x_pos, y_pos, self.runtime_dir + fn)
         await uasyncio.sleep_ms(0)
 
     async def draw_15min_plot_screen(self):
@@ -563,6 +691,12 @@ class SargsUI:
         else:
             await self.draw_plot_screen(3)
 
+    async def draw_7d_plot_screen(self):
+        if not self.plots[4][1].have_enough_data():
+            self.select_last_main_subscreen()
+        else:
+            await self.draw_plot_screen(4)
+
     async def draw_plot_screen(self, selected_plot):
         sp = self.plots[selected_plot]
         text = "%s " % sp[0]
@@ -571,7 +705,8 @@ class SargsUI:
                              text)
         await uasyncio.sleep_ms(0)
         if sp[1].have_enough_data():
-            await sp[1].plot_data(self.screen, 0)
+            if not self.skip_draw:
+                await sp[1].plot_data(self.screen, 0)
         else:
             await self.draw_hcenter_text(24, "Nepietiek datu!")
 
@@ -585,21 +720,21 @@ class SargsUI:
     async def draw_ota_update_screen(self):
 
         screen_timeout = (ticks_ms() - self.ota_screen_act_time) > 60 * 1000
-        if not self.ota_update_requested and screen_timeout and not self.ota_screen_btn_handler.signal.value():
+        if not self.ota_update_requested and screen_timeout and not self.buttons.value():
             self.log.info("returning to main screen due to timeout")
             self.update_prompt_shown = True
             self.select_main_screen()
 
         if not self.ota_update_requested:
             # select yes/no on button release
-            if self.ota_screen_btn_handler.negedge():
+            if self.btn_event == ButtonService.RELEASE:
                 self.ota_screen_act_time = ticks_ms()
                 await self.buzzer.short_beep()
                 self.ota_sel_btn += 1
                 if self.ota_sel_btn == 3:
                     self.ota_sel_btn = 1
 
-            if self.ota_screen_btn_handler.longpress():
+            if self.btn_event == ButtonService.LONGPRESS:
                 self.update_prompt_shown = True
                 if self.ota_sel_btn == 2:
                     self.log.info("user requested ota")
@@ -0,0 +1,87 @@
+import logging
+import os
+import struct
+import ubinascii
+
+
+class SegmentLog:
+    """
+    Append-only log of checksummed batches, used to persist data without rewriting the whole file on every save.
+
+    File layout: magic, followed by any number of batches. Each batch is a (payload length, crc32) header and the
+    payload itself. A batch that is truncated or fails the checksum (e.g. power was lost mid-write) ends the log, and
+    the next write compacts the log instead of appending behind the damaged tail. Compaction writes the full state
+    into a temporary file and renames it over the log, so the log is never left half-written.
+    """
+
+    BATCH_HEADER = "<HI"
+    BATCH_HEADER_SIZE = 6
+
+    def __init__(self, fn, magic, compact_size=16 * 1024):
+        self.log = logging.getLogger("seglog")
+        self.fn = fn
+        self.magic = magic
+        self.compact_size = compact_size
+        self.size = 0
+        self.damaged = True
+
+    def needs_compaction(self) -> bool:
+        return self.damaged or self.size > self.compact_size
+
+    def read_batches(self):
+        """Yields the payloads of all intact batches in the order they were appended"""
+        self.size = 0
+        self.damaged = True
+        try:
+            f = open(self.fn, "rb")
+        except OSError:
+            self.log.info("%s does not exist" % self.fn)
+            return
+
+        with f:
+            if f.read(len(self.magic)) != self.magic:
+                self.log.warning("%s has unexpected format, discarding" % self.fn)
+                return
+            size = len(self.magic)
+            while True:
+                header = f.read(self.BATCH_HEADER_SIZE)
+                if not header:
+                    break
+                if len(header) != self.BATCH_HEADER_SIZE:
+                    self.log.warning("%s: truncated batch header at offset %d" % (self.fn, size))
+                    self.size = size
+                    return
+                (length, crc) = struct.unpack(self.BATCH_HEADER, header)
+                payload = f.read(length)
+                if len(payload) != length or ubinascii.crc32(payload) != crc:
+                    self.log.warning("%s: damaged batch at offset %d" % (self.fn, size))
+                    self.size = size
+                    return
+                size += self.BATCH_HEADER_SIZE + length
+                yield payload
+
+        self.size = size
+        self.damaged = False
+
+    def _write_batch(self, f, payload):
+        f.write(struct.pack(self.BATCH_HEADER, len(payload), ubinascii.crc32(payload)))
+        f.write(payload)
+        return self.BATCH_HEADER_SIZE + len(payload)
+
+    def append(self, payload):
+        """Appends a single batch to the end of the log"""
+        with open(self.fn, "ab") as f:
+            self.size += self._write_batch(f, payload)
+
+    def compact(self, payloads):
+        """Replaces the log with a fresh one holding the given batches"""
+        tmp_fn = self.fn + ".tmp"
+        with open(tmp_fn, "wb") as f:
+            f.write(self.magic)
+            size = len(self.magic)
+            for payload in payloads:
+                size += self._write_batch(f, payload)
+        os.rename(tmp_fn, self.fn)
+        self.size = size
+        self.damaged = False
+        self.log.info("%s compacted to %d bytes" % (self.fn, size))
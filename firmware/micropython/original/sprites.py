@@ -0,0 +1,84 @@
+import logging
+import struct
+
+
+class SpriteCache:
+    """
+    LRU cache of pre-decoded sprites. The build converts every PNG asset into a raw 1-bpp ".spr" file (see
+    tools/flasher/convert-sprites.py), the cache keeps the most recently drawn ones in RAM within a memory budget, so
+    animation frames are blitted without touching the filesystem or decoding PNGs.
+
+    Sprites are read from the asset bundle when the firmware has one, otherwise from loose files in runtime_dir.
+    """
+
+    HEADER_FMT = "<HH"
+    HEADER_SIZE = 4
+
+    def __init__(self, bundle, runtime_dir, budget_bytes=8 * 1024):
+        self.log = logging.getLogger("sprites")
+        self.bundle = bundle
+        self.runtime_dir = runtime_dir
+        self.budget_bytes = budget_bytes
+        self.used_bytes = 0
+        # PNG asset name -> [last use, width, height, data]
+        self.entries = {}
+        # assets which don't have a pre-decoded sprite, so the filesystem isn't asked again
+        self.missing = set()
+        self.use_ctr = 0
+
+    def get(self, png_name):
+        """Returns (width, height, data) of the sprite converted from png_name, or None if there's no such sprite"""
+        self.use_ctr += 1
+        entry = self.entries.get(png_name)
+        if entry is not None:
+            entry[0] = self.use_ctr
+            return entry[1], entry[2], entry[3]
+        if png_name in self.missing:
+            return None
+
+        try:
+            (w, h, data) = self._load(png_name[:-4] + ".spr")
+        except (OSError, ValueError) as e:
+            self.log.debug("no sprite for %s: %s" % (png_name, e))
+            self.missing.add(png_name)
+            return None
+
+        self._make_room(len(data))
+        if len(data) <= self.budget_bytes:
+            self.entries[png_name] = [self.use_ctr, w, h, data]
+            self.used_bytes += len(data)
+        return w, h, data
+
+    def _load(self, spr_name):
+        if self.bundle is not None:
+            entry = self.bundle.find(spr_name)
+            if entry is None:
+                raise ValueError("not in bundle")
+            raw = self.bundle.read(entry)
+        else:
+            with open(self.runtime_dir + "/" + spr_name, "rb") as f:
+                raw = f.read()
+        (w, h) = struct.unpack_from(self.HEADER_FMT, raw)
+        if len(raw) != self.HEADER_SIZE + (w + 7) // 8 * h:
+            raise ValueError("truncated sprite")
+        return w, h, memoryview(raw)[self.HEADER_SIZE:]
+
+    def _make_room(self, size):
+        """Evict the least recently used sprites until size bytes fit into the budget"""
+        while self.entries and self.used_bytes + size > self.budget_bytes:
+            lru_name = None
+            lru_use = None
+            for name, entry in self.entries.items():
+                if lru_use is None or entry[0] < lru_use:
+                    lru_name = name
+                    lru_use = entry[0]
+            self.used_bytes -= len(self.entries.pop(lru_name)[3])
+
+    def draw(self, screen, x, y, png_name):
+        """Blits the sprite converted from png_name, returns False if there's no such sprite"""
+        sprite = self.get(png_name)
+        if sprite is None:
+            return False
+        (w, h, data) = sprite
+        screen.drawRaw(x, y, w, h, data)
+        return True
@@ -0,0 +1,320 @@
+import logging
+import math
+import struct
+import ujson
+import utime
+from . import seglog
+
+# utime counts seconds from 2000-01-01, telemetry timestamps are Unix time
+UNIX_EPOCH_OFFSET_S = 946684800
+# the RTC starts at 2000-01-01 after power-on, anything before this hasn't been set from NTP yet
+MIN_VALID_TIME_S = 694224000  # 2022-01-01
+
+# status flags of a record
+# taken before the clock was set from NTP, the time was corrected by the clock change, or is still the time since
+# boot (0 if that boot is over)
+FLAG_TIME_ESTIMATED = 0x01
+# the first record after the device started, the sequence numbers restart from here
+FLAG_BOOT = 0x02
+
+# statistics of the CO2 samples of a window that can be reported, bit i of a statistics mask stands for STATISTICS[i]
+STATISTICS = ("mean", "min", "max", "stddev", "count")
+
+
+def clock_is_set():
+    return utime.time() >= MIN_VALID_TIME_S
+
+
+def time_is_set(t):
+    """Returns whether the Unix time t of a record is real time, not the time since boot"""
+    return t >= MIN_VALID_TIME_S + UNIX_EPOCH_OFFSET_S
+
+
+def valid_statistics(statistics):
+    """Returns whether a comma separated list of statistics only names known ones, and at least one"""
+    names = [name.strip() for name in statistics.split(",")]
+    return all(name in STATISTICS for name in names)
+
+
+def statistics_mask(statistics):
+    """Returns the mask of the statistics in a comma separated list like "mean,min,max", the mean if there are none"""
+    mask = 0
+    for name in statistics.split(","):
+        name = name.strip()
+        if name in STATISTICS:
+            mask |= 1 << STATISTICS.index(name)
+        elif name:
+            logging.getLogger("telemetry").warning('unknown telemetry statistic "%s"' % name)
+    return mask or 1
+
+
+class TelemetryQueue:
+    """
+    Bounded queue of telemetry records waiting to be published, oldest first. The CO2 samples passed to add() are
+    aggregated over windows of window_s seconds: a record holds the mean, minimum, maximum, standard deviation and
+    number of the samples of a window and their mean temperature, and is kept until the MQTT client has sent it.
+    While they can't be sent, the queued records are spooled to a segment log at most every SPOOL_PERIOD_MS, so a WiFi
+    or broker outage (or a reboot during one) doesn't leave a gap in the published series. Once the queue holds
+    MAX_SPAN_S of records, the oldest are dropped.
+
+    Windows that start before the clock is set from NTP carry the time since boot and are moved to real time by
+    clock_set(). Those still unset after a reboot can't be placed anymore, their time is cleared to 0.
+    Every record has a sequence number, so the backend can tell records which were dropped from ones never taken.
+    """
+
+    # 12 hours of records, but no more than MAX_RECORDS
+    MAX_SPAN_S = 12 * 3600
+    MAX_RECORDS = 720
+    SPOOL_PERIOD_MS = 10 * 60 * 1000
+    # window start (Unix time), status flags, sequence number, mean temperature, CO2 ppm statistics in the order of
+    # STATISTICS
+    RECORD_FMT = "<IBHhHHHHH"
+    RECORD_SIZE = 19
+
+    def __init__(self, window_s=60, fn="telemetry.log"):
+        self.log = logging.getLogger("telemetry")
+        self.window_s = window_s
+        self.seglog = seglog.SegmentLog(fn, b"TLQ3")
+        self.records = bytearray()
+        # number of records at the start of the queue that are in the spool
+        self.spooled = 0
+        # set when records have been sent since the last spool write, the spool has to be rewritten
+        self.spool_stale = False
+        self.last_spool_ms = utime.ticks_ms()
+        # records are only spooled while they can't be sent
+        self.offline = True
+        self.next_seq = 0
+        self.next_flags = FLAG_BOOT
+        # the window being aggregated: its end, start time, flags and the running statistics of its samples
+        self.window_end_ms = None
+        self.window_start_s = 0
+        self.window_flags = 0
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.co2_min = 0
+        self.co2_max = 0
+        self.temperature_sum = 0
+        self._load()
+
+    def __len__(self):
+        return len(self.records) // self.RECORD_SIZE
+
+    def max_records(self):
+        return max(1, min(self.MAX_RECORDS, self.MAX_SPAN_S // self.window_s))
+
+    def add(self, co2, temperature):
+        """Adds a CO2 sample and the temperature to the current window, queueing a record for it once it's over"""
+        now = utime.ticks_ms()
+        if self.count and utime.ticks_diff(now, self.window_end_ms) >= 0:
+            self._close_window(now)
+        if not self.count:
+            if self.window_end_ms is None:
+                self.window_end_ms = utime.ticks_add(now, self.window_s * 1000)
+            self.window_start_s = utime.time() + UNIX_EPOCH_OFFSET_S
+            self.window_flags = self.next_flags | (0 if clock_is_set() else FLAG_TIME_ESTIMATED)
+            self.next_flags = 0
+            (self.mean, self.m2, self.co2_min, self.co2_max, self.temperature_sum) = (0.0, 0.0, co2, co2, 0)
+        # Welford's algorithm, single precision floats can't take a sum of squares
+        self.count += 1
+        delta = co2 - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (co2 - self.mean)
+        self.co2_min = min(self.co2_min, co2)
+        self.co2_max = max(self.co2_max, co2)
+        self.temperature_sum += temperature
+
+    def _close_window(self, now):
+        window_ms = self.window_s * 1000
+        # keep the cadence unless sampling stopped for a while
+        late_ms = utime.ticks_diff(now, self.window_end_ms)
+        self.window_end_ms = utime.ticks_add(now if late_ms >= window_ms else self.window_end_ms, window_ms)
+
+        while len(self) >= self.max_records():
+            self._drop(1)
+        self.records += struct.pack(self.RECORD_FMT, self.window_start_s, self.window_flags, self.next_seq,
+                                    round(self.temperature_sum / self.count), round(self.mean), self.co2_min,
+                                    self.co2_max, round(math.sqrt(self.m2 / self.count)), min(self.count, 0xffff))
+        self.next_seq = (self.next_seq + 1) & 0xffff
+        self.count = 0
+
+        if self.offline and utime.ticks_diff(now, self.last_spool_ms) >= self.SPOOL_PERIOD_MS:
+            self.spool()
+
+    def peek(self, n):
+        """
+        Yields the oldest n records as (Unix time in seconds, flags, sequence number, temperature, co2 mean, co2 min,
+        co2 max, co2 standard deviation, number of samples)
+        """
+        for off in range(0, min(n, len(self)) * self.RECORD_SIZE, self.RECORD_SIZE):
+            yield struct.unpack_from(self.RECORD_FMT, self.records, off)
+
+    def sent(self, last_seq):
+        """
+        Removes the records up to the one with sequence number last_seq once they have been published. Records are
+        taken by sequence number, the oldest may have been dropped while they were being sent.
+        """
+        for i in range(len(self)):
+            if struct.unpack_from("<H", self.records, i * self.RECORD_SIZE + 5)[0] == last_seq:
+                self._drop(i + 1)
+                break
+        self.offline = False
+        if not self.records and self.spool_stale:
+            self.spool()
+
+    def failed(self):
+        """Called when the queued records couldn't be sent, they are spooled until they can"""
+        if not self.offline:
+            self.offline = True
+            self.last_spool_ms = utime.ticks_ms()
+
+    def clock_set(self, delta_s):
+        """Moves the windows that started before the clock was set forward by delta_s, the size of the clock change"""
+        if self.count and not time_is_set(self.window_start_s):
+            self.window_start_s += delta_s
+        for off in range(0, len(self.records), self.RECORD_SIZE):
+            (t,) = struct.unpack_from("<I", self.records, off)
+            # records from before a reboot have no time since this boot
+            if t and not time_is_set(t):
+                struct.pack_into("<I", self.records, off, t + delta_s)
+        if self.spooled:
+            self.spool_stale = True
+
+    def _drop(self, n):
+        n = min(n, len(self))
+        self.records = self.records[n * self.RECORD_SIZE:]
+        if self.spooled:
+            self.spooled = max(0, self.spooled - n)
+            self.spool_stale = True
+
+    def spool(self):
+        """Writes the records that aren't in the spool yet, or rewrites it if sent records are still in it"""
+        self.last_spool_ms = utime.ticks_ms()
+        try:
+            if self.spool_stale or self.seglog.needs_compaction():
+                self.seglog.compact([self.records] if self.records else [])
+            elif len(self) > self.spooled:
+                self.seglog.append(self.records[self.spooled * self.RECORD_SIZE:])
+            self.spooled = len(self)
+            self.spool_stale = False
+        except OSError as e:
+            self.log.error("failed to spool telemetry: %s" % e)
+
+    def _load(self):
+        unset = 0
+        for payload in self.seglog.read_batches():
+            for off in range(0, len(payload) - self.RECORD_SIZE + 1, self.RECORD_SIZE):
+                record = payload[off:off + self.RECORD_SIZE]
+                (t,) = struct.unpack_from("<I", record)
+                if t and not time_is_set(t):
+                    record = struct.pack("<I", 0) + record[4:]
+                    unset += 1
+                self.records += record
+        excess = len(self) - self.max_records()
+        if excess > 0:
+            self.records = self.records[excess * self.RECORD_SIZE:]
+        self.spooled = len(self)
+        self.spool_stale = unset > 0 or excess > 0
+        if self.records:
+            # the sequence continues, so the backend doesn't take the records after the reboot for a restart
+            last = struct.unpack_from(self.RECORD_FMT, self.records, len(self.records) - self.RECORD_SIZE)
+            self.next_seq = (last[2] + 1) & 0xffff
+        if self.records:
+            self.log.info("%d spooled records loaded, %d without time" % (len(self), unset))
+
+
+class JsonEncoder:
+    """
+    ThingsBoard telemetry: [{"ts": <window start, Unix time in ms>, "values": {"co2": ..., "co2Min": ...,
+    "co2Max": ..., "co2Stddev": ..., "samples": ..., "temperature": ..., "flags": ..., "seq": ...}}, ...] with the
+    CO2 statistics selected by the mask, latest_values are added to the values of the newest record.
+
+    Records taken before the clock was set are published without "ts", one per message, so that ThingsBoard takes
+    the time they arrive. Their "uptime" is the window start in seconds since boot, unless they're from an earlier
+    boot.
+    """
+
+    TOPIC = "v1/devices/me/telemetry"
+    # the names of STATISTICS in the telemetry
+    KEYS = ("co2", "co2Min", "co2Max", "co2Stddev", "samples")
+
+    def __init__(self, statistics=1):
+        self.statistics = statistics
+
+    def messages(self, queue, n, latest_values):
+        """Yields (topic, payload) of the messages carrying the oldest n queued records"""
+        timed = []
+        untimed = []
+        for record in queue.peek(n):
+            values = ['"%s": %d' % (key, record[4 + i]) for i, key in enumerate(self.KEYS) if self.statistics & 1 << i]
+            values = '%s, "temperature": %d, "flags": %d, "seq": %d' % (", ".join(values), record[3], record[1],
+                                                                        record[2])
+            if time_is_set(record[0]):
+                timed.append('{"ts": %d000, "values": {%s}}' % (record[0], values))
+                newest = timed
+            else:
+                if record[0]:
+                    values += ', "uptime": %d' % (record[0] - UNIX_EPOCH_OFFSET_S)
+                untimed.append("{%s}" % values)
+                newest = untimed
+        if latest_values:
+            closing = "}}" if newest is timed else "}"
+            newest[-1] = newest[-1][:-len(closing)] + ", " + ujson.dumps(latest_values)[1:] + closing[1:]
+        if timed:
+            yield self.TOPIC, "[%s]" % ", ".join(timed)
+        for entry in untimed:
+            yield self.TOPIC, entry
+
+
+class BinaryEncoder:
+    """
+    Compact binary telemetry, little-endian:
+
+        "<BBBB"    format version (2), number of records, length of the firmware version, statistics mask (bit i
+                   set when STATISTICS[i] is included)
+                   firmware version (ASCII)
+        "<IBHh"    every record, oldest first: window start (Unix time in seconds, before 2022 if the clock wasn't
+                   set, see FLAG_TIME_ESTIMATED), status flags (FLAG_*), sequence number, mean temperature in °C
+        "<H"       followed by each included CO2 statistic in the order of STATISTICS
+
+    latest_values other than firmwareVersion don't fit the format and are published as JSON telemetry.
+    """
+
+    TOPIC = "v1/devices/me/telemetry/bin"
+    FORMAT_VERSION = 2
+
+    def __init__(self, statistics=1):
+        self.statistics = statistics
+        self.fields = [4 + i for i in range(len(STATISTICS)) if statistics & 1 << i]
+        self.record_fmt = "<IBHh" + "H" * len(self.fields)
+
+    def messages(self, queue, n, latest_values):
+        """Yields (topic, payload) of the messages carrying the oldest n queued records"""
+        n = min(n, len(queue), 255)
+        version = (latest_values or {}).get("firmwareVersion", "").encode()
+        payload = bytearray(struct.pack("<BBBB", self.FORMAT_VERSION, n, len(version), self.statistics))
+        payload += version
+        for record in queue.peek(n):
+            payload += struct.pack(self.record_fmt, record[0], record[1], record[2], record[3],
+                                   *[record[i] for i in self.fields])
+        yield self.TOPIC, payload
+        others = {k: v for k, v in (latest_values or {}).items() if k != "firmwareVersion"}
+        if others:
+            yield JsonEncoder.TOPIC, ujson.dumps(others)
+
+
+ENCODERS = {
+    "json": JsonEncoder,
+    "binary": BinaryEncoder,
+}
+
+
+def encoder(name, statistics="mean"):
+    """
+    Returns the encoder for the telemetryEncoding setting, JSON if it's unknown, reporting the statistics in the
+    telemetryStatistics setting
+    """
+    if name not in ENCODERS:
+        logging.getLogger("telemetry").warning('unknown telemetry encoding "%s", using JSON' % name)
+        name = "json"
+    return ENCODERS[name](statistics_mask(statistics))
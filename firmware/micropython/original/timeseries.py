@@ -0,0 +1,268 @@
+import logging
+import os
+import struct
+import utime
+from array import array
+from . import seglog
+
+
+class RingBuffer:
+    """Fixed-capacity circular buffer of signed 16-bit values
+
+    head is the slot the next value will be written to and count is the number of valid values, so appending never
+    moves the existing values around.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.buf = array('h', bytes(2 * capacity))
+        self.head = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        """Yields the stored values in chronological order (oldest first)"""
+        return self.iter_last(self.count)
+
+    def iter_last(self, n):
+        """Yields the n most recent values in chronological order"""
+        buf = self.buf
+        idx = self.head - n
+        if idx < 0:
+            idx += self.capacity
+        for _ in range(n):
+            yield buf[idx]
+            idx += 1
+            if idx == self.capacity:
+                idx = 0
+
+    def append(self, v):
+        """Store a value, overwriting the oldest one once the buffer is full"""
+        self.buf[self.head] = v
+        self.head += 1
+        if self.head == self.capacity:
+            self.head = 0
+        if self.count < self.capacity:
+            self.count += 1
+
+    def clear(self):
+        self.head = 0
+        self.count = 0
+
+
+class Tier:
+    """
+    A single resolution level of the time-series store. Each point holds the min/mean/max of all raw measurements
+    that fell into it. Points of the finer tier are rolled up into this tier every `factor` points.
+    """
+
+    def __init__(self, name, span_min, capacity, factor):
+        self.name = name
+        self.span_min = span_min
+        self.seconds_per_point = span_min * 60 / capacity
+        self.factor = factor
+        self.mins = RingBuffer(capacity)
+        self.means = RingBuffer(capacity)
+        self.maxs = RingBuffer(capacity)
+        # number of points that have not been persisted yet
+        self.unsaved = 0
+        # incremented on every new point, lets consumers cache data derived from the tier
+        self.version = 0
+        self._reset_acc()
+
+    def _reset_acc(self):
+        self.acc_min = 32767
+        self.acc_max = 0
+        self.acc_sum = 0
+        self.acc_n = 0
+        self.acc_points = 0
+
+    def accumulate(self, vmin, vsum, n, vmax):
+        if vmin < self.acc_min:
+            self.acc_min = vmin
+        if vmax > self.acc_max:
+            self.acc_max = vmax
+        self.acc_sum += vsum
+        self.acc_n += n
+        self.acc_points += 1
+
+    def flush(self):
+        """Close the current point and return its aggregate as (min, sum, n, max) for the next tier"""
+        agg = (self.acc_min, self.acc_sum, self.acc_n, self.acc_max)
+        self.append_point(self.acc_min, self.acc_sum // self.acc_n, self.acc_max)
+        if self.unsaved < self.means.capacity:
+            self.unsaved += 1
+        self._reset_acc()
+        return agg
+
+    def append_point(self, vmin, vmean, vmax):
+        self.mins.append(vmin)
+        self.means.append(vmean)
+        self.maxs.append(vmax)
+        self.version += 1
+
+    def iter_last(self, n):
+        """Yields the n most recent points as (min, mean, max) tuples"""
+        return zip(self.mins.iter_last(n), self.means.iter_last(n), self.maxs.iter_last(n))
+
+    def have_enough_data(self) -> bool:
+        return len(self.means) > 5
+
+
+class TimeSeriesStore:
+    """
+    Multi-resolution store for CO2 measurements. Every raw measurement is ingested once into the finest tier and the
+    closed points are cascaded into the coarser tiers, so adding a tier costs one more rollup per finer point instead
+    of one more copy of the whole measurement path.
+
+    Tier spans have to be integer multiples of each other, e.g. 15 min, 1 h, 12 h, 24 h.
+
+    The points are persisted in an append-only segment log, each save appends only the points closed since the
+    previous save as one batch of (tier index, min, mean, max) records.
+    """
+
+    SAVE_PERIOD_MS = 10 * 60 * 1000
+    RECORD_FMT = "<Bhhh"
+    RECORD_SIZE = 7
+
+    def __init__(self, tier_spec, capacity, fn="co2_history.log", load_data=True):
+        """tier_spec is a list of (name, span in minutes) tuples, ordered from the finest to the coarsest tier"""
+        self.log = logging.getLogger("timeseries")
+        self.tiers = []
+        prev_span = None
+        for name, span_min in tier_spec:
+            if prev_span is None:
+                factor = 0
+            elif span_min % prev_span:
+                raise ValueError("tier span %d min is not a multiple of %d min" % (span_min, prev_span))
+            else:
+                factor = span_min // prev_span
+            self.tiers.append(Tier(name, span_min, capacity, factor))
+            prev_span = span_min
+
+        # the tier layout is part of the magic, so that data of a different layout is never loaded
+        magic = b"TSL1" + struct.pack("<B%dH" % len(self.tiers), len(self.tiers), *[t.span_min for t in self.tiers])
+        self.seglog = seglog.SegmentLog(fn, magic)
+
+        self.bucket_ms = int(self.tiers[0].seconds_per_point * 1000)
+        self.bucket_start_ts = None
+        self.last_save_ts = None
+        if load_data:
+            self._load_data()
+
+    def tier(self, name):
+        for t in self.tiers:
+            if t.name == name:
+                return t
+        raise KeyError(name)
+
+    def add_measurement(self, m):
+        """Ingest a single raw measurement"""
+        now = utime.ticks_ms()
+        if self.bucket_start_ts is None:
+            self.bucket_start_ts = now
+            self.last_save_ts = now
+
+        self.tiers[0].accumulate(m, m, 1, m)
+
+        elapsed = utime.ticks_diff(now, self.bucket_start_ts)
+        if elapsed >= self.bucket_ms:
+            # keep the bucket cadence unless measurements stopped for a while
+            if elapsed < 2 * self.bucket_ms:
+                self.bucket_start_ts = utime.ticks_add(self.bucket_start_ts, self.bucket_ms)
+            else:
+                self.bucket_start_ts = now
+            self._rollup()
+
+        if utime.ticks_diff(now, self.last_save_ts) > self.SAVE_PERIOD_MS:
+            self._save_data()
+            self.last_save_ts = now
+
+    def _rollup(self):
+        agg = self.tiers[0].flush()
+        for t in self.tiers[1:]:
+            t.accumulate(*agg)
+            if t.acc_points < t.factor:
+                break
+            agg = t.flush()
+
+    def _load_data(self):
+        """Replay the persisted points from the segment log"""
+        self.log.info("loading history from %s" % self.seglog.fn)
+        try:
+            for payload in self.seglog.read_batches():
+                for off in range(0, len(payload), self.RECORD_SIZE):
+                    (tier_idx, vmin, vmean, vmax) = struct.unpack_from(self.RECORD_FMT, payload, off)
+                    self.tiers[tier_idx].append_point(vmin, vmean, vmax)
+        except Exception as e:
+            self.log.warning("failed to read history: %s" % e)
+            self.seglog.damaged = True
+            for t in self.tiers:
+                for rb in (t.mins, t.means, t.maxs):
+                    rb.clear()
+        for t in self.tiers:
+            self.log.info("%s: %d points loaded" % (t.name, len(t.means)))
+
+        self._migrate_plot_files()
+        # data files written by older firmware versions are not used anymore
+        for fn in os.listdir():
+            if fn.endswith(".bin") and (fn.startswith("plot_") or fn.startswith("co2_history")):
+                os.remove(fn)
+
+    def _migrate_plot_files(self):
+        """
+        Imports the plot_<span>.bin files of firmware versions before this store into the tiers of the same span,
+        if they are still empty. Those only kept the mean of each point, it's used as the min and max too.
+        """
+        migrated = 0
+        for t in self.tiers:
+            fn = "plot_%d.bin" % t.span_min
+            try:
+                with open(fn, "rb") as f:
+                    data = f.read()
+            except OSError:
+                continue
+            if len(t.means):
+                continue
+            # the point count, then the points oldest first
+            count = struct.unpack_from("h", data)[0] if len(data) >= 2 else -1
+            if not 0 <= count <= (len(data) - 2) // 2:
+                self.log.warning("%s is corrupted, not imported" % fn)
+                continue
+            points = array('h', data[2:2 + 2 * count])
+            for v in points[max(0, count - t.means.capacity):]:
+                t.append_point(v, v, v)
+            t.unsaved = len(t.means)
+            migrated += len(t.means)
+        if migrated:
+            self.log.info("%d points imported from older plot files" % migrated)
+            # written right away, the old files are removed next
+            self._save_data()
+
+    def _pack_points(self, counts):
+        """Pack the given number of most recent points of each tier into a single batch payload"""
+        payload = bytearray(self.RECORD_SIZE * sum(counts))
+        off = 0
+        for tier_idx, t in enumerate(self.tiers):
+            for (vmin, vmean, vmax) in t.iter_last(counts[tier_idx]):
+                struct.pack_into(self.RECORD_FMT, payload, off, tier_idx, vmin, vmean, vmax)
+                off += self.RECORD_SIZE
+        return payload
+
+    def _save_data(self):
+        """
+        Save data to filesystem. Only the new points are appended to the log, unless it has grown too large or
+        has a damaged tail, in which case the whole state is written into a fresh log
+        """
+        if self.seglog.needs_compaction():
+            self.log.info("compacting history log %s" % self.seglog.fn)
+            self.seglog.compact([self._pack_points([len(t.means) for t in self.tiers])])
+        else:
+            counts = [t.unsaved for t in self.tiers]
+            if sum(counts):
+                self.log.info("appending %d points to %s" % (sum(counts), self.seglog.fn))
+                self.seglog.append(self._pack_points(counts))
+        for t in self.tiers:
+            t.unsaved = 0
@@ -1,10 +1,13 @@
 import uasyncio
+from array import array
 from machine import Signal, PWM, unique_id
 from utime import ticks_ms
 import logging
 import machine
 import math
+import micropython
 import random
+import utime
 
 # For AirGuardIotMQTTClient
 from umqtt.simple import MQTTClient
@@ -103,70 +106,110 @@ async def pagaidit(v):
     await uasyncio.sleep(v)
 
 
-class ButtonEventHandler:
-    """"""
-    signal = None
-    DEBOUNCE_TIME_MS = 10
-    LONG_PRESS_TIME_MS = 5000
-    posedge_debounce_time = 0
-    posedge_state = False
-    negedge_state = False
-    negedge_debounce_time = 0
-    negedge_on_latched = False
-    longpress_start_time = 0
-    longpress_on_latched = False
-    longpress_state = False
-
-    def __init__(self, signal):
-        self.signal = signal
-        self.log = logging.getLogger("btn")
-
-    def posedge(self):
-        """Returns True for one invocation after positive edge has been detected"""
-        on = self.signal.value()
-        if on and not self.posedge_state:
-            self.posedge_state = True
-            self.posedge_debounce_time = ticks_ms()
-            return True
-        elif not on and self.posedge_state and (ticks_ms() - self.posedge_debounce_time) > self.DEBOUNCE_TIME_MS:
-            self.posedge_state = False
-
-        return False
-
-    def negedge(self):
-        """Returns True for one invocation after negative edge has been detected"""
-        on = self.signal.value()
-
-        if on and not self.negedge_on_latched:
-            self.negedge_debounce_time = ticks_ms()
-            self.negedge_on_latched = True
-            self.negedge_state = False
-
-        if not on and self.negedge_on_latched and (ticks_ms() - self.negedge_debounce_time) > self.DEBOUNCE_TIME_MS:
-            self.negedge_on_latched = False
-            if not self.negedge_state:
-                self.negedge_state = True
-                return True
+class ButtonService:
+    """
+    Interrupt-driven button handling. Edges are timestamped by a pin IRQ and queued in a small ring buffer, the
+    consumer turns them into events with poll(), so the button doesn't have to be sampled on every frame.
 
-        return False
+    The queue has a single producer (the scheduled IRQ callback) and a single consumer (poll()), so it doesn't need
+    any locking. `flag` is set on every edge, so that a sleeping task can wait for input.
+    """
+    PRESS = 1
+    RELEASE = 2
+    LONGPRESS = 3
 
-    def longpress(self):
-        """Returns True for one invocation after a long press has been detected"""
-        on = self.signal.value()
-        if on and not self.longpress_on_latched:
-            self.longpress_on_latched = True
-            self.longpress_state = False
-            self.longpress_start_time = ticks_ms()
-
-        elif on and self.longpress_on_latched and (ticks_ms() - self.longpress_start_time) > self.LONG_PRESS_TIME_MS:
-            if not self.longpress_state:
-                self.longpress_state = True
-                return True
-        elif not on and (ticks_ms() - self.longpress_start_time) > self.DEBOUNCE_TIME_MS:
-            self.longpress_on_latched = False
-            self.longpress_state = False
+    LONG_PRESS_TIME_MS = 5000
+    QUEUE_SIZE = 16
+    # edges this soon after the previous one are contact bounce
+    DEBOUNCE_MS = 10
 
-        return False
+    def __init__(self, pin, invert=True):
+        self.pin = pin
+        self.invert = invert
+        self.log = logging.getLogger("btn")
+        self.flag = uasyncio.ThreadSafeFlag()
+
+        self._edge_ts = array('i', [0] * self.QUEUE_SIZE)
+        self._edge_state = bytearray(self.QUEUE_SIZE)
+        self._wr = 0
+        self._rd = 0
+        self._last_state = self.value()
+        self._last_edge_ts = utime.ticks_add(ticks_ms(), -self.DEBOUNCE_MS)
+        # set while an edge is scheduled, a bouncing contact must not fill MicroPython's schedule queue
+        self._edge_pending = False
+
+        self.pressed = False
+        self._press_ts = 0
+        self._longpress_fired = False
+
+        # bound methods allocate, so create the reference once instead of inside the hard IRQ handler
+        self._on_edge_ref = self._on_edge
+        pin.irq(handler=self._irq, trigger=machine.Pin.IRQ_RISING | machine.Pin.IRQ_FALLING, hard=True)
+
+    def value(self):
+        return self.pin.value() != self.invert
+
+    def _irq(self, _):
+        if self._edge_pending:
+            return
+        try:
+            micropython.schedule(self._on_edge_ref, ticks_ms())
+            self._edge_pending = True
+        except RuntimeError:
+            # schedule queue full, the edge is dropped
+            pass
+
+    def _on_edge(self, ts):
+        self._edge_pending = False
+        if utime.ticks_diff(ts, self._last_edge_ts) < self.DEBOUNCE_MS:
+            return
+        # read the state only now, by the time the callback runs the contacts have mostly stopped bouncing
+        state = self.value()
+        if state == self._last_state:
+            return
+        self._last_edge_ts = ts
+        self._last_state = state
+        nxt = (self._wr + 1) % self.QUEUE_SIZE
+        if nxt == self._rd:
+            self.log.warning("button queue full, dropping edge")
+            return
+        self._edge_ts[self._wr] = ts
+        self._edge_state[self._wr] = state
+        self._wr = nxt
+        self.flag.set()
+
+    def longpress_deadline(self):
+        """Returns the ticks_ms at which the current press becomes a long press, or None"""
+        if self.pressed and not self._longpress_fired:
+            return utime.ticks_add(self._press_ts, self.LONG_PRESS_TIME_MS)
+        return None
+
+    def poll(self):
+        """
+        Returns the next button event or None. RELEASE is only reported for short presses, a press held for
+        LONG_PRESS_TIME_MS is reported as LONGPRESS while the button is still held
+        """
+        while self._rd != self._wr:
+            ts = self._edge_ts[self._rd]
+            state = self._edge_state[self._rd]
+            self._rd = (self._rd + 1) % self.QUEUE_SIZE
+            if state:
+                self.pressed = True
+                self._press_ts = ts
+                self._longpress_fired = False
+                return self.PRESS
+
+            self.pressed = False
+            if not self._longpress_fired:
+                if utime.ticks_diff(ts, self._press_ts) >= self.LONG_PRESS_TIME_MS:
+                    return self.LONGPRESS
+                return self.RELEASE
+
+        if self.pressed and not self._longpress_fired and \
+                utime.ticks_diff(ticks_ms(), self._press_ts) >= self.LONG_PRESS_TIME_MS:
+            self._longpress_fired = True
+            return self.LONGPRESS
+        return None
 
 
 # fade in/out animation max brightness
@@ -0,0 +1,97 @@
+import logging
+import random
+
+import ujson
+from utime import ticks_ms, ticks_add, ticks_diff
+
+import http_utils
+
+log = logging.getLogger("versioncheck")
+
+
+class VersionChecker:
+    """
+    Periodically fetches the latest release tag with conditional requests. The last response is kept in RECORD_FILE
+    together with its ETag/Last-Modified, so after a reboot the device knows the latest version right away and the
+    server can answer "304 Not Modified". The periodic checks are spread out with random jitter, so a fleet powered on at
+    the same time doesn't check at the same minute, and failures back off exponentially.
+    """
+
+    RECORD_FILE = "_latest_release"
+
+    CHECK_PERIOD_MS = 60 * 60 * 1000  # once an hour
+    CHECK_JITTER_MS = 10 * 60 * 1000
+    # first check after boot happens within this time
+    FIRST_CHECK_MAX_DELAY_MS = 5 * 60 * 1000
+    RETRY_MIN_MS = 60 * 1000
+
+    def __init__(self, url):
+        self.url = url
+        self.record = self._load_record()
+        self.failures = 0
+        self.next_check_ticks_ms = ticks_add(ticks_ms(), random.randint(0, self.FIRST_CHECK_MAX_DELAY_MS))
+
+    def _load_record(self):
+        try:
+            with open(self.RECORD_FILE) as f:
+                record = ujson.load(f)
+            if record.get("url") == self.url:
+                return record
+        except (OSError, ValueError):
+            pass
+        return {}
+
+    def _save_record(self):
+        try:
+            with open(self.RECORD_FILE, "w") as f:
+                ujson.dump(self.record, f)
+        except OSError as e:
+            log.error("could not save %s: %s" % (self.RECORD_FILE, e))
+
+    @property
+    def latest_version(self):
+        """Latest release tag from the last successful check, possibly before a reboot, or None"""
+        return self.record.get("version")
+
+    def is_due(self):
+        return ticks_diff(ticks_ms(), self.next_check_ticks_ms) >= 0
+
+    def _schedule(self, delay_ms):
+        self.next_check_ticks_ms = ticks_add(ticks_ms(), delay_ms)
+        return delay_ms
+
+    async def check(self):
+        """Fetches the latest release tag, returns it or raises if the check failed"""
+        headers = {}
+        if "etag" in self.record:
+            headers["If-None-Match"] = self.record["etag"]
+        if "lastModified" in self.record:
+            headers["If-Modified-Since"] = self.record["lastModified"]
+
+        try:
+            response = await http_utils.get(self.url, headers=headers)
+            try:
+                if response.status == 304 and self.latest_version:
+                    log.debug("latest release not modified")
+                else:
+                    line = (await response.read(64)).splitlines()[0]
+                    self.record = {
+                        "url": self.url,
+                        "version": line.decode("latin1").rstrip(),
+                    }
+                    if "etag" in response.headers:
+                        self.record["etag"] = response.headers["etag"]
+                    if "last-modified" in response.headers:
+                        self.record["lastModified"] = response.headers["last-modified"]
+                    self._save_record()
+            finally:
+                await response.close()
+        except Exception:
+            self.failures += 1
+            delay_ms = self._schedule(min(self.RETRY_MIN_MS << min(self.failures - 1, 10), self.CHECK_PERIOD_MS))
+            log.info("version check failed %d time(s), retrying in %d s" % (self.failures, delay_ms // 1000))
+            raise
+
+        self.failures = 0
+        self._schedule(self.CHECK_PERIOD_MS + random.randint(0, self.CHECK_JITTER_MS))
+        return self.latest_version
@@ -4,28 +4,116 @@ import network
 import sys
 
 import os
+import ubinascii
 import uerrno
-import ujson
+import uhashlib
 import usocket
 import ussl
 import utarfile
 import utime
+import uzlib
 import machine
 import ota_utils
 import http_utils
+import json_stream
 import display
 
-class NotFoundError(Exception):
-    pass
+
+class TarStream:
+    """
+    Stream for utarfile which raises instead of returning less than asked for. utarfile takes the end of the stream
+    for the end of the archive and a short read for a shorter file, but a tar archive only ends after its
+    end-of-archive blocks, so either means the download was cut off.
+    """
+
+    def __init__(self, f):
+        self.f = f
+
+    def readinto(self, buf, n=None):
+        n = len(buf) if n is None else n
+        if self.f.readinto(buf, n) != n:
+            raise OSError(uerrno.ECONNRESET)
+        return n
+
+    def read(self, n):
+        buf = bytearray(n)
+        self.readinto(buf)
+        return buf
+
+
+class PackageStream:
+    """The uncompressed package from offset on as a stream for utarfile, read with OTA.package_readinto()"""
+
+    def __init__(self, ota, offset):
+        self.ota = ota
+        self.offset = offset
+
+    def readinto(self, buf, n=None):
+        n = len(buf) if n is None else n
+        mv = memoryview(buf)
+        done = 0
+        while done < n:
+            done += self.ota.package_readinto(self.offset + done, mv[done:], n - done)
+        self.offset += done
+        return done
+
+    def read(self, n):
+        buf = bytearray(n)
+        self.readinto(buf)
+        return buf
 
 
 class OTA:
+    # release packages, the compressed one is preferred when a release has both
+    PACKAGE_ASSETS = ("micropython.tar.gz", "micropython.tar")
+    # window size (log2) micropython.tar.gz is compressed with, see tools/flasher/compress-package.py. The decompressor
+    # allocates a buffer of this size, so it must be the same or larger than the one used for compression.
+    GZIP_WINDOW_BITS = 12
+    FILE_BUFFER_SIZE = 4096
+
+    # delta updates: per-file hashes and package offsets, see tools/flasher/make-manifest.py
+    MANIFEST_ASSET = "manifest.json"
+    MANIFEST_FILE = "_ota_manifest"
+    # changed files still to download as "offset size sha256 path" lines, in package order
+    FETCH_FILE = "_ota_fetch"
+    # the inactive slot: the new version is put together here and renamed once complete and verified. It is kept
+    # when an update fails, so the next attempt only downloads what is still missing.
+    STAGING_DIR = "_ota_staging"
+
+    # offset in the uncompressed package up to which a full download has been extracted, so a download interrupted by
+    # a reboot resumes there with a range request
+    CHECKPOINT_FILE = "_ota_checkpoint"
+    # checkpoints are written at most this often, they cost a flash write each
+    CHECKPOINT_INTERVAL = 32 * 1024
+    # reconnects with range requests after network errors, with a growing pause and a WiFi reconnect in between
+    DOWNLOAD_RETRIES = 5
+    RETRY_DELAY_MS = 2000
+    # a changed file this close after the previous one is read from the same range request instead of a new one
+    MAX_RANGE_GAP = 16 * 1024
+
+    # release sources: GitHub, and LAN mirrors (tools/ota-mirror) which serve the same releases list with asset URLs
+    # pointing to themselves, so a school's devices don't each download the update over its uplink. A mirror is only
+    # used when configured (OTA_MIRROR_URL): the firmware is installed from it as served, so it must be trusted.
+    GITHUB_API_URL = "https://api.github.com"
+    RELEASES_PATH = "/repos/open-lv/air-guard/releases"
+
     def __init__(self):
-        self.file_buf = bytearray(512)
+        self.file_buf = bytearray(self.FILE_BUFFER_SIZE)
+        self.file_buf_mv = memoryview(self.file_buf)
         self.debug = True
         self.warn_ussl = True
-        self.gzdict_sz = 16 + 15
+        # +16 selects the gzip container
+        self.gzdict_sz = 16 + self.GZIP_WINDOW_BITS
         self.ota_started_time = None
+        self.update_name = None
+        self.progress_percent = None
+        # connection reading the uncompressed package and its position, see package_readinto()
+        self.package_url = None
+        self.package_f = None
+        self.package_pos = 0
+        # offset in the uncompressed package up to which a full download has been extracted, and the checkpoint
+        self.extracted_offset = 0
+        self.checkpoint_offset = 0
 
     def is_ota_in_progress(self):
         try:
@@ -70,21 +158,43 @@ class OTA:
         x = (display.width() - display.getTextWidth(text)) // 2
         display.drawText(x, y, text)
 
-    def display_update_info(self, name):
+    def display_update_info(self, name, percent=None):
         display.drawFill(0)
         self.draw_hcenter_text(10, "Ielade")
         self.draw_hcenter_text(25, "atjauninajumu...")
         self.draw_hcenter_text(45, "versija: " + name)
+        if percent is not None:
+            display.drawRect(14, 58, 100, 5, False, 0xffffff)
+            display.drawRect(14, 58, percent, 5, True, 0xffffff)
         display.flush()
 
-    def perform_update(self, name):
+    def report_progress(self, done, total):
+        """Shows the download progress on the display and logs every 10%"""
+        if not total:
+            return
+        percent = min(100, done * 100 // total)
+        previous = self.progress_percent
+        if percent == previous:
+            return
+        self.progress_percent = percent
+        self.display_update_info(self.update_name, percent)
+        if previous is None or percent // 10 != previous // 10:
+            self._log("Downloaded %d%% (%d of %d bytes)" % (percent, done, total))
+
+    def perform_update(self, name, active_version=ota_utils.ORIGINAL):
+        """
+        Installs release "micropython-<name>". active_version, the version running before the update, isn't touched
+        until the new version is complete and verified, and is booted again if the update fails or the new version
+        doesn't confirm itself (see ota_utils.check_trial()).
+        """
         self.clear_log_file()
+        self.update_name = name
         self.display_update_info(name)
         try:
             self.ota_started_time = utime.ticks_ms()
             if self.is_ota_in_progress():
                 self._log("OTA already in progress, resetting state")
-                ota_utils.restore_original()
+                ota_utils.activate(active_version)
                 return self.reset_ota_state(ota_utils.STATUS_CANCELLED)
 
             self._log('Starting OTA update: "%s"' % name)
@@ -100,60 +210,365 @@ class OTA:
 
             gc.collect()
 
-            release = self.select_release(name)
+            for release in self.find_releases(name):
+                try:
+                    self.install(release, active_version)
+                    break
+                except Exception as e:
+                    # what is already staged or checkpointed is reused by the next source, the packages are the same
+                    self._log("Installing from %s failed" % release["source"])
+                    self._log_exception(e)
+                    self.close_package()
+            else:
+                raise Exception('Error installing release "%s"' % name)
 
             dir_name = release["name"].replace(".", "_").replace("-", "_")
-
-            ota_utils.remove_all_versions()
-
-            self.download_and_install(dir_name, release["asset_url"])
-
-            with open("main.py", "w") as f:
-                f.write("import %s.main\n" % dir_name)
-                f.write("%s.main.run()\n" % dir_name)
-
+            self.activate(dir_name, active_version)
+            self._remove(self.CHECKPOINT_FILE)
             self.reset_ota_state(ota_utils.STATUS_FINISHED)
             self._log('OTA update completed successfully in %d seconds: "%s" "%s"' % (
                 (utime.ticks_ms() - self.ota_started_time) / 1000, name, release["asset_url"]))
         except Exception as e:
             self._log('Error performing OTA update: "%s"' % name)
             self._log_exception(e)
-            ota_utils.restore_original()
+            ota_utils.activate(active_version)
             self.reset_ota_state(ota_utils.STATUS_FAILED)
         finally:
+            self.close_package()
+            self._remove(self.MANIFEST_FILE)
+            self._remove(self.FETCH_FILE)
             print("Resetting device")
             machine.reset()
 
-    def get_releases(self):
-        releases = ujson.load(http_utils.open_url("https://api.github.com/repos/open-lv/air-guard/releases"))
-        micropython_releases = []
-        for release in releases:
-            if not release["tag_name"].startswith("micropython-"):
-                continue
-            for asset in release["assets"]:
-                if not asset["name"] == "micropython.tar":
-                    continue
-                micropython_releases.append({"name": release["tag_name"], "asset_url": asset["browser_download_url"]})
-                break
+    def install(self, release, active_version):
+        """Stages release in STAGING_DIR, only downloading what changed if the release has a delta manifest"""
+        if release["manifest_url"]:
+            self._download(release["manifest_url"], self.MANIFEST_FILE)
+        if not (release["manifest_url"] and release["package_url"]
+                and self.delta_install(release, active_version)):
+            self.download_and_install(release)
+            if release["manifest_url"]:
+                self.verify_staging()
+
+    def release_sources(self):
+        """Returns the base URLs of the releases lists to look in, the configured LAN mirror first"""
+        import config
+        mirror = config.sargsConfig.OTA_MIRROR_URL
+        if mirror:
+            return [mirror.rstrip("/"), self.GITHUB_API_URL]
+        return [self.GITHUB_API_URL]
+
+    def find_releases(self, name):
+        """
+        Yields release "micropython-<name>" from each source that has it, in the order of release_sources(). A source
+        is only asked once the previous one didn't work out.
+        """
+        full_version_name = "micropython-" + name
+        for source in self.release_sources():
+            found = None
+            try:
+                for release in self.get_releases(source):
+                    if release["name"] == full_version_name:
+                        found = release
+                        break
+                else:
+                    self._log('Release "%s" not found at %s' % (full_version_name, source))
+            except Exception as e:
+                self._log("Failed to list the releases at " + source)
+                self._log_exception(e)
+            gc.collect()
+            if found:
+                yield found
+
+    def get_releases(self, source=GITHUB_API_URL):
+        """
+        Returns the MicroPython releases listed at source as {"name", "source", "asset_url", "package_url",
+        "package_size", "manifest_url"}: the package to install (compressed if available), the uncompressed package
+        with its size and the delta manifest, the last three may be None.
+        The response lists every release with its notes and grows with each one, so it is streamed and only the tag and
+        asset URLs of each release are kept.
+        """
+        f = http_utils.open_url(source + self.RELEASES_PATH)
+        try:
+            tokens = json_stream.Tokenizer(f)
+            micropython_releases = []
+            for _ in tokens.array():
+                tag_name = None
+                urls = {}
+                sizes = {}
+                for key in tokens.object():
+                    if key == "tag_name":
+                        tag_name = tokens.value()
+                    elif key == "assets":
+                        for _ in tokens.array():
+                            name = None
+                            url = None
+                            size = None
+                            for asset_key in tokens.object():
+                                if asset_key == "name":
+                                    name = tokens.value()
+                                elif asset_key == "browser_download_url":
+                                    url = tokens.value()
+                                elif asset_key == "size":
+                                    size = tokens.value()
+                                else:
+                                    tokens.skip()
+                            if (name in self.PACKAGE_ASSETS or name == self.MANIFEST_ASSET) and url:
+                                urls[name] = url
+                                sizes[name] = size
+                    else:
+                        tokens.skip()
+                asset_url = urls.get(self.PACKAGE_ASSETS[0]) or urls.get(self.PACKAGE_ASSETS[1])
+                if tag_name and tag_name.startswith("micropython-") and asset_url:
+                    micropython_releases.append({
+                        "name": tag_name,
+                        "source": source,
+                        "asset_url": asset_url,
+                        "package_url": urls.get(self.PACKAGE_ASSETS[1]),
+                        "package_size": sizes.get(self.PACKAGE_ASSETS[1]),
+                        "manifest_url": urls.get(self.MANIFEST_ASSET),
+                    })
+        finally:
+            f.close()
 
         return micropython_releases
 
-    def select_release(self, name):
-        full_version_name = "micropython-" + name
-        for release in self.get_releases():
-            if release["name"] == full_version_name:
-                return release
-        raise Exception('Error retrieving release "%s"' % name)
-
-    def download_and_install(self, name, tar_url):
+    def download_and_install(self, release):
+        """
+        Downloads and extracts the whole package into STAGING_DIR, the compressed one if the release has it. Progress
+        is checkpointed at tar member boundaries: when the download is interrupted it continues from the last one with
+        range requests into the uncompressed package, right away or after a reboot.
+        """
+        self.package_url = release["package_url"]
+        offset = self._load_checkpoint(release)
+        if offset:
+            self._log("Resuming download at %d bytes" % offset)
+            self.install_tar(PackageStream(self, offset), offset, release)
+            return
+
+        self._remove(self.STAGING_DIR)
+        tar_url = release["asset_url"]
         f1 = http_utils.open_url(tar_url)
+        f2 = None
         try:
-            f2 = utarfile.TarFile(fileobj=f1)
-            self.install_tar(f2, name + "/")
+            if tar_url.endswith(".gz"):
+                f2 = TarStream(uzlib.DecompIO(f1, self.gzdict_sz))
+            else:
+                f2 = TarStream(f1)
+            self.install_tar(f2, 0, release)
+            return
+        except Exception as e:
+            if not self.package_url:
+                raise
+            self._log("Download interrupted (%s), resuming at %d bytes" % (e, self.extracted_offset))
         finally:
+            # the connection and the decompressor's window are freed before resuming
             f1.close()
-        del f2
-        gc.collect()
+            f2 = None
+            gc.collect()
+        self.install_tar(PackageStream(self, self.extracted_offset), self.extracted_offset, release)
+
+    def _load_checkpoint(self, release):
+        if not self.package_url:
+            return 0
+        try:
+            with open(self.CHECKPOINT_FILE) as f:
+                (name, offset) = f.read().split()
+            if name == release["name"]:
+                return int(offset)
+        except (OSError, ValueError):
+            pass
+        return 0
+
+    def _save_checkpoint(self, release, offset):
+        with open(self.CHECKPOINT_FILE, "w") as f:
+            f.write("%s %d" % (release["name"], offset))
+
+    def package_readinto(self, offset, buf, n):
+        """
+        Reads up to n bytes of the uncompressed package at offset into buf. The open connection is reused when offset
+        is at or a little ahead of its position, otherwise, and after network errors, a range request is made.
+        """
+        attempt = 0
+        while True:
+            try:
+                if self.package_f is None or offset < self.package_pos or offset - self.package_pos > self.MAX_RANGE_GAP:
+                    self.close_package()
+                    self.package_f = http_utils.open_url(self.package_url, headers={"Range": "bytes=%d-" % offset})
+                    self.package_pos = offset
+                while self.package_pos < offset:
+                    sz = self.package_f.readinto(self.file_buf, min(offset - self.package_pos, self.FILE_BUFFER_SIZE))
+                    if not sz:
+                        raise OSError(uerrno.ECONNRESET)
+                    self.package_pos += sz
+                sz = self.package_f.readinto(buf, n)
+                if not sz:
+                    raise OSError(uerrno.ECONNRESET)
+                self.package_pos += sz
+                return sz
+            except Exception as e:
+                self.close_package()
+                attempt += 1
+                if attempt > self.DOWNLOAD_RETRIES:
+                    raise
+                self._log("Download interrupted (%s), retrying at %d bytes" % (e, offset))
+                self._wait_for_network(attempt)
+
+    def close_package(self):
+        if self.package_f:
+            self.package_f.close()
+            self.package_f = None
+
+    def _wait_for_network(self, attempt):
+        utime.sleep_ms(self.RETRY_DELAY_MS * attempt)
+        if not network.WLAN(network.STA_IF).isconnected():
+            self.connect_to_network()
+
+    def activate(self, name, active_version):
+        """Turns the staged version into version directory name and boots it next, on trial"""
+        previous = active_version if active_version != name else ota_utils.ORIGINAL
+        self._remove(name)
+        os.rename(self.STAGING_DIR, name)
+        ota_utils.remove_all_versions(keep=(name, previous))
+        if ota_utils.confirms_itself(name):
+            ota_utils.activate_on_trial(name, previous)
+        else:
+            # e.g. a downgrade from the portal, the version would be rolled back after MAX_TRIAL_BOOTS boots
+            self._log("%s doesn't confirm itself, activated without a trial" % name)
+            ota_utils.activate(name)
+
+    def delta_install(self, release, active_version):
+        """
+        Stages only what changed: files listed in MANIFEST_FILE with the same size and SHA-256 as a file already
+        staged or installed are reused, the others are downloaded with range requests into the uncompressed package.
+        Returns False if the package has to be downloaded whole, network errors are raised.
+        """
+        self.package_url = release["package_url"]
+        try:
+            (reused, fetched, fetch_bytes) = self._reuse_unchanged(active_version)
+            self._fetch_changed(fetch_bytes)
+            self._log("Delta update: %d files reused, %d files (%d bytes) downloaded" % (reused, fetched, fetch_bytes))
+            return True
+        except ValueError as e:
+            self._log("Delta update failed, downloading the whole package")
+            self._log_exception(e)
+            return False
+
+    def _manifest_entries(self):
+        """Yields (path, size, offset, sha256) of every file in MANIFEST_FILE"""
+        with open(self.MANIFEST_FILE, "rb") as f:
+            tokens = json_stream.Tokenizer(f)
+            for key in tokens.object():
+                if key != "files":
+                    tokens.skip()
+                    continue
+                for _ in tokens.array():
+                    yield [tokens.value() for _ in tokens.array()]
+
+    def verify_staging(self):
+        for (path, size, _, sha256) in self._manifest_entries():
+            if self._sha256(self.STAGING_DIR + "/" + path) != sha256:
+                raise ValueError("SHA-256 mismatch: " + path)
+
+    def _reuse_unchanged(self, active_version):
+        """
+        Puts unchanged files into STAGING_DIR and lists the others in FETCH_FILE, returns the counts of both and the
+        number of bytes to download
+        """
+        # the staging directory of an interrupted update comes first, then the installed versions
+        sources = [self.STAGING_DIR, active_version]
+        for d in os.listdir():
+            if d.startswith("micropython_") and d not in sources:
+                sources.append(d)
+        if ota_utils.ORIGINAL not in sources:
+            sources.append(ota_utils.ORIGINAL)
+        reused = 0
+        fetched = 0
+        fetch_bytes = 0
+        with open(self.FETCH_FILE, "w") as fetch:
+            for (path, size, offset, sha256) in self._manifest_entries():
+                if self._reuse(sources, path, size, sha256, active_version):
+                    reused += 1
+                else:
+                    fetch.write("%d %d %s %s\n" % (offset, size, sha256, path))
+                    fetched += 1
+                    fetch_bytes += size
+        return reused, fetched, fetch_bytes
+
+    def _reuse(self, sources, path, size, sha256, active_version):
+        dst = self.STAGING_DIR + "/" + path
+        for src_dir in sources:
+            src = src_dir + "/" + path
+            try:
+                if os.stat(src)[6] != size:
+                    continue
+            except OSError:
+                continue
+            if self._sha256(src) != sha256:
+                continue
+            if src_dir == self.STAGING_DIR:
+                return True
+            self._makedirs(dst)
+            if src_dir in (active_version, ota_utils.ORIGINAL):
+                # the fallback versions must stay intact
+                with open(src, "rb") as f:
+                    self.save_file(dst, f)
+            else:
+                # older versions are removed once the new one is activated
+                os.rename(src, dst)
+            return True
+        return False
+
+    def _fetch_changed(self, total):
+        """Downloads the files listed in FETCH_FILE into STAGING_DIR"""
+        done = 0
+        with open(self.FETCH_FILE) as fetch:
+            while True:
+                line = fetch.readline()
+                if not line:
+                    break
+                (offset, size, sha256, path) = line.rstrip("\n").split(" ", 3)
+                offset = int(offset)
+                size = int(size)
+                if self.debug:
+                    self._log("Downloading " + path)
+                fname = self.STAGING_DIR + "/" + path
+                self._makedirs(fname)
+                h = uhashlib.sha256()
+                with open(fname, "wb") as outf:
+                    end = offset + size
+                    while offset < end:
+                        sz = self.package_readinto(offset, self.file_buf, min(end - offset, self.FILE_BUFFER_SIZE))
+                        h.update(self.file_buf_mv[:sz])
+                        outf.write(self.file_buf_mv[:sz])
+                        offset += sz
+                        done += sz
+                        self.report_progress(done, total)
+                if ubinascii.hexlify(h.digest()).decode() != sha256:
+                    raise ValueError("SHA-256 mismatch: " + fname)
+
+    def _sha256(self, fname):
+        h = uhashlib.sha256()
+        with open(fname, "rb") as f:
+            while True:
+                sz = f.readinto(self.file_buf)
+                if not sz:
+                    break
+                h.update(self.file_buf_mv[:sz])
+        return ubinascii.hexlify(h.digest()).decode()
+
+    def _download(self, url, fname):
+        f = http_utils.open_url(url)
+        try:
+            self.save_file(fname, f)
+        finally:
+            f.close()
+
+    def _remove(self, path):
+        try:
+            ota_utils.rmrf(path)
+        except OSError:
+            pass
 
     def save_file(self, fname, subf):
         with open(fname, "wb") as outf:
@@ -161,7 +576,7 @@ class OTA:
                 sz = subf.readinto(self.file_buf)
                 if not sz:
                     break
-                outf.write(self.file_buf, sz)
+                outf.write(self.file_buf_mv[:sz])
 
     # Expects *file* name
     def _makedirs(self, name):
@@ -183,16 +598,23 @@ class OTA:
                 ret = False
         return ret
 
-    def install_tar(self, f, prefix):
-        for info in f:
-            fname = info.name
-            outfname = prefix + fname
+    def install_tar(self, f, offset, release):
+        """Extracts tar stream f, which starts at offset of the uncompressed package, into STAGING_DIR"""
+        self.extracted_offset = offset
+        self.checkpoint_offset = offset
+        tar = utarfile.TarFile(fileobj=f)
+        for info in tar:
+            outfname = self.STAGING_DIR + "/" + info.name
             if info.type != utarfile.DIRTYPE:
                 if self.debug:
                     self._log("Extracting " + outfname)
                 self._makedirs(outfname)
-                subf = f.extractfile(info)
-                self.save_file(outfname, subf)
+                self.save_file(outfname, tar.extractfile(info))
+            self.extracted_offset += 512 + utarfile.roundup(info.size, 512)
+            self.report_progress(self.extracted_offset, release["package_size"])
+            if self.extracted_offset - self.checkpoint_offset >= self.CHECKPOINT_INTERVAL:
+                self._save_checkpoint(release, self.extracted_offset)
+                self.checkpoint_offset = self.extracted_offset
 
     def fatal(self, msg, exc=None):
         self._log("Error:", msg)
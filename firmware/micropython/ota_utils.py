@@ -3,6 +3,7 @@ import os
 import sys
 import time
 import uasyncio
+import ujson
 import http_utils
 import usocket
 import logging
@@ -14,6 +15,18 @@ STATUS_FAILED = "FAILED"
 STATUS_IN_PROGRESS = "IN_PROGRESS"
 STATUS_FINISHED = "FINISHED"
 
+ORIGINAL = "original"
+
+# written after switching to a new version, removed by confirm_version() once the version has proven itself
+TRIAL_FILE = "_ota_trial"
+# boots a new version gets to call confirm_version() before boot.py switches back to the previous one
+MAX_TRIAL_BOOTS = 3
+# a version on trial runs under a watchdog, so a hang resets the device and counts as a failed boot. The ESP32 watchdog
+# can't be stopped, a confirmed version keeps feeding it (feed_watchdog()) until the next reset.
+TRIAL_WATCHDOG_MS = 5 * 60 * 1000
+
+_watchdog = None
+
 
 def print_ota_logs():
     try:
@@ -38,14 +51,128 @@ def rmrf(d):
         os.remove(d)
 
 
+def write_main(code):
+    """
+    Replaces main.py. The new contents are written to a temporary file first and renamed over main.py, so a power
+    loss leaves either the old or the new main.py, never a truncated one.
+    """
+    with open("main.py.new", "w") as f:
+        f.write("# DO NOT EDIT, FILE BEING WRITTEN BY FIRMWARE\n")
+        f.write(code)
+    os.rename("main.py.new", "main.py")
+
+
+def activate(version_dir):
+    """Makes main.py boot a version directory, e.g. "original" or "micropython_1_2_3" """
+    write_main("import %s.main\n\n%s.main.run()\n" % (version_dir, version_dir))
+    end_trial()
+
+
+def confirms_itself(version_dir):
+    """Returns whether a version calls confirm_version(), versions older than the trial boots would always fail it"""
+    try:
+        with open(version_dir + "/main.py") as f:
+            return "confirm_version" in f.read()
+    except OSError:
+        return False
+
+
+def activate_on_trial(version_dir, previous_dir):
+    """
+    Makes main.py boot a freshly installed version until it calls confirm_version(). Exceptions and hangs (see
+    TRIAL_WATCHDOG_MS) reset the device instead of stopping at the REPL, so check_trial() gets to count the failed
+    boots and switch back to previous_dir.
+    """
+    with open(TRIAL_FILE, "w") as f:
+        ujson.dump({"version": version_dir, "previous": previous_dir, "boots": 0}, f)
+    write_main("""import ota_utils
+
+ota_utils.start_trial_watchdog()
+try:
+    import %s.main
+
+    %s.main.run()
+except Exception as e:
+    import machine
+    import sys
+
+    sys.print_exception(e)
+    machine.reset()
+""" % (version_dir, version_dir))
+
+
+def start_trial_watchdog():
+    global _watchdog
+    import machine
+    _watchdog = machine.WDT(timeout=TRIAL_WATCHDOG_MS)
+
+
+def feed_watchdog():
+    """Feeds the trial watchdog, returns False if it isn't running"""
+    if _watchdog is None:
+        return False
+    _watchdog.feed()
+    return True
+
+
 def restore_original():
-    with open("main.py", "w") as f:
-        f.write("import original.main\n")
-        f.write("original.main.run()\n")
+    activate(ORIGINAL)
+
 
+def prepare_update(version_name, active_version):
+    """Makes the next boot install a release, the OTA falls back to active_version if it fails"""
+    write_main('import ota\nota = ota.OTA()\nota.perform_update("%s", "%s")\n' % (version_name, active_version))
 
-def remove_all_versions():
+
+def remove_all_versions(keep=()):
     for dir_name in os.listdir():
-        if dir_name.startswith("micropython_"):
+        if dir_name.startswith("micropython_") and dir_name not in keep:
             log.info("Removing version directory: %s" % dir_name)
             rmrf(dir_name)
+
+
+def _load_trial():
+    try:
+        with open(TRIAL_FILE) as f:
+            return ujson.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def end_trial():
+    try:
+        os.remove(TRIAL_FILE)
+    except OSError:
+        pass
+
+
+def confirm_version():
+    """Called by the firmware once it runs fine, keeps a freshly installed version from being rolled back"""
+    trial = _load_trial()
+    if trial:
+        activate(trial["version"])
+        log.info("Version %s confirmed" % trial["version"])
+
+
+def check_trial():
+    """
+    Called from boot.py. Counts the boots of a freshly installed version and switches back to the previous version
+    when it has booted MAX_TRIAL_BOOTS times without confirming. Returns the version rolled back to or None.
+    """
+    trial = _load_trial()
+    if not trial:
+        return None
+
+    trial["boots"] += 1
+    if trial["boots"] <= MAX_TRIAL_BOOTS:
+        with open(TRIAL_FILE, "w") as f:
+            ujson.dump(trial, f)
+        return None
+
+    previous = trial["previous"]
+    try:
+        os.stat(previous)
+    except OSError:
+        previous = ORIGINAL
+    activate(previous)
+    return previous
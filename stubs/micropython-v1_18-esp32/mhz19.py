@@ -175,24 +175,34 @@ class MHZ19:
 class MHZ19Sim(MHZ19):
     """Simulated MHZ19 sensor- replaces the send_cmd method with one which returns pre-defined responses"""
 
-    # responses contains response data
+    # responses contain the 9-byte response packets
     # checksum is re-calculated before responding
     RESPONSES = {
-        MHZ19.CMD_GET_FW_VERSION: bytearray([0xff, MHZ19.CMD_GET_FW_VERSION, 0, 5, 0, 0, 0, 0]),
-        MHZ19.CMD_GET_READING: bytearray([0xff, MHZ19.CMD_GET_READING, 0x1, 0xa4, 0, 0, 0, 0]),
+        MHZ19.CMD_GET_FW_VERSION: bytearray([0xff, MHZ19.CMD_GET_FW_VERSION, 0, 5, 0, 0, 0, 0, 0]),
+        MHZ19.CMD_GET_READING: bytearray([0xff, MHZ19.CMD_GET_READING, 0x1, 0xa4, 0x40, 0, 0, 0, 0]),
+        MHZ19.CMD_SET_ABC_STATE: bytearray([0xff, MHZ19.CMD_SET_ABC_STATE, 0x1, 0, 0, 0, 0, 0, 0]),
     }
 
-    def send_cmd(self, cmd, payload=None):
+    def __init__(self, uart):
+        super().__init__(uart)
+        # copy, so that simulated readings of one instance don't leak into another
+        self.responses = {cmd: bytearray(resp) for cmd, resp in self.RESPONSES.items()}
+
+    async def send_cmd(self, cmd, payload=None):
         c = MHZ19Cmd(cmd, payload)
         c.pack()
         self.log.debug("Processing simulated cmd: %s" % ubinascii.hexlify(c.body, " "))
 
-        if cmd in self.RESPONSES.keys():
-            c.unpack(self.RESPONSES[cmd])
-            c.body[7] = calc_checksum(c.body[1:7])
+        if cmd in self.responses.keys():
+            resp = self.responses[cmd]
+            resp[8] = calc_checksum(resp[1:8])
+            c.unpack(bytearray(resp))
             self.log.debug("Returning simulated response: %s" % ubinascii.hexlify(c.body, " "))
             return c
 
     def set_sim_co2(self, co2_ppm):
-        self.RESPONSES[MHZ19.CMD_GET_READING][2] = (co2_ppm >> 8) & 0xff
-        self.RESPONSES[MHZ19.CMD_GET_READING][3] = co2_ppm & 0xff
+        self.responses[MHZ19.CMD_GET_READING][2] = (co2_ppm >> 8) & 0xff
+        self.responses[MHZ19.CMD_GET_READING][3] = co2_ppm & 0xff
+
+    def set_sim_temperature(self, temperature):
+        self.responses[MHZ19.CMD_GET_READING][4] = (temperature + 40) & 0xff
@@ -14,6 +14,8 @@ cp "${MICROPYTHON_SOFTWARE_DIR}"/*.py build/
 cp "${MICROPYTHON_SOFTWARE_DIR}"/original/*.py build/original/
 
 cp -r "${MICROPYTHON_SOFTWARE_DIR}"/original/assets/ build/original/assets/
+# pre-decode PNG assets into raw sprites, so that they don't have to be decoded on the device
+python3 "${SCRIPT_DIR}"/convert-sprites.py build/original/assets
 
 cp -r "${MICROPYTHON_SOFTWARE_DIR}"/original/static/ build/original/static/
 
@@ -21,6 +23,9 @@ rm -r build/original/static/mock/
 sed -i'' -e "s:const mock = true;:const mock = false;:g" build/original/static/sargsAPI.js
 gzip -r build/original/static/*
 
+# pack assets and web portal files into a single file
+python3 "${SCRIPT_DIR}"/pack-assets.py build/original build/original/assets.bundle
+
 # create a version file
 echo "VERSION='${1}'" > build/original/airguardversion.py
 
@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+"""
+Gzips a release package (micropython.tar) for OTA updates. The device decompresses the package while downloading it
+with uzlib.DecompIO, which allocates the whole DEFLATE window, so the package is compressed with a small window that
+must not be larger than OTA.GZIP_WINDOW_BITS in firmware/micropython/ota.py.
+
+Usage: compress-package.py [--window-bits N] <micropython.tar> <micropython.tar.gz>
+"""
+import argparse
+import os
+import zlib
+
+DEFAULT_WINDOW_BITS = 12
+CHUNK_SIZE = 64 * 1024
+
+
+def compress(src, dst, window_bits=DEFAULT_WINDOW_BITS):
+    # +16 writes a gzip header and trailer instead of zlib ones
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + window_bits)
+    with open(src, "rb") as fin, open(dst, "wb") as fout:
+        while True:
+            chunk = fin.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            fout.write(compressor.compress(chunk))
+        fout.write(compressor.flush())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--window-bits", type=int, default=DEFAULT_WINDOW_BITS, choices=range(9, 16),
+                        help="log2 of the DEFLATE window (default %d)" % DEFAULT_WINDOW_BITS)
+    parser.add_argument("src")
+    parser.add_argument("dst")
+    args = parser.parse_args()
+
+    compress(args.src, args.dst, args.window_bits)
+    src_size = os.path.getsize(args.src)
+    dst_size = os.path.getsize(args.dst)
+    print("%s: %d -> %d bytes (%.0f%%)" % (args.dst, src_size, dst_size, 100 * dst_size / max(1, src_size)))
+
+
+if __name__ == "__main__":
+    main()
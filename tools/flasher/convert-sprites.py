@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+"""
+Converts the PNG assets into raw 1-bpp sprites that the firmware can blit without decoding PNGs at runtime.
+
+Every "<name>.png" gets a "<name>.spr" next to it: a 4-byte header (width, height as little-endian uint16) followed
+by the pixels in MONO_HLSB layout (rows of ceil(width / 8) bytes, most significant bit is the leftmost pixel).
+A pixel is set when it is light and not transparent, which matches how the display draws the PNGs.
+
+Usage: convert-sprites.py <assets dir>
+"""
+import os
+import struct
+import sys
+
+from PIL import Image
+
+
+def convert(png_path):
+    im = Image.open(png_path).convert("LA")
+    w, h = im.size
+    row_bytes = (w + 7) // 8
+    data = bytearray(row_bytes * h)
+    pixels = im.load()
+    for y in range(h):
+        for x in range(w):
+            lum, alpha = pixels[x, y]
+            if lum >= 128 and alpha >= 128:
+                data[y * row_bytes + x // 8] |= 0x80 >> (x % 8)
+
+    with open(png_path[:-4] + ".spr", "wb") as f:
+        f.write(struct.pack("<HH", w, h))
+        f.write(data)
+
+
+def main(assets_dir):
+    count = 0
+    for root, _, files in os.walk(assets_dir):
+        for fn in sorted(files):
+            if fn.endswith(".png"):
+                convert(os.path.join(root, fn))
+                count += 1
+    print("Converted %d sprites" % count)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print(__doc__.strip())
+        sys.exit(1)
+    main(sys.argv[1])
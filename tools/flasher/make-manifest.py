@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+"""
+Writes the delta OTA manifest of a release package (micropython.tar): every regular file with its size, the offset of
+its data in the package and its SHA-256, in package order. Devices only download the files whose hash differs from
+the installed ones, with HTTP range requests into micropython.tar, see OTA.delta_install() in firmware/micropython/ota.py.
+
+    {"package": "micropython.tar", "files": [["main.py", 1234, 512, "9f86d0..."], ...]}
+
+Usage: make-manifest.py <micropython.tar> <manifest.json>
+"""
+import argparse
+import hashlib
+import json
+import os
+import tarfile
+
+PACKAGE_NAME = "micropython.tar"
+
+
+def make_manifest(src):
+    files = []
+    with tarfile.open(src, "r:") as tar:
+        for info in tar:
+            if not info.isreg():
+                continue
+            data = tar.extractfile(info).read()
+            name = info.name[2:] if info.name.startswith("./") else info.name
+            files.append([name, info.size, info.offset_data, hashlib.sha256(data).hexdigest()])
+    return {"package": PACKAGE_NAME, "files": files}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("src")
+    parser.add_argument("dst")
+    args = parser.parse_args()
+
+    manifest = make_manifest(args.src)
+    with open(args.dst, "w") as f:
+        # one file per line keeps the manifest readable and diffable
+        f.write('{"package": %s, "files": [\n' % json.dumps(manifest["package"]))
+        f.write(",\n".join(json.dumps(entry) for entry in manifest["files"]))
+        f.write("\n]}\n")
+    print("%s: %d files, %d bytes" % (args.dst, len(manifest["files"]), os.path.getsize(args.dst)))
+
+
+if __name__ == "__main__":
+    main()
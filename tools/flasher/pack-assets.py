@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+Packs the UI assets and the gzipped web portal files of a build into a single bundle file, so that the device
+doesn't have to look up dozens of small files on the filesystem. The packed files are removed from the build.
+
+Bundle layout (all integers little-endian):
+    magic "AGB1", uint16 entry count
+    entry count times: uint8 name length, name (utf-8), uint32 offset, uint32 length, uint8 encoding
+    file data
+
+Names are relative to the firmware directory, e.g. "assets/ppm/ppm17.spr" or "static/index.html". Gzipped files
+are stored with the ".gz" suffix stripped and encoding 1, everything else has encoding 0.
+
+Usage: pack-assets.py <firmware build dir> <bundle file>
+"""
+import os
+import struct
+import sys
+
+MAGIC = b"AGB1"
+ENCODING_RAW = 0
+ENCODING_GZIP = 1
+
+PACKED_DIRS = ("assets", "static")
+
+
+def collect(build_dir):
+    files = []
+    for packed_dir in PACKED_DIRS:
+        for root, _, fns in os.walk(os.path.join(build_dir, packed_dir)):
+            for fn in sorted(fns):
+                path = os.path.join(root, fn)
+                name = os.path.relpath(path, build_dir).replace(os.sep, "/")
+                encoding = ENCODING_RAW
+                if name.endswith(".gz"):
+                    name = name[:-3]
+                    encoding = ENCODING_GZIP
+                files.append((name, encoding, path))
+    return sorted(files)
+
+
+def main(build_dir, bundle_fn):
+    files = collect(build_dir)
+
+    index_size = len(MAGIC) + 2
+    for name, _, _ in files:
+        index_size += 1 + len(name.encode()) + 4 + 4 + 1
+
+    index = bytearray(MAGIC + struct.pack("<H", len(files)))
+    data = bytearray()
+    for name, encoding, path in files:
+        with open(path, "rb") as f:
+            content = f.read()
+        name_b = name.encode()
+        index += struct.pack("<B", len(name_b)) + name_b
+        index += struct.pack("<IIB", index_size + len(data), len(content), encoding)
+        data += content
+
+    with open(bundle_fn, "wb") as f:
+        f.write(index)
+        f.write(data)
+
+    for _, _, path in files:
+        os.remove(path)
+    for packed_dir in PACKED_DIRS:
+        for root, _, _ in sorted(os.walk(os.path.join(build_dir, packed_dir)), reverse=True):
+            os.rmdir(root)
+
+    print("Packed %d files (%d bytes) into %s" % (len(files), len(index) + len(data), bundle_fn))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print(__doc__.strip())
+        sys.exit(1)
+    main(sys.argv[1], sys.argv[2])
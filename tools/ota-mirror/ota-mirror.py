@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+"""
+Serves Air Guard OTA updates on the local network, so that a school's devices download each release once over the
+uplink instead of once per device.
+
+The mirror keeps the newest MicroPython releases of the GitHub repository in a directory, checking for new ones every
+--sync-interval seconds, and serves them over HTTP with the same releases list as the GitHub API (asset URLs pointing
+to the mirror) and range requests, which is all the device needs (see OTA.release_sources() in
+firmware/micropython/ota.py). Devices use the mirror configured as otaMirrorUrl in their config.json. When the mirror
+doesn't have the release or fails, they download it from GitHub.
+
+Usage: ota-mirror.py [--dir DIR] [--port PORT] [--keep N] [--sync-interval S] [--no-sync]
+"""
+import argparse
+import json
+import os
+import re
+import shutil
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+GITHUB_REPO = "open-lv/air-guard"
+GITHUB_API_URL = "https://api.github.com"
+RELEASES_PATH = "/repos/%s/releases" % GITHUB_REPO
+# what the device downloads, see OTA.PACKAGE_ASSETS and OTA.MANIFEST_ASSET
+ASSETS = ("micropython.tar.gz", "micropython.tar", "manifest.json")
+CONTENT_TYPES = {"manifest.json": "application/json"}
+
+INDEX_FILE = "releases.json"
+CHUNK_SIZE = 64 * 1024
+
+
+def log(message):
+    print("%s %s" % (time.strftime("%Y-%m-%d %H:%M:%S"), message), flush=True)
+
+
+def _fetch(url, dst):
+    tmp = dst + ".part"
+    request = urllib.request.Request(url, headers={"User-Agent": "open-lv/air-guard ota-mirror"})
+    with urllib.request.urlopen(request, timeout=60) as response, open(tmp, "wb") as f:
+        shutil.copyfileobj(response, f, CHUNK_SIZE)
+    os.replace(tmp, dst)
+
+
+def load_index(mirror_dir):
+    try:
+        with open(os.path.join(mirror_dir, INDEX_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return []
+
+
+def sync(mirror_dir, keep):
+    """Downloads the assets of the newest keep MicroPython releases that aren't mirrored yet and removes older ones"""
+    request = urllib.request.Request(GITHUB_API_URL + RELEASES_PATH, headers={
+        "User-Agent": "open-lv/air-guard ota-mirror", "Accept": "application/vnd.github+json"})
+    with urllib.request.urlopen(request, timeout=60) as response:
+        github_releases = json.load(response)
+
+    index = []
+    for release in github_releases:
+        tag = release.get("tag_name") or ""
+        if not re.match(r"micropython-[\w.-]+$", tag) or release.get("draft") or release.get("prerelease"):
+            continue
+        assets = [a for a in release.get("assets", []) if a["name"] in ASSETS]
+        if not any(a["name"] in ASSETS[:2] for a in assets):
+            continue
+        release_dir = os.path.join(mirror_dir, tag)
+        os.makedirs(release_dir, exist_ok=True)
+        for asset in assets:
+            path = os.path.join(release_dir, asset["name"])
+            if os.path.exists(path) and os.path.getsize(path) == asset["size"]:
+                continue
+            log("Downloading %s %s (%d bytes)" % (tag, asset["name"], asset["size"]))
+            _fetch(asset["browser_download_url"], path)
+        index.append({
+            "tag_name": tag,
+            "name": release.get("name") or tag,
+            "published_at": release.get("published_at"),
+            "assets": [{"name": a["name"], "size": a["size"]} for a in assets],
+        })
+        if len(index) >= keep:
+            break
+
+    tmp = os.path.join(mirror_dir, INDEX_FILE + ".part")
+    with open(tmp, "w") as f:
+        json.dump(index, f, indent=1)
+    os.replace(tmp, os.path.join(mirror_dir, INDEX_FILE))
+
+    kept = {release["tag_name"] for release in index}
+    for name in os.listdir(mirror_dir):
+        if name.startswith("micropython-") and name not in kept:
+            log("Removing " + name)
+            shutil.rmtree(os.path.join(mirror_dir, name), ignore_errors=True)
+    log("Mirroring %s" % (", ".join(sorted(kept)) or "no releases"))
+
+
+def releases_list(index, base_url):
+    """The index as the GitHub API lists releases, with download URLs pointing to the mirror at base_url"""
+    releases = []
+    for release in index:
+        release = dict(release, assets=[dict(
+            asset, browser_download_url="%s/%s/%s" % (base_url, release["tag_name"], asset["name"]))
+            for asset in release["assets"]])
+        releases.append(release)
+    return releases
+
+
+def parse_range(header, size):
+    """Returns (start, end) of a "bytes=start-[end]" Range header, None without one, raises ValueError if invalid"""
+    if not header:
+        return None
+    m = re.match(r"bytes=(\d+)-(\d*)$", header.strip())
+    if not m or int(m.group(1)) >= size:
+        raise ValueError(header)
+    start = int(m.group(1))
+    end = min(int(m.group(2)) if m.group(2) else size - 1, size - 1)
+    if end < start:
+        raise ValueError(header)
+    return start, end
+
+
+class MirrorHandler(BaseHTTPRequestHandler):
+    # the device's open_url() speaks HTTP/1.0, every response closes the connection
+    protocol_version = "HTTP/1.0"
+    server_version = "air-guard-ota-mirror"
+    mirror_dir = "."
+
+    def do_HEAD(self):
+        self.do_GET(head=True)
+
+    def do_GET(self, head=False):
+        path = self.path.split("?")[0]
+        if path == RELEASES_PATH:
+            # the Host header is the address the device reached the mirror at
+            base_url = "http://%s" % (self.headers.get("Host") or "%s:%d" % self.server.server_address)
+            body = json.dumps(releases_list(load_index(self.mirror_dir), base_url)).encode()
+            self._respond(200, "application/json", len(body))
+            if not head:
+                self.wfile.write(body)
+            return
+
+        m = re.match(r"/(micropython-[\w.-]+)/([\w.-]+)$", path)
+        if not m or m.group(2) not in ASSETS:
+            return self.send_error(404)
+        file_path = os.path.join(self.mirror_dir, m.group(1), m.group(2))
+        try:
+            f = open(file_path, "rb")
+        except OSError:
+            return self.send_error(404)
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            try:
+                byte_range = parse_range(self.headers.get("Range"), size)
+            except ValueError:
+                self.send_response(416)
+                self.send_header("Content-Range", "bytes */%d" % size)
+                self.send_header("Content-Length", "0")
+                return self.end_headers()
+            (start, end) = byte_range or (0, size - 1)
+            content_type = CONTENT_TYPES.get(m.group(2), "application/octet-stream")
+            if byte_range:
+                self._respond(206, content_type, end + 1 - start, "bytes %d-%d/%d" % (start, end, size))
+            else:
+                self._respond(200, content_type, size)
+            if head:
+                return
+            f.seek(start)
+            remaining = end + 1 - start
+            while remaining > 0:
+                chunk = f.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+                remaining -= len(chunk)
+
+    def _respond(self, status, content_type, length, content_range=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(length))
+        self.send_header("Accept-Ranges", "bytes")
+        if content_range:
+            self.send_header("Content-Range", content_range)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        log("%s %s" % (self.address_string(), format % args))
+
+
+def sync_periodically(mirror_dir, keep, interval_s):
+    while True:
+        try:
+            sync(mirror_dir, keep)
+        except Exception as e:
+            log("Sync failed: %s" % e)
+        time.sleep(interval_s)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--dir", default="ota-mirror", help="directory the releases are kept in (default ota-mirror)")
+    parser.add_argument("--port", type=int, default=8080, help="HTTP port (default 8080)")
+    parser.add_argument("--keep", type=int, default=3, help="number of newest releases to mirror (default 3)")
+    parser.add_argument("--sync-interval", type=float, default=3600,
+                        help="seconds between checks for new releases (default 3600)")
+    parser.add_argument("--no-sync", action="store_true", help="only serve what is already in --dir")
+    args = parser.parse_args()
+
+    os.makedirs(args.dir, exist_ok=True)
+    MirrorHandler.mirror_dir = args.dir
+    if not args.no_sync:
+        threading.Thread(target=sync_periodically, args=(args.dir, args.keep, args.sync_interval), daemon=True).start()
+
+    server = ThreadingHTTPServer(("", args.port), MirrorHandler)
+    log("Serving %s on port %d" % (args.dir, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
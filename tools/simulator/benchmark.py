@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+"""
+Benchmarks the firmware hot paths in the simulation: SargsUI.update() for every screen and main sub-screen, the CO2
+history and plots, the MH-Z19 protocol and web portal request handling. See simrt/bench.py for the metrics.
+
+Examples:
+    benchmark.py --out results.json
+    benchmark.py --out results.json --compare baseline.json
+    benchmark.py --only plot --quick
+"""
+import argparse
+import contextlib
+import io
+import sys
+
+import simrt
+from simrt import bench
+from simrt.trace import Co2Trace
+
+HISTORY_DAYS = 7
+MEASUREMENT_PERIOD_MS = 5000
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--out", help="write the results to this JSON file")
+    parser.add_argument("--compare", metavar="BASELINE", help="compare with the results of an earlier run")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="relative change of virtual time or allocations that counts as a regression")
+    parser.add_argument("--only", action="append", help="only run benchmarks whose name contains this")
+    parser.add_argument("--quick", action="store_true", help="run a tenth of the iterations")
+    parser.add_argument("--firmware", default=simrt.FIRMWARE_DIR, help="firmware directory or build")
+    return parser.parse_args()
+
+
+class Device:
+    """The firmware objects the benchmarks work on, set up like main.py does but without starting its tasks"""
+
+    def __init__(self, sim):
+        self.sim = sim
+        from original import sargs
+        self.sargs = sargs.setup()
+        sim.run_until_complete(self.sargs.setup())
+        self.ui = self.sargs.ui
+        self.sargs.co2_measurement = 650
+
+        # a week of history, so every plot has data to draw
+        history = self.ui.co2_history
+        for i in range(HISTORY_DAYS * 24 * 3600 * 1000 // MEASUREMENT_PERIOD_MS):
+            history.add_measurement(600 + (i // 120) % 400)
+            sim.clock.advance_ms(MEASUREMENT_PERIOD_MS)
+
+    def now(self):
+        return self.sim.clock.ticks_ms()
+
+
+def ui_benchmarks(device):
+    from original import sargsui
+    ui = device.ui
+    ScreenState = sargsui.ScreenState
+    CO2Level = sargsui.CO2Level
+
+    def prepare_screen(screen, subscreen=0, co2_level=CO2Level.LOW):
+        def prepare():
+            ui.current_screen = screen
+            ui.main_selected_subscreen = subscreen
+            ui.co2_level = co2_level
+            ui.prev_co2_level = co2_level
+            ui.co2_measurement = 650 if co2_level == CO2Level.LOW else 1600
+            ui.eye_animation = None
+            ui.update_available = False
+            ui.latest_version = "1.2.3"
+            now = device.now()
+            ui.large_ppm_enter_ticks_ms = now
+            ui.cal_screen_act_time = now
+            ui.ota_screen_act_time = now
+            # force a full redraw, as if the shown data had just changed
+            ui.shown_content_key = None
+            ui.wake.set()
+        return prepare
+
+    def prepare_idle():
+        # nothing changed and the next frame isn't due, update() only does housekeeping
+        ui.scheduled_screen = ui._screen_selection()
+        ui.next_frame_ticks_ms = device.now() + 3600 * 1000
+        ui.wake.clear()
+
+    screens = [
+        ("init", ScreenState.INIT_SCREEN, CO2Level.LOW),
+        ("intro", ScreenState.INTRO_SCREEN, CO2Level.LOW),
+        ("warmup", ScreenState.WARMUP_SCREEN, CO2Level.LOW),
+        ("open_window", ScreenState.OPEN_WINDOW_SCREEN, CO2Level.HIGH),
+        ("large_ppm", ScreenState.LARGE_PPM_SCREEN, CO2Level.HIGH),
+        ("calibration", ScreenState.CALIBRATION_SCREEN, CO2Level.LOW),
+        ("ota_update", ScreenState.OTA_UPDATE_SCREEN, CO2Level.LOW),
+    ]
+    benchmarks = []
+    for name, screen, co2_level in screens:
+        benchmarks.append(bench.Benchmark("ui.update/%s" % name, ui.update, prepare_screen(screen, 0, co2_level)))
+    for idx, subscreen in enumerate(ui.MAIN_SUBSCREENS):
+        benchmarks.append(bench.Benchmark("ui.update/main/%s" % subscreen.replace("draw_", "").replace("_screen", ""),
+                                          ui.update, prepare_screen(ScreenState.MAIN_SCREEN, idx)))
+    benchmarks.append(bench.Benchmark("ui.update/idle", ui.update, prepare_idle, iterations=2000))
+    return benchmarks
+
+
+def history_benchmarks(device):
+    history = device.ui.co2_history
+
+    def next_measurement():
+        device.sim.clock.advance_ms(MEASUREMENT_PERIOD_MS)
+
+    def load():
+        history.seglog.damaged = False
+        for t in history.tiers:
+            for rb in (t.mins, t.means, t.maxs):
+                rb.clear()
+        history._load_data()
+
+    history._save_data()
+    return [
+        bench.Benchmark("timeseries.add_measurement", lambda: history.add_measurement(700), next_measurement,
+                        iterations=5000),
+        bench.Benchmark("timeseries.load", load, iterations=20),
+    ]
+
+
+def plot_benchmarks(device):
+    benchmarks = []
+    for name, plotter in device.ui.plots:
+        def invalidate(plotter=plotter):
+            plotter.cached_version = -1
+
+        name = name.replace(" ", "")
+        benchmarks.append(bench.Benchmark("plot.plot_data/%s/rescale" % name,
+                                          lambda plotter=plotter: plotter.plot_data(device.sim.display, 16),
+                                          invalidate))
+        benchmarks.append(bench.Benchmark("plot.plot_data/%s/cached" % name,
+                                          lambda plotter=plotter: plotter.plot_data(device.sim.display, 16)))
+    return benchmarks
+
+
+def mhz19_benchmarks(device):
+    import mhz19
+    sensor = device.sargs.co2_sensor
+    response = bytearray([0xff, mhz19.MHZ19.CMD_GET_READING, 0x02, 0x8a, 0x3e, 0, 0, 0, 0])
+    response[8] = mhz19.calc_checksum(response[1:8])
+    cmd = mhz19.MHZ19Cmd(mhz19.MHZ19.CMD_GET_READING)
+    return [
+        bench.Benchmark("mhz19.MHZ19Cmd.pack", cmd.pack, iterations=20000),
+        bench.Benchmark("mhz19.MHZ19Cmd.unpack", lambda: cmd.unpack(response), iterations=20000),
+        bench.Benchmark("mhz19.get_co2_reading", sensor.get_co2_reading, iterations=2000),
+    ]
+
+
+def portal_benchmarks(device):
+    from original import portal
+    sim = device.sim
+    with contextlib.redirect_stdout(io.StringIO()):
+        portal.setup()
+    # let the server task register with the simulated network
+    sim.run_until_complete(_yield())
+    host = sim.device_ip()
+
+    def get(path):
+        raw = ("GET %s HTTP/1.0\r\nHost: %s\r\n\r\n" % (path, host)).encode()
+        return lambda: sim.net.request(host, 80, raw)
+
+    return [
+        bench.Benchmark("portal GET /api/state", get("/api/state"), iterations=500),
+        bench.Benchmark("portal GET /", get("/"), iterations=500),
+    ]
+
+
+async def _yield():
+    import uasyncio
+    await uasyncio.sleep_ms(0)
+
+
+def main():
+    args = parse_args()
+    sim = simrt.Simulation(Co2Trace.constant(650), firmware_dir=args.firmware, log_stream=None)
+    runner = bench.Runner(sim, iteration_scale=0.1 if args.quick else 1.0)
+
+    with sim.flash():
+        device = Device(sim)
+        benchmarks = []
+        for suite in (ui_benchmarks, history_benchmarks, plot_benchmarks, mhz19_benchmarks, portal_benchmarks):
+            benchmarks += suite(device)
+
+        def progress(name, r):
+            print("%-48s %10s ops/s %10d us/call (virtual) %8d B/call" % (
+                name, r["ops_per_s"], r["virtual_us_per_call"], r["alloc_bytes_per_call"]), flush=True)
+
+        results = runner.run(benchmarks, only=args.only, progress=progress)
+
+    if args.out:
+        bench.save(args.out, results, device.sargs.version)
+        print("Results written to %s" % args.out)
+
+    if args.compare:
+        lines, regressions = bench.compare(bench.load(args.compare), results, args.threshold)
+        print("\nCompared with %s:" % args.compare)
+        for line in lines:
+            print(line)
+        if regressions:
+            print("\n%d regression(s):" % len(regressions))
+            for r in regressions:
+                print("  " + r)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
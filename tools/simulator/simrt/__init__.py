@@ -0,0 +1,388 @@
+"""
+Simulation runtime for running the Air Guard MicroPython firmware under CPython.
+
+The MicroPython-specific modules (`machine`, `display`, `network`, `uasyncio`, `utime`, ...) are replaced with the
+simulated ones from this package, the frozen modules (`mhz19`, `network_manager`, `tinyweb`, `logging`, `utarfile`)
+are loaded from the MicroPython stubs, and the firmware itself runs unmodified from a copy of its directory (the
+simulated flash). Time is virtual: the event loop never sleeps, it advances the clock to the next timer instead.
+machine.reset() reboots the firmware with the same flash, so OTA updates can be simulated too.
+
+Only one simulation can be installed per process, since the simulated modules replace entries in sys.modules.
+"""
+import asyncio
+import builtins
+import contextlib
+import gc
+import importlib
+import importlib.util
+import os
+import shutil
+import sys
+import tempfile
+import time as _host_time
+import tracemalloc
+import traceback
+
+from . import clock as _clock
+from .internet import Internet, firmware_version
+from .net import VirtualNetwork
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..", ".."))
+FIRMWARE_DIR = os.path.join(ROOT_DIR, "firmware", "micropython")
+STUBS_DIR = os.path.join(ROOT_DIR, "stubs", "micropython-v1_18-esp32")
+
+# modules which are frozen into the firmware image, their sources are shipped with the stubs
+FROZEN_MODULES = ("logging", "mhz19", "network_manager", "tinyweb", "utarfile")
+
+# MicroPython "u" modules that behave close enough to their CPython counterparts
+MODULE_ALIASES = {
+    "uarray": "array",
+    "ubinascii": "binascii",
+    "ucollections": "collections",
+    "uerrno": "errno",
+    "uhashlib": "hashlib",
+    "uheapq": "heapq",
+    "uio": "io",
+    "ujson": "json",
+    "uos": "os",
+    "urandom": "random",
+    "ure": "re",
+    "uselect": "select",
+    "ustruct": "struct",
+    "usys": "sys",
+}
+
+BUTTON_PIN = 35
+LDR_PIN = 34
+
+# the simulation currently installed, used by the simulated modules
+sim = None
+
+
+class SimulationEnd(SystemExit):
+    """Raised on the event loop when the requested duration has been simulated"""
+
+
+class _TimestampedStream:
+    """Prefixes every log line with the virtual time"""
+
+    def __init__(self, stream, clock):
+        self.stream = stream
+        self.clock = clock
+        self.line_start = True
+
+    def write(self, s):
+        for part in s.splitlines(True):
+            if self.line_start:
+                self.stream.write("[%10.3f] " % self.clock.seconds())
+            self.stream.write(part)
+            self.line_start = part.endswith("\n")
+
+    def flush(self):
+        self.stream.flush()
+
+
+def _print_exception(e, file=None):
+    file = file or sys.stderr
+    if isinstance(e, BaseException):
+        traceback.print_exception(type(e), e, e.__traceback__, file=file)
+    else:
+        print(e, file=file)
+
+
+def _ilistdir(path="."):
+    for entry in os.scandir(path):
+        yield entry.name, 0x4000 if entry.is_dir() else 0x8000, 0, entry.stat().st_size if entry.is_file() else 0
+
+
+def _load_frozen(name):
+    spec = importlib.util.spec_from_file_location(name, os.path.join(STUBS_DIR, name + ".py"))
+    m = importlib.util.module_from_spec(spec)
+    sys.modules[name] = m
+    spec.loader.exec_module(m)
+    return m
+
+
+def _binary_open(fn, mode="r", *args, **kwargs):
+    # MicroPython files opened in text mode still support readinto(), CPython only has it on binary files
+    if "b" not in mode:
+        mode += "b"
+    return builtins.open(fn, mode, *args, **kwargs)
+
+
+async def _tinyweb_tcp_server(self, host, port, backlog):
+    """Replaces tinyweb's socket-polling server generator, which only runs on MicroPython's uasyncio"""
+    import uasyncio
+
+    async def accept(reader, writer):
+        self.processed_connections += 1
+        self.conns[id(writer.s)] = None
+        await self._handler(reader, writer)
+
+    await uasyncio.start_server(accept, host, port, backlog)
+
+
+class Simulation:
+    """
+    A simulated Air Guard device.
+
+    trace           - simrt.trace.Co2Trace the CO2 sensor follows
+    firmware_dir    - firmware to run, either firmware/micropython or a build made by tools/flasher/build.sh
+    flash_dir       - directory holding the simulated flash, a temporary copy of firmware_dir by default
+    config          - contents of config.json, WiFi is disabled by default
+    wifi_networks   - SSID -> password of the access points in range
+    internet        - whether a connected WiFi network has Internet access
+    latest_release  - release tag the update server announces, the firmware's own version by default
+    frames_dir      - if set, every distinct frame shown on the display is written there as a PBM image
+    log_stream      - where firmware logs go, prefixed with the virtual time; None silences them
+    """
+
+    heap_size = 111 * 1024
+
+    def __init__(self, trace, firmware_dir=FIRMWARE_DIR, flash_dir=None, config=None, wifi_networks=None,
+                 internet=False, frames_dir=None, log_stream=sys.stderr, machine_id=b"\x24\x0a\xc4\x5a\x1d\x0e",
+                 trace_heap=False, latest_release=None):
+        self.trace = trace
+        self.firmware_dir = firmware_dir
+        self.flash_dir = flash_dir
+        self.config = config if config is not None else {"wifiEnabled": False}
+        self.wifi_networks = wifi_networks or {}
+        self.internet = internet
+        self.frames_dir = frames_dir
+        self.log_stream = log_stream
+        self.machine_id = machine_id
+        self.trace_heap = trace_heap
+
+        self.clock = _clock.VirtualClock()
+        self.loop = None
+        self.net = VirtualNetwork()
+        self.servers = Internet(self.net, latest_release or firmware_version(firmware_dir))
+        self.display = None
+        self.broker = None
+        self.end_reason = None
+        self.wall_time_s = 0
+        # (t_s, reason) of every reboot
+        self.reboots = []
+        # (t_s, func, args) of everything scheduled with at(), carried over to the event loop of the next boot
+        self.scheduled = []
+        # tasks of previous boots, kept so that their coroutines aren't finalized (running finally blocks)
+        self.abandoned_tasks = []
+
+    # --- setup
+
+    def install(self):
+        """Replaces the MicroPython modules in sys.modules with the simulated ones"""
+        global sim
+        if sim is not None:
+            raise RuntimeError("a simulation is already installed in this process")
+        sim = self
+
+        from . import (display, machine, micropython, network, ntptime, uasyncio, uctypes, umqtt, urequests, usocket,
+                       ussl, uzlib)
+
+        self.loop = _clock.VirtualTimeEventLoop(self.clock)
+        asyncio.set_event_loop(self.loop)
+        self.display = display.Display(self.clock, display.FrameRecorder(self.frames_dir))
+        self.broker = umqtt.Broker()
+        self.servers.add_mqtt_broker(self.broker)
+        machine.reset_sim_state()
+        network.reset_sim_state()
+
+        utime = _clock.make_utime(self.clock)
+        # stdlib modules imported from now on still find what they expect from `time`
+        for name in dir(_host_time):
+            if not hasattr(utime, name):
+                setattr(utime, name, getattr(_host_time, name))
+        sys.modules["utime"] = utime
+        sys.modules["time"] = utime
+
+        for alias, name in MODULE_ALIASES.items():
+            sys.modules[alias] = importlib.import_module(name)
+        os.ilistdir = _ilistdir
+        sys.print_exception = _print_exception
+        gc.mem_free = self.mem_free
+        gc.mem_alloc = lambda: self.heap_size - self.mem_free()
+
+        umqtt.simple = umqtt
+        sys.modules.update({
+            "machine": machine,
+            "network": network,
+            "display": self.display,
+            "micropython": micropython,
+            "uasyncio": uasyncio,
+            "uasyncio.core": uasyncio,
+            "umqtt": umqtt,
+            "umqtt.simple": umqtt,
+            "usocket": usocket,
+            "ussl": ussl,
+            "uctypes": uctypes,
+            "uzlib": uzlib,
+            "ntptime": ntptime,
+            "urequests": urequests,
+        })
+
+        self._load_frozen_modules()
+        machine.ADC.levels[LDR_PIN] = 2048
+        self._prepare_flash()
+
+    def _load_frozen_modules(self):
+        for name in FROZEN_MODULES:
+            _load_frozen(name)
+        logging = sys.modules["logging"]
+        if self.log_stream is None:
+            logging._stream = open(os.devnull, "w")
+        else:
+            logging._stream = _TimestampedStream(self.log_stream, self.clock)
+        tinyweb = sys.modules["tinyweb"]
+        tinyweb.webserver._tcp_server = _tinyweb_tcp_server
+        tinyweb.open = _binary_open
+
+        from . import sensor
+        sys.modules["mhz19"].MHZ19 = sensor.TraceMHZ19
+
+    def _prepare_flash(self):
+        if self.flash_dir is not None:
+            self.flash_dir = os.path.abspath(self.flash_dir)
+        else:
+            self.flash_dir = tempfile.mkdtemp(prefix="airguard-flash-")
+            shutil.rmtree(self.flash_dir)
+            shutil.copytree(self.firmware_dir, self.flash_dir, ignore=shutil.ignore_patterns("__pycache__"))
+        if self.config is not None:
+            import json
+            with open(os.path.join(self.flash_dir, "config.json"), "w") as f:
+                json.dump(self.config, f)
+
+    # --- inputs
+
+    def at(self, t_s, func, *args):
+        """Calls func at t_s seconds of virtual time"""
+        self.scheduled.append((t_s, func, args))
+        self.loop.call_at(t_s, func, *args)
+
+    def press_button(self, t_s, hold_s=0.2):
+        def drive(value):
+            sys.modules["machine"].Pin.pins[BUTTON_PIN].sim_drive(value)
+        # the button pulls the pin low
+        self.at(t_s, drive, 0)
+        self.at(t_s + hold_s, drive, 1)
+
+    def set_light(self, level, t_s=0):
+        """Sets the raw LDR reading, lower is brighter"""
+        self.at(t_s, sys.modules["machine"].ADC.levels.__setitem__, LDR_PIN, level)
+
+    # --- state
+
+    def device_ip(self):
+        network = sys.modules["network"]
+        if network.WLAN(network.STA_IF).isconnected():
+            return network.STA_IP
+        return network.AP_IP
+
+    def mem_free(self):
+        if tracemalloc.is_tracing():
+            return max(0, self.heap_size - tracemalloc.get_traced_memory()[0])
+        return self.heap_size
+
+    def leds(self):
+        """Returns pin number -> PWM duty of the LEDs and buzzer"""
+        return {pin: pwm.duty() for pin, pwm in sys.modules["machine"].PWM.channels.items()}
+
+    # --- running
+
+    def _end(self):
+        raise SimulationEnd()
+
+    @contextlib.contextmanager
+    def flash(self):
+        """Makes the simulated flash the working directory and its modules importable, like on the device"""
+        if sim is not self:
+            self.install()
+        cwd = os.getcwd()
+        os.chdir(self.flash_dir)
+        sys.path.insert(0, self.flash_dir)
+        try:
+            yield
+        finally:
+            sys.path.remove(self.flash_dir)
+            os.chdir(cwd)
+
+    def run_until_complete(self, coro):
+        """Runs a single coroutine (e.g. a piece of the firmware) on the simulated event loop"""
+        return self.loop.run_until_complete(coro)
+
+    def _reboot(self):
+        """Drops everything the firmware had in RAM like a reset does, the flash and the clock are kept"""
+        for name, m in list(sys.modules.items()):
+            if (getattr(m, "__file__", None) or "").startswith(self.flash_dir + os.sep):
+                del sys.modules[name]
+
+        # tasks of the previous boot are abandoned, not cancelled, and nobody needs to hear about it
+        old_loop = self.loop
+        old_loop.set_exception_handler(lambda loop, context: None)
+        self.abandoned_tasks += asyncio.all_tasks(old_loop)
+        # the device's connections are gone, the broker stops sending to them
+        self.broker.sessions.clear()
+        self.loop = _clock.VirtualTimeEventLoop(self.clock)
+        asyncio.set_event_loop(self.loop)
+        old_loop.close()
+        for (t_s, func, args) in self.scheduled:
+            if t_s >= self.clock.seconds():
+                self.loop.call_at(t_s, func, *args)
+
+        machine = sys.modules["machine"]
+        levels = dict(machine.ADC.levels)
+        machine.reset_sim_state()
+        machine.ADC.levels.update(levels)
+        sys.modules["network"].reset_sim_state()
+        self._load_frozen_modules()
+
+    def run(self, duration_s, boot=True, reboot=True):
+        """
+        Boots the firmware and runs it until duration_s seconds of virtual time have passed. machine.reset() boots
+        the firmware again, or ends the run if reboot is False.
+        """
+        with self.flash():
+            machine = sys.modules["machine"]
+            self.at(duration_s, self._end)
+            if self.trace_heap:
+                tracemalloc.start()
+            wall_start = _host_time.perf_counter()
+            try:
+                while True:
+                    try:
+                        if boot:
+                            importlib.import_module("boot")
+                        importlib.import_module("main")
+                        self.end_reason = "main returned"
+                        break
+                    except SimulationEnd:
+                        raise
+                    except SystemExit as e:
+                        # sys.exit() in main.py soft-resets MicroPython, which runs boot.py again
+                        reason = str(e) if isinstance(e, machine.SimulatedReset) else \
+                            "sys.exit() at t=%.3fs" % self.clock.seconds()
+                        self.end_reason = reason
+                        if not reboot:
+                            break
+                        self.reboots.append((round(self.clock.seconds(), 3), reason))
+                        self._reboot()
+            except SimulationEnd:
+                self.end_reason = "duration"
+            finally:
+                self.wall_time_s = _host_time.perf_counter() - wall_start
+                if self.trace_heap:
+                    tracemalloc.stop()
+        return self.summary()
+
+    def summary(self):
+        return {
+            "virtual_time_s": round(self.clock.seconds(), 3),
+            "wall_time_s": round(self.wall_time_s, 3),
+            "end_reason": self.end_reason,
+            "reboots": len(self.reboots),
+            "flushes": self.display.recorder.flushes,
+            "distinct_frames": len(self.display.recorder.frames),
+            "draw_calls": dict(sorted(self.display.calls.items())),
+            "mqtt_messages": len(self.broker.messages),
+            "leds": self.leds(),
+        }
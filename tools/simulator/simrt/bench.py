@@ -0,0 +1,157 @@
+"""
+Benchmark runner for firmware code running in the simulation.
+
+Every benchmark is measured in two passes:
+  * a timing pass reporting host operations per second and the virtual time one call takes on the simulated device
+    (event loop iterations, display flushes, sleeps)
+  * an allocation pass with tracemalloc, reporting the bytes allocated by one call on top of what was live before it
+    and the largest such peak. These are CPython object sizes, larger than on MicroPython, so they are meant for
+    comparing runs, not for predicting free heap on the device.
+
+Virtual time and allocations are deterministic, so they are what compare() fails on; host ops/s depends on the
+machine running the benchmark and is only reported.
+"""
+import datetime
+import inspect
+import json
+import platform
+import tracemalloc
+from time import perf_counter
+
+WARMUP_CALLS = 3
+ALLOC_CALLS = 20
+
+# metric -> True if lower is better
+METRICS = {
+    "ops_per_s": False,
+    "virtual_us_per_call": True,
+    "alloc_bytes_per_call": True,
+    "peak_alloc_bytes": True,
+}
+GATED_METRICS = ("virtual_us_per_call", "alloc_bytes_per_call", "peak_alloc_bytes")
+
+
+class Benchmark:
+    """
+    name        - unique name, used as the key in results
+    fn          - function under test, may return a coroutine which is run on the simulated event loop
+    prepare     - called before every call of fn, not measured
+    iterations  - number of calls in the timing pass
+    """
+
+    def __init__(self, name, fn, prepare=None, iterations=200):
+        self.name = name
+        self.fn = fn
+        self.prepare = prepare
+        self.iterations = iterations
+
+
+class Runner:
+    def __init__(self, sim, iteration_scale=1.0):
+        self.sim = sim
+        self.iteration_scale = iteration_scale
+        self.results = {}
+
+    def _call(self, bench):
+        r = bench.fn()
+        if inspect.iscoroutine(r):
+            self.sim.run_until_complete(r)
+
+    def _measure(self, bench):
+        for _ in range(WARMUP_CALLS):
+            if bench.prepare:
+                bench.prepare()
+            self._call(bench)
+
+        iterations = max(1, int(bench.iterations * self.iteration_scale))
+        wall_s = 0
+        virtual_us = 0
+        for _ in range(iterations):
+            if bench.prepare:
+                bench.prepare()
+            v0 = self.sim.clock.now_us
+            t0 = perf_counter()
+            self._call(bench)
+            wall_s += perf_counter() - t0
+            virtual_us += self.sim.clock.now_us - v0
+
+        alloc_total = 0
+        alloc_peak = 0
+        tracemalloc.start()
+        try:
+            for _ in range(ALLOC_CALLS):
+                if bench.prepare:
+                    bench.prepare()
+                before = tracemalloc.get_traced_memory()[0]
+                tracemalloc.reset_peak()
+                self._call(bench)
+                peak = tracemalloc.get_traced_memory()[1] - before
+                alloc_total += peak
+                alloc_peak = max(alloc_peak, peak)
+        finally:
+            tracemalloc.stop()
+
+        return {
+            "iterations": iterations,
+            "ops_per_s": round(iterations / wall_s, 1) if wall_s else None,
+            "virtual_us_per_call": virtual_us // iterations,
+            "alloc_bytes_per_call": alloc_total // ALLOC_CALLS,
+            "peak_alloc_bytes": alloc_peak,
+        }
+
+    def run(self, benchmarks, only=None, progress=None):
+        for bench in benchmarks:
+            if only and not any(pattern in bench.name for pattern in only):
+                continue
+            self.results[bench.name] = self._measure(bench)
+            if progress:
+                progress(bench.name, self.results[bench.name])
+        return self.results
+
+
+def save(fn, results, firmware_version):
+    doc = {
+        "firmware_version": firmware_version,
+        "python": platform.python_version(),
+        "host": platform.machine(),
+        "created": datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "results": results,
+    }
+    with open(fn, "w") as f:
+        json.dump(doc, f, indent=2, sort_keys=True)
+
+
+def load(fn):
+    with open(fn) as f:
+        return json.load(f)
+
+
+def compare(baseline, results, threshold=0.2):
+    """
+    Compares results with a baseline document, returns (lines describing the changes, list of regressions).
+    A regression is a gated metric getting worse by more than threshold (relative).
+    """
+    lines = []
+    regressions = []
+    base_results = baseline["results"]
+    for name, r in results.items():
+        b = base_results.get(name)
+        if b is None:
+            lines.append("%-48s new" % name)
+            continue
+        changes = []
+        for metric, lower_is_better in METRICS.items():
+            old = b.get(metric)
+            new = r.get(metric)
+            if not old or new is None:
+                continue
+            rel = (new - old) / old
+            changes.append("%s %+.0f%%" % (metric, rel * 100))
+            worse = rel > threshold if lower_is_better else rel < -threshold
+            if worse and metric in GATED_METRICS:
+                regressions.append("%s: %s %s -> %s" % (name, metric, old, new))
+        lines.append("%-48s %s" % (name, ", ".join(changes)))
+    for name in base_results:
+        if name not in results:
+            lines.append("%-48s missing" % name)
+    return lines, regressions
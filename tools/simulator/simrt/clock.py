@@ -0,0 +1,149 @@
+"""
+Virtual time for the simulation. Nothing in the simulated firmware ever waits for real time: whenever the event loop
+would block, the clock jumps straight to the next timer, so hours of device time run in seconds.
+"""
+import asyncio
+import selectors
+import time as _host_time
+import types
+
+# ESP32 MicroPython epoch is 2000-01-01, the simulation starts at a fixed wall-clock time so runs are reproducible
+EPOCH_OFFSET = 946684800
+DEFAULT_START_TIME = 1664582400 - EPOCH_OFFSET  # 2022-10-01 00:00:00 UTC
+
+
+class SimulationDeadlock(RuntimeError):
+    pass
+
+
+class VirtualClock:
+    """
+    Simulated time in microseconds since boot. Code doesn't take any virtual time to run by itself, so every event
+    loop iteration is charged step_us (roughly what a uasyncio task switch costs on the ESP32) and the simulated
+    peripherals charge the time their blocking operations take (see e.g. Display.FLUSH_US).
+    """
+
+    def __init__(self, start_time=DEFAULT_START_TIME, step_us=200):
+        self.now_us = 0
+        # the RTC time at boot, set it to 0 for a device whose clock hasn't been set yet
+        self.start_time = start_time
+        # the actual time at boot, as NTP servers tell it
+        self.wall_start_time = start_time
+        self.step_us = step_us
+
+    def advance_us(self, us):
+        if us > 0:
+            self.now_us += us
+
+    def advance_ms(self, ms):
+        self.advance_us(int(ms * 1000))
+
+    def seconds(self):
+        return self.now_us / 1000000
+
+    def ticks_ms(self):
+        return self.now_us // 1000
+
+    def ticks_us(self):
+        return self.now_us
+
+    def time(self):
+        """Seconds since the MicroPython epoch"""
+        return self.start_time + self.now_us // 1000000
+
+    def wall_time(self):
+        """The actual time in seconds since the MicroPython epoch, whatever the RTC is set to"""
+        return self.wall_start_time + self.now_us // 1000000
+
+    def set_time(self, t):
+        """Sets the RTC to t seconds since the MicroPython epoch"""
+        self.start_time = t - self.now_us // 1000000
+
+
+class _VirtualSelector(selectors.BaseSelector):
+    """Polls the real selector without blocking and moves the virtual clock forward instead of sleeping"""
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.selector = selectors.DefaultSelector()
+
+    def register(self, fileobj, events, data=None):
+        return self.selector.register(fileobj, events, data)
+
+    def unregister(self, fileobj):
+        return self.selector.unregister(fileobj)
+
+    def modify(self, fileobj, events, data=None):
+        return self.selector.modify(fileobj, events, data)
+
+    def get_map(self):
+        return self.selector.get_map()
+
+    def close(self):
+        self.selector.close()
+
+    def select(self, timeout=None):
+        self.clock.advance_us(self.clock.step_us)
+        ready = self.selector.select(0)
+        if ready:
+            return ready
+        if timeout is None:
+            raise SimulationDeadlock("all tasks are waiting and no timer is scheduled")
+        self.clock.advance_us(int(timeout * 1000000) - self.clock.step_us)
+        return []
+
+
+class VirtualTimeEventLoop(asyncio.SelectorEventLoop):
+    def __init__(self, clock):
+        super().__init__(_VirtualSelector(clock))
+        self.clock = clock
+
+    def time(self):
+        return self.clock.seconds()
+
+
+def make_utime(clock):
+    """Builds a MicroPython-flavoured `utime` module backed by the virtual clock"""
+    m = types.ModuleType("utime")
+
+    def ticks_diff(a, b):
+        return a - b
+
+    def ticks_add(a, b):
+        return a + b
+
+    def sleep_ms(ms):
+        clock.advance_ms(ms)
+
+    def sleep_us(us):
+        clock.advance_us(us)
+
+    def sleep(s):
+        clock.advance_us(int(s * 1000000))
+
+    def gmtime(secs=None):
+        if secs is None:
+            secs = clock.time()
+        t = _host_time.gmtime(secs + EPOCH_OFFSET)
+        return (t.tm_year, t.tm_mon, t.tm_mday, t.tm_hour, t.tm_min, t.tm_sec, t.tm_wday, t.tm_yday)
+
+    def mktime(t):
+        return int(_host_time.mktime(tuple(t[:8]) + (0,)) - _host_time.timezone) - EPOCH_OFFSET
+
+    def time_ns():
+        return (clock.start_time + EPOCH_OFFSET) * 1000000000 + clock.now_us * 1000
+
+    m.ticks_ms = clock.ticks_ms
+    m.ticks_us = clock.ticks_us
+    m.ticks_cpu = clock.ticks_us
+    m.ticks_diff = ticks_diff
+    m.ticks_add = ticks_add
+    m.sleep = sleep
+    m.sleep_ms = sleep_ms
+    m.sleep_us = sleep_us
+    m.time = clock.time
+    m.time_ns = time_ns
+    m.gmtime = gmtime
+    m.localtime = gmtime
+    m.mktime = mktime
+    return m
@@ -0,0 +1,202 @@
+"""
+Simulated badge.team-style `display` module for the 128x64 monochrome OLED. The firmware imports `display` as a
+module and calls its functions, so the simulation registers a Display instance under that name.
+
+Text and PNG images are rendered with Pillow when it is installed; without it the draw calls are still counted but
+leave no pixels, which is enough for timing and benchmarks.
+"""
+import io
+import os
+import re
+
+try:
+    from PIL import Image, ImageDraw, ImageFont
+except ImportError:
+    Image = None
+
+WIDTH = 128
+HEIGHT = 64
+
+DEFAULT_FONT_SIZE = 8
+
+
+def _font_size(font):
+    """Pixel height of a firmware font name, e.g. "graphik_bold20" -> 20"""
+    if not font:
+        return DEFAULT_FONT_SIZE
+    m = re.search(r"(\d+)$", font)
+    return int(m.group(1)) if m else DEFAULT_FONT_SIZE
+
+
+def _is_set(color):
+    return (color & 0xffffff) != 0
+
+
+class FrameRecorder:
+    """Keeps every distinct frame pushed to the panel, optionally writing them to a directory as PBM images"""
+
+    def __init__(self, out_dir=None):
+        self.out_dir = out_dir
+        self.flushes = 0
+        self.frames = []  # (ticks_ms, framebuffer bytes)
+        self.last = None
+        if out_dir:
+            os.makedirs(out_dir, exist_ok=True)
+
+    def record(self, ticks_ms, fb):
+        self.flushes += 1
+        if fb == self.last:
+            return
+        self.last = bytes(fb)
+        self.frames.append((ticks_ms, self.last))
+        if self.out_dir:
+            fn = os.path.join(self.out_dir, "frame-%05d-%09dms.pbm" % (len(self.frames), ticks_ms))
+            with open(fn, "wb") as f:
+                f.write(to_pbm(self.last))
+
+
+def to_pbm(fb):
+    out = bytearray(b"P4\n%d %d\n" % (WIDTH, HEIGHT))
+    for y in range(HEIGHT):
+        row = fb[y * WIDTH:(y + 1) * WIDTH]
+        for x in range(0, WIDTH, 8):
+            b = 0
+            for bit in range(8):
+                if row[x + bit]:
+                    b |= 0x80 >> bit
+            out.append(b)
+    return bytes(out)
+
+
+class Display:
+    # pushing the 1 KiB framebuffer over 400 kHz I2C blocks for about this long
+    FLUSH_US = 25000
+
+    def __init__(self, clock, recorder=None):
+        self.clock = clock
+        self.recorder = recorder or FrameRecorder()
+        self.fb = bytearray(WIDTH * HEIGHT)
+        # draw call name -> number of calls, benchmarks use it to see how much work a frame does
+        self.calls = {}
+        self._fonts = {}
+
+    def _count(self, name):
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    def _set(self, x, y, on):
+        if 0 <= x < WIDTH and 0 <= y < HEIGHT:
+            self.fb[y * WIDTH + x] = 1 if on else 0
+
+    def width(self):
+        return WIDTH
+
+    def height(self):
+        return HEIGHT
+
+    def flush(self, *args):
+        self._count("flush")
+        self.clock.advance_us(self.FLUSH_US)
+        self.recorder.record(self.clock.ticks_ms(), self.fb)
+
+    def drawFill(self, color=0):
+        self._count("drawFill")
+        self.fb[:] = (b"\x01" if _is_set(color) else b"\x00") * len(self.fb)
+
+    def drawPixel(self, x, y, color):
+        self._count("drawPixel")
+        self._set(x, y, _is_set(color))
+
+    def drawLine(self, x0, y0, x1, y1, color):
+        self._count("drawLine")
+        on = _is_set(color)
+        dx = abs(x1 - x0)
+        dy = -abs(y1 - y0)
+        sx = 1 if x0 < x1 else -1
+        sy = 1 if y0 < y1 else -1
+        err = dx + dy
+        while True:
+            self._set(x0, y0, on)
+            if x0 == x1 and y0 == y1:
+                break
+            e2 = 2 * err
+            if e2 >= dy:
+                err += dy
+                x0 += sx
+            if e2 <= dx:
+                err += dx
+                y0 += sy
+
+    def drawRect(self, x, y, w, h, fill, color):
+        self._count("drawRect")
+        on = _is_set(color)
+        for yy in range(y, y + h):
+            for xx in range(x, x + w):
+                if fill or yy in (y, y + h - 1) or xx in (x, x + w - 1):
+                    self._set(xx, yy, on)
+
+    def drawCircle(self, x0, y0, radius, a0, a1, fill, color):
+        self._count("drawCircle")
+        on = _is_set(color)
+        r2 = radius * radius
+        for yy in range(-radius, radius + 1):
+            for xx in range(-radius, radius + 1):
+                d2 = xx * xx + yy * yy
+                if d2 <= r2 and (fill or d2 > (radius - 1) * (radius - 1)):
+                    self._set(x0 + xx, y0 + yy, on)
+
+    def getTextWidth(self, text, font=None):
+        return len(text) * max(1, _font_size(font) * 3 // 4)
+
+    def getTextHeight(self, text, font=None):
+        return _font_size(font)
+
+    def _font(self, size):
+        if size not in self._fonts:
+            try:
+                self._fonts[size] = ImageFont.load_default(size=size)
+            except TypeError:
+                # Pillow < 10.1 only has the fixed-size bitmap font
+                self._fonts[size] = ImageFont.load_default()
+        return self._fonts[size]
+
+    def drawText(self, x, y, text, color=0xffffff, font=None, x_scale=1, y_scale=1):
+        self._count("drawText")
+        if Image is None or not text:
+            return
+        w = self.getTextWidth(text, font)
+        h = self.getTextHeight(text, font)
+        im = Image.new("1", (w, h))
+        ImageDraw.Draw(im).text((0, 0), text, fill=1, font=self._font(h))
+        self._blit_image(x, y, im, _is_set(color))
+
+    def drawPng(self, x, y, png):
+        self._count("drawPng")
+        if Image is None:
+            return
+        if isinstance(png, str):
+            im = Image.open(png)
+        else:
+            im = Image.open(io.BytesIO(bytes(png)))
+        im = im.convert("LA")
+        pixels = im.load()
+        for yy in range(im.size[1]):
+            for xx in range(im.size[0]):
+                lum, alpha = pixels[xx, yy]
+                if alpha >= 128:
+                    self._set(x + xx, y + yy, lum >= 128)
+
+    def drawRaw(self, x, y, w, h, data):
+        """Blits a MONO_HLSB bitmap, set bits are drawn white and clear bits black"""
+        self._count("drawRaw")
+        row_bytes = (w + 7) // 8
+        for yy in range(h):
+            row = yy * row_bytes
+            for xx in range(w):
+                self._set(x + xx, y + yy, data[row + xx // 8] & (0x80 >> (xx % 8)))
+
+    def _blit_image(self, x, y, im, on):
+        pixels = im.load()
+        for yy in range(im.size[1]):
+            for xx in range(im.size[0]):
+                if pixels[xx, yy]:
+                    self._set(x + xx, y + yy, on)
@@ -0,0 +1,352 @@
+"""
+The Internet hosts the firmware talks to, registered on the simulated network. They are only reachable while the
+device is connected to a WiFi network with Internet access (Simulation(internet=True)). An OTA mirror on the local
+network (tools/ota-mirror) can be added with Internet.add_lan_mirror().
+"""
+import asyncio
+import email.utils
+import hashlib
+import importlib.util
+import io
+import json
+import os
+import re
+import tarfile
+import tempfile
+
+ONE_ONE_ONE_ONE = "1.1.1.1"
+
+GAISASARGS_HOST = "gaisasargs.lv"
+GAISASARGS_ADDRESS = "185.7.252.10"
+
+GITHUB_REPO = "open-lv/air-guard"
+GITHUB_API_HOST = "api.github.com"
+GITHUB_API_ADDRESS = "140.82.121.6"
+GITHUB_HOST = "github.com"
+GITHUB_ADDRESS = "140.82.121.4"
+# release downloads redirect here
+GITHUB_OBJECTS_HOST = "objects.githubusercontent.com"
+GITHUB_OBJECTS_ADDRESS = "185.199.108.133"
+
+NTP_HOST = "pool.ntp.org"
+NTP_ADDRESS = "194.58.204.20"
+
+MQTT_HOST = "mqtt.gaisasargs.lv"
+MQTT_ADDRESS = "185.7.252.11"
+MQTT_PORT = 1883
+
+# tools/ota-mirror on the local network
+LAN_MIRROR_ADDRESS = "10.0.0.5"
+LAN_MIRROR_PORT = 8080
+LAN_MIRROR_URL = "http://%s:%d" % (LAN_MIRROR_ADDRESS, LAN_MIRROR_PORT)
+
+# how long a stalled response keeps the connection open, see HttpServer.stall_responses()
+STALL_S = 3600
+
+FLASHER_DIR = os.path.join(os.path.dirname(__file__), "..", "..", "flasher")
+
+REASONS = {
+    200: "OK",
+    206: "Partial Content",
+    301: "Moved Permanently",
+    302: "Found",
+    304: "Not Modified",
+    400: "Bad Request",
+    404: "Not Found",
+    416: "Range Not Satisfiable",
+    500: "Internal Server Error",
+    503: "Service Unavailable",
+}
+
+
+class Request:
+    def __init__(self, method, path, headers, body):
+        self.method = method
+        self.path = path
+        # lower case header name -> value
+        self.headers = headers
+        self.body = body
+
+
+class Response:
+    def __init__(self, status=200, body=b"", headers=None):
+        self.status = status
+        self.body = body.encode() if isinstance(body, str) else body
+        self.headers = headers or {}
+
+
+class HttpServer:
+    """
+    A small HTTP/1.1 origin server. Routes map a path to a handler(request) returning a Response; every request
+    is answered with Content-Length and the connection is closed afterwards.
+    """
+
+    def __init__(self):
+        self.routes = {}
+        # (method, path, headers, status) of every request received, for tests and reports
+        self.requests = []
+        # body sizes the next responses are cut at
+        self.truncations = []
+        # body sizes after which the next responses stop sending, the connection staying open
+        self.stalls = []
+
+    def route(self, path, handler):
+        self.routes[path] = handler
+
+    def truncate_responses(self, *sizes):
+        """Closes the connection of the next responses after sizes[i] bytes of the body, like a dropped connection"""
+        self.truncations.extend(sizes)
+
+    def stall_responses(self, *sizes):
+        """Stops sending the next responses after sizes[i] bytes of the body without closing, like a stalled link"""
+        self.stalls.extend(sizes)
+
+    def static(self, path, body, content_type="application/octet-stream"):
+        self.route(path, lambda request: ranged(request, Response(200, body, {"Content-Type": content_type})))
+
+    async def handle(self, stream):
+        try:
+            request = await self._read_request(stream)
+            if request is None:
+                return
+            handler = self.routes.get(request.path.split("?")[0])
+            response = handler(request) if handler else Response(404, b"Not Found")
+            self.requests.append((request.method, request.path, request.headers, response.status))
+            head = "HTTP/1.1 %d %s\r\n" % (response.status, REASONS.get(response.status, ""))
+            headers = dict(response.headers)
+            headers["Content-Length"] = str(len(response.body))
+            headers["Connection"] = "close"
+            for name, value in headers.items():
+                head += "%s: %s\r\n" % (name, value)
+            stream.write(head.encode() + b"\r\n")
+            stall = self.stalls.pop(0) if self.stalls else None
+            if request.method != "HEAD":
+                body = response.body[:self.truncations.pop(0)] if self.truncations else response.body
+                stream.write(body[:stall] if stall is not None else body)
+            await stream.drain()
+            if stall is not None:
+                await asyncio.sleep(STALL_S)
+        finally:
+            stream.close()
+
+    async def _read_request(self, stream):
+        line = await stream.readline()
+        if not line:
+            return None
+        (method, path, _) = line.decode("latin1").split(" ", 2)
+        headers = {}
+        while True:
+            line = await stream.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            (name, _, value) = line.decode("latin1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        body = b""
+        if "content-length" in headers:
+            body = await stream.readexactly(int(headers["content-length"]))
+        return Request(method, path, headers, body)
+
+
+def conditional(request, response, modified_s):
+    """
+    Adds ETag and Last-Modified (modified_s being a Unix timestamp) to a 200 response and turns it into
+    "304 Not Modified" if the request's If-None-Match/If-Modified-Since show the client already has it
+    """
+    etag = '"%s"' % hashlib.sha1(response.body).hexdigest()[:16]
+    last_modified = email.utils.formatdate(modified_s, usegmt=True)
+    response.headers["ETag"] = etag
+    response.headers["Last-Modified"] = last_modified
+    if "if-none-match" in request.headers:
+        not_modified = request.headers["if-none-match"] == etag
+    elif "if-modified-since" in request.headers:
+        since = email.utils.parsedate_to_datetime(request.headers["if-modified-since"]).timestamp()
+        not_modified = modified_s <= since
+    else:
+        not_modified = False
+    if not_modified:
+        return Response(304, b"", {"ETag": etag, "Last-Modified": last_modified})
+    return response
+
+
+def ranged(request, response):
+    """Answers a "Range: bytes=start-[end]" request for a 200 response with "206 Partial Content" """
+    m = re.match(r"bytes=(\d+)-(\d*)$", request.headers.get("range", ""))
+    if not m or response.status != 200:
+        return response
+    size = len(response.body)
+    start = int(m.group(1))
+    end = min(int(m.group(2)) if m.group(2) else size - 1, size - 1)
+    if start >= size:
+        return Response(416, b"", {"Content-Range": "bytes */%d" % size})
+    headers = dict(response.headers)
+    headers["Content-Range"] = "bytes %d-%d/%d" % (start, end, size)
+    return Response(206, response.body[start:end + 1], headers)
+
+
+async def _accept_and_close(stream):
+    stream.close()
+
+
+def firmware_version(firmware_dir):
+    """Returns the release tag of a firmware directory or build, e.g. "micropython-1.2.3" """
+    try:
+        with open(firmware_dir + "/original/airguardversion.py") as f:
+            m = re.search(r"VERSION\s*=\s*['\"]([^'\"]+)['\"]", f.read())
+            if m:
+                return m.group(1)
+    except OSError:
+        pass
+    return "micropython-UNKNOWN"
+
+
+def _flasher_tool(script):
+    """Imports one of the tools/flasher scripts the release workflow runs"""
+    spec = importlib.util.spec_from_file_location(script.replace("-", "_")[:-3], os.path.join(FLASHER_DIR, script))
+    m = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(m)
+    return m
+
+
+def release_package(firmware_dir, tag):
+    """
+    Builds the OTA assets of a release from a firmware directory like the release workflow does: the contents of
+    original/ with airguardversion.py set to tag as micropython.tar, gzip-compressed as micropython.tar.gz, and the
+    delta update manifest.json. Returns asset name -> contents.
+    """
+    original_dir = os.path.join(firmware_dir, "original")
+    tar_buf = io.BytesIO()
+    # plain USTAR, utarfile doesn't understand PAX or GNU extension headers
+    with tarfile.open(fileobj=tar_buf, mode="w", format=tarfile.USTAR_FORMAT) as tar:
+        for dir_path, dir_names, file_names in os.walk(original_dir):
+            dir_names[:] = sorted(d for d in dir_names if d != "__pycache__")
+            for file_name in sorted(file_names):
+                path = os.path.join(dir_path, file_name)
+                name = os.path.relpath(path, original_dir).replace(os.sep, "/")
+                if name == "airguardversion.py":
+                    data = ("VERSION='%s'\n" % tag).encode()
+                else:
+                    with open(path, "rb") as f:
+                        data = f.read()
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+    package = tar_buf.getvalue()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        src = os.path.join(tmp_dir, "micropython.tar")
+        with open(src, "wb") as f:
+            f.write(package)
+        _flasher_tool("compress-package.py").compress(src, src + ".gz")
+        with open(src + ".gz", "rb") as f:
+            compressed = f.read()
+        manifest = _flasher_tool("make-manifest.py").make_manifest(src)
+    return {
+        "micropython.tar": package,
+        "micropython.tar.gz": compressed,
+        "manifest.json": json.dumps(manifest).encode(),
+    }
+
+
+class Internet:
+    """
+    latest_release - tag served by https://gaisasargs.lv/latest_release, change it with set_latest_release()
+
+    GitHub serves the releases published with add_release() for OTA updates, the LAN mirror (if added) those it
+    has synced.
+    """
+
+    # Unix time the initial latest release was published
+    RELEASE_TIME = 1664582400
+
+    def __init__(self, net, latest_release):
+        self.net = net
+        self.latest_release = latest_release
+        self.latest_release_time = self.RELEASE_TIME
+
+        # the connectivity check only opens a TCP connection to 1.1.1.1:53
+        net.add_host(ONE_ONE_ONE_ONE, 53, _accept_and_close, public=True)
+        # NTP is answered by usocket, see VirtualNetwork.ntp_answer()
+        net.add_dns(NTP_HOST, NTP_ADDRESS)
+
+        self.gaisasargs = HttpServer()
+        self.gaisasargs.route("/latest_release", self._latest_release)
+        net.add_dns(GAISASARGS_HOST, GAISASARGS_ADDRESS)
+        net.add_host(GAISASARGS_ADDRESS, 443, self.gaisasargs.handle, public=True)
+
+        # newest first, like the GitHub API lists them
+        self.releases = []
+        # tag -> asset name -> contents
+        self.release_assets = {}
+        self.lan_mirror = None
+        self.github_api = HttpServer()
+        self.github_api.route("/repos/%s/releases" % GITHUB_REPO, self._releases)
+        net.add_dns(GITHUB_API_HOST, GITHUB_API_ADDRESS)
+        net.add_host(GITHUB_API_ADDRESS, 443, self.github_api.handle, public=True)
+        self.github = HttpServer()
+        net.add_dns(GITHUB_HOST, GITHUB_ADDRESS)
+        net.add_host(GITHUB_ADDRESS, 443, self.github.handle, public=True)
+        self.github_objects = HttpServer()
+        net.add_dns(GITHUB_OBJECTS_HOST, GITHUB_OBJECTS_ADDRESS)
+        net.add_host(GITHUB_OBJECTS_ADDRESS, 443, self.github_objects.handle, public=True)
+
+    def add_mqtt_broker(self, broker):
+        self.net.add_dns(MQTT_HOST, MQTT_ADDRESS)
+        self.net.add_host(MQTT_ADDRESS, MQTT_PORT, broker.handle, public=True)
+
+    def set_latest_release(self, tag, released_s):
+        self.latest_release = tag
+        self.latest_release_time = released_s
+
+    def add_release(self, tag, assets, published_s=None):
+        """Publishes a GitHub release with assets (name -> contents), e.g. from release_package()"""
+        published_s = self.RELEASE_TIME if published_s is None else published_s
+        release = {
+            "tag_name": tag,
+            "name": tag,
+            "published_at": email.utils.formatdate(published_s, usegmt=True),
+            "body": "",
+            "assets": [],
+        }
+        for name, data in assets.items():
+            download_path = "/%s/releases/download/%s/%s" % (GITHUB_REPO, tag, name)
+            object_path = "/%s/%s" % (hashlib.sha1(data).hexdigest(), name)
+            self.github.route(download_path, lambda request, path=object_path: Response(
+                302, b"", {"Location": "https://%s%s" % (GITHUB_OBJECTS_HOST, path)}))
+            self.github_objects.static(object_path, data)
+            release["assets"].append({
+                "name": name,
+                "size": len(data),
+                "browser_download_url": "https://%s%s" % (GITHUB_HOST, download_path),
+            })
+        self.releases.insert(0, release)
+        self.release_assets[tag] = assets
+
+    def _releases(self, request):
+        return Response(200, json.dumps(self.releases), {"Content-Type": "application/json"})
+
+    def add_lan_mirror(self, tags=None):
+        """
+        Starts an OTA mirror on the local network serving the releases published so far (or those in tags) like
+        tools/ota-mirror does, at LAN_MIRROR_URL. The device only uses it with otaMirrorUrl configured. Returns its
+        HttpServer.
+        """
+        releases = []
+        self.lan_mirror = HttpServer()
+        for release in self.releases:
+            tag = release["tag_name"]
+            if tags is not None and tag not in tags:
+                continue
+            release = dict(release, assets=[])
+            for name, data in self.release_assets[tag].items():
+                path = "/%s/%s" % (tag, name)
+                self.lan_mirror.static(path, data)
+                release["assets"].append({"name": name, "size": len(data), "browser_download_url": LAN_MIRROR_URL + path})
+            releases.append(release)
+        self.lan_mirror.route("/repos/%s/releases" % GITHUB_REPO, lambda request: Response(
+            200, json.dumps(releases), {"Content-Type": "application/json"}))
+        self.net.add_host(LAN_MIRROR_ADDRESS, LAN_MIRROR_PORT, self.lan_mirror.handle)
+        return self.lan_mirror
+
+    def _latest_release(self, request):
+        response = Response(200, self.latest_release + "\n", {"Content-Type": "text/plain"})
+        return conditional(request, response, self.latest_release_time)
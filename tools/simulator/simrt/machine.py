@@ -0,0 +1,235 @@
+"""
+Simulated `machine` module. Pins remember their state and can be driven by the simulation (e.g. button presses),
+PWM channels record their duty so LEDs and the buzzer can be inspected, the ADC returns a settable value.
+"""
+import calendar
+import time as _host_time
+
+import simrt
+from .clock import EPOCH_OFFSET
+
+
+class SimulatedReset(SystemExit):
+    """Raised by machine.reset(), ends the simulation run"""
+
+
+class Pin:
+    IN = 1
+    OUT = 3
+    OPEN_DRAIN = 7
+    PULL_UP = 2
+    PULL_DOWN = 1
+    IRQ_RISING = 1
+    IRQ_FALLING = 2
+
+    # pin number -> Pin, so the simulation can drive inputs
+    pins = {}
+
+    def __init__(self, id, mode=-1, pull=-1, value=None):
+        self.id = id
+        self.mode = mode
+        self.pull = pull
+        existing = Pin.pins.get(id)
+        self._value = existing._value if existing else (1 if pull == Pin.PULL_UP else 0)
+        self._irq_handler = existing._irq_handler if existing else None
+        self._irq_trigger = existing._irq_trigger if existing else 0
+        if value is not None:
+            self._value = 1 if value else 0
+        Pin.pins[id] = self
+
+    def init(self, mode=-1, pull=-1, value=None):
+        if value is not None:
+            self._value = 1 if value else 0
+
+    def value(self, *args):
+        if args:
+            self._value = 1 if args[0] else 0
+            return None
+        return self._value
+
+    def __call__(self, *args):
+        return self.value(*args)
+
+    def on(self):
+        self._value = 1
+
+    def off(self):
+        self._value = 0
+
+    def irq(self, handler=None, trigger=IRQ_FALLING | IRQ_RISING, hard=False):
+        self._irq_handler = handler
+        self._irq_trigger = trigger
+
+    def sim_drive(self, value):
+        """Changes an input from outside of the firmware, firing the IRQ handler on a matching edge"""
+        value = 1 if value else 0
+        if value == self._value:
+            return
+        self._value = value
+        edge = Pin.IRQ_RISING if value else Pin.IRQ_FALLING
+        if self._irq_handler is not None and self._irq_trigger & edge:
+            self._irq_handler(self)
+
+
+class Signal:
+    def __init__(self, pin, invert=False):
+        self.pin = pin
+        self.invert = invert
+
+    def value(self, *args):
+        if args:
+            self.pin.value(bool(args[0]) != self.invert)
+            return None
+        return self.pin.value() != self.invert
+
+    def on(self):
+        self.value(1)
+
+    def off(self):
+        self.value(0)
+
+
+class PWM:
+    # pin number -> PWM, so the simulation can inspect LEDs and the buzzer
+    channels = {}
+
+    def __init__(self, pin, freq=None, duty=None):
+        self.pin = pin
+        self._freq = 5000
+        self._duty = 0
+        self.init(freq=freq, duty=duty)
+        PWM.channels[pin.id] = self
+
+    def init(self, freq=None, duty=None):
+        if freq is not None:
+            self._freq = freq
+        if duty is not None:
+            self._duty = duty
+
+    def deinit(self):
+        self._duty = 0
+
+    def freq(self, *args):
+        if args:
+            self._freq = args[0]
+            return None
+        return self._freq
+
+    def duty(self, *args):
+        if args:
+            self._duty = args[0]
+            return None
+        return self._duty
+
+
+class ADC:
+    ATTN_0DB = 0
+    ATTN_2_5DB = 1
+    ATTN_6DB = 2
+    ATTN_11DB = 3
+    WIDTH_9BIT = 0
+    WIDTH_10BIT = 1
+    WIDTH_11BIT = 2
+    WIDTH_12BIT = 3
+
+    # pin number -> raw 12-bit reading returned by read()
+    levels = {}
+
+    def __init__(self, pin, atten=None):
+        self.pin = pin
+
+    def atten(self, atten):
+        pass
+
+    def width(self, width):
+        pass
+
+    def read(self):
+        return ADC.levels.get(self.pin.id, 2048)
+
+    def read_u16(self):
+        return self.read() << 4
+
+
+class I2C:
+    def __init__(self, id, scl=None, sda=None, freq=400000):
+        self.id = id
+
+    def scan(self):
+        return [0x3c]
+
+    def readfrom(self, addr, nbytes, stop=True):
+        if addr not in self.scan():
+            raise OSError(19)  # ENODEV
+        return bytes(nbytes)
+
+    def writeto(self, addr, buf, stop=True):
+        if addr not in self.scan():
+            raise OSError(19)
+        return len(buf)
+
+
+class UART:
+    """UART without a peer, the CO2 sensor is simulated above the UART (see simrt.sensor)"""
+
+    def __init__(self, id, baudrate=9600, **kwargs):
+        self.id = id
+
+    def any(self):
+        return 0
+
+    def read(self, nbytes=-1):
+        return None
+
+    def write(self, buf):
+        return len(buf)
+
+
+class WDT:
+    """Resets the device when it isn't fed for timeout ms of virtual time, it can't be stopped (like on the ESP32)"""
+
+    def __init__(self, id=0, timeout=5000):
+        self.timeout = timeout
+        self._handle = None
+        self.feed()
+
+    def feed(self):
+        if self._handle:
+            self._handle.cancel()
+        self._handle = simrt.sim.loop.call_later(self.timeout / 1000, reset)
+
+
+class RTC:
+    """Setting the date moves the wall-clock time of the virtual clock, the ticks keep counting from boot"""
+
+    def datetime(self, t=None):
+        if t is None:
+            tm = _host_time.gmtime(simrt.sim.clock.time() + EPOCH_OFFSET)
+            return (tm.tm_year, tm.tm_mon, tm.tm_mday, tm.tm_wday + 1, tm.tm_hour, tm.tm_min, tm.tm_sec, 0)
+        simrt.sim.clock.set_time(calendar.timegm((t[0], t[1], t[2], t[4], t[5], t[6])) - EPOCH_OFFSET)
+
+
+def unique_id():
+    return simrt.sim.machine_id
+
+
+def reset():
+    raise SimulatedReset("machine.reset() at t=%.3fs" % simrt.sim.clock.seconds())
+
+
+def soft_reset():
+    reset()
+
+
+def freq(*args):
+    return 240000000
+
+
+def idle():
+    pass
+
+
+def reset_sim_state():
+    Pin.pins.clear()
+    PWM.channels.clear()
+    ADC.levels.clear()
@@ -0,0 +1,31 @@
+"""Simulated `micropython` module, scheduled callbacks run on the event loop like they do between bytecodes"""
+import simrt
+
+
+def const(v):
+    return v
+
+
+def schedule(func, arg):
+    simrt.sim.loop.call_soon(func, arg)
+
+
+def alloc_emergency_exception_buf(size):
+    pass
+
+
+def heap_lock():
+    pass
+
+
+def heap_unlock():
+    pass
+
+
+def mem_info(*args):
+    print("stack: 0 out of 15360\nGC: total: %d, used: %d, free: %d" % (
+        simrt.sim.heap_size, simrt.sim.heap_size - simrt.sim.mem_free(), simrt.sim.mem_free()))
+
+
+def opt_level(*args):
+    return 0
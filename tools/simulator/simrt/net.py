@@ -0,0 +1,201 @@
+"""
+In-memory network for the simulation. Hosts are registered with an async connection handler; connecting to a host
+gives both ends a uasyncio-style Stream. Connections to unknown hosts fail like they do on a device without Internet.
+"""
+import asyncio
+import errno
+import struct
+
+
+class _Pipe:
+    def __init__(self):
+        self.buf = bytearray()
+        self.closed = False
+        self.readable = asyncio.Event()
+
+    def feed(self, data):
+        self.buf += data
+        self.readable.set()
+
+    def close(self):
+        self.closed = True
+        self.readable.set()
+
+    async def wait(self):
+        while not self.buf and not self.closed:
+            self.readable.clear()
+            await self.readable.wait()
+
+
+class Stream:
+    """One end of a connection with the uasyncio v3 Stream API (used both as reader and writer)"""
+
+    def __init__(self, rx, tx, peer):
+        self.rx = rx
+        self.tx = tx
+        self.peer = peer
+        # tinyweb uses the underlying socket as the connection id
+        self.s = self
+
+    def get_extra_info(self, name):
+        if name == "peername":
+            return self.peer
+        return None
+
+    async def read(self, n=-1):
+        await self.rx.wait()
+        if n < 0:
+            n = len(self.rx.buf)
+        data = bytes(self.rx.buf[:n])
+        del self.rx.buf[:n]
+        return data
+
+    async def readinto(self, buf):
+        data = await self.read(len(buf))
+        buf[:len(data)] = data
+        return len(data)
+
+    async def readexactly(self, n):
+        data = b""
+        while len(data) < n:
+            chunk = await self.read(n - len(data))
+            if not chunk:
+                raise EOFError
+            data += chunk
+        return data
+
+    async def readline(self):
+        line = b""
+        while True:
+            await self.rx.wait()
+            idx = self.rx.buf.find(b"\n")
+            if idx >= 0:
+                line += bytes(self.rx.buf[:idx + 1])
+                del self.rx.buf[:idx + 1]
+                return line
+            if self.rx.closed:
+                line += bytes(self.rx.buf)
+                self.rx.buf = bytearray()
+                return line
+            line += bytes(self.rx.buf)
+            self.rx.buf = bytearray()
+
+    def write(self, buf):
+        if self.tx.closed:
+            raise OSError(errno.ECONNRESET)
+        if isinstance(buf, str):
+            buf = buf.encode()
+        self.tx.feed(buf)
+
+    async def drain(self):
+        await asyncio.sleep(0)
+
+    async def awrite(self, buf, off=0, sz=-1):
+        if sz == -1:
+            sz = len(buf) - off
+        self.write(buf[off:off + sz])
+        await self.drain()
+
+    async def awritestr(self, s):
+        await self.awrite(s.encode())
+
+    def close(self):
+        self.tx.close()
+        self.rx.close()
+
+    async def wait_closed(self):
+        await asyncio.sleep(0)
+
+    async def aclose(self):
+        self.close()
+        await self.wait_closed()
+
+
+def stream_pair(client_addr, server_addr):
+    a = _Pipe()
+    b = _Pipe()
+    return Stream(a, b, server_addr), Stream(b, a, client_addr)
+
+
+class VirtualNetwork:
+    # latency of establishing a connection, in seconds
+    CONNECT_LATENCY = 0.02
+
+    def __init__(self):
+        # (host, port) -> async handler(stream)
+        self.hosts = {}
+        # hosts on the Internet, only reachable while online
+        self.public = set()
+        # hostname -> IPv4 address
+        self.dns = {}
+        self.online = False
+        self.connections = 0
+        self.dns_queries = 0
+        # set to simulate a network that drops NTP traffic
+        self.ntp_blocked = False
+
+    def add_host(self, host, port, handler, public=False):
+        self.hosts[(host, port)] = handler
+        if public:
+            self.public.add((host, port))
+
+    def remove_host(self, host, port):
+        self.hosts.pop((host, port), None)
+        self.public.discard((host, port))
+
+    def add_dns(self, hostname, address):
+        self.dns[hostname] = address
+
+    def resolve(self, host):
+        """Returns the address of host, which may already be an address, or None if it can't be resolved"""
+        parts = host.split(".")
+        if len(parts) == 4 and all(p.isdigit() for p in parts):
+            return host
+        return self.dns.get(host) if self.online else None
+
+    def dns_answer(self, query):
+        """Builds the response to a DNS query packet, as a DNS server on the Internet would"""
+        self.dns_queries += 1
+        (query_id, _, qdcount) = struct.unpack_from("!HHH", query)
+        pos = 12
+        labels = []
+        while query[pos]:
+            labels.append(query[pos + 1:pos + 1 + query[pos]].decode())
+            pos += query[pos] + 1
+        question = query[12:pos + 5]
+        address = self.dns.get(".".join(labels))
+        if address is None:
+            # NXDOMAIN
+            return struct.pack("!HHHHHH", query_id, 0x8183, 1, 0, 0, 0) + question
+        answer = b"\xc0\x0c" + struct.pack("!HHIH", 1, 1, 300, 4) + bytes(int(p) for p in address.split("."))
+        return struct.pack("!HHHHHH", query_id, 0x8180, 1, 1, 0, 0) + question + answer
+
+    def ntp_answer(self, query, now_s):
+        """Builds the response to an NTP query packet at now_s seconds since the MicroPython epoch"""
+        # leap indicator 0, version 3, server mode, stratum 1, transmit timestamp in seconds since 1900
+        return struct.pack("!BB", 0x1c, 1) + bytes(38) + struct.pack("!II", now_s + 3155673600, 0)
+
+    async def open_connection(self, host, port):
+        await asyncio.sleep(self.CONNECT_LATENCY)
+        host = self.resolve(host) or host
+        handler = self.hosts.get((host, port))
+        if (host, port) in self.public and not self.online:
+            handler = None
+        if handler is None:
+            raise OSError(errno.EHOSTUNREACH if not self.online else errno.ECONNREFUSED)
+        self.connections += 1
+        client, server = stream_pair(("10.0.0.2", 49152 + self.connections), (host, port))
+        asyncio.get_event_loop().create_task(handler(server))
+        return client, client
+
+    async def request(self, host, port, raw):
+        """Sends a raw request to a host and returns everything it writes back before closing the connection"""
+        reader, writer = await self.open_connection(host, port)
+        await writer.awrite(raw)
+        response = b""
+        while True:
+            chunk = await reader.read(4096)
+            if not chunk:
+                break
+            response += chunk
+        return response
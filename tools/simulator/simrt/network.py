@@ -0,0 +1,93 @@
+"""
+Simulated `network` module. Station connections succeed after CONNECT_TIME_S of virtual time when the SSID and
+password match one of the networks configured for the simulation (Simulation.wifi_networks).
+"""
+import simrt
+
+STA_IF = 0
+AP_IF = 1
+
+AUTH_OPEN = 0
+AUTH_WPA2_PSK = 3
+
+STAT_IDLE = 1000
+STAT_CONNECTING = 1001
+STAT_GOT_IP = 1010
+STAT_NO_AP_FOUND = 201
+STAT_WRONG_PASSWORD = 202
+
+CONNECT_TIME_S = 2
+
+STA_IP = "10.0.0.2"
+AP_IP = "192.168.4.1"
+
+
+class WLAN:
+    # interface -> shared state, like on the device every WLAN(STA_IF) refers to the same interface
+    _state = {}
+
+    def __init__(self, interface_id=STA_IF):
+        self.interface_id = interface_id
+        if interface_id not in WLAN._state:
+            WLAN._state[interface_id] = {"active": False, "essid": "", "connect_at": None, "status": STAT_IDLE}
+        self.st = WLAN._state[interface_id]
+
+    def active(self, *args):
+        if args:
+            self.st["active"] = bool(args[0])
+            if not args[0]:
+                self.disconnect()
+            return None
+        return self.st["active"]
+
+    def connect(self, ssid=None, password=None, **kwargs):
+        networks = simrt.sim.wifi_networks
+        self.st["essid"] = ssid
+        if ssid not in networks:
+            self.st["status"] = STAT_NO_AP_FOUND
+        elif networks[ssid] != password:
+            self.st["status"] = STAT_WRONG_PASSWORD
+        else:
+            self.st["status"] = STAT_CONNECTING
+            self.st["connect_at"] = simrt.sim.clock.seconds() + CONNECT_TIME_S
+
+    def disconnect(self):
+        self.st["status"] = STAT_IDLE
+        self.st["connect_at"] = None
+        simrt.sim.net.online = False
+
+    def status(self, *args):
+        if args:
+            return None
+        if self.st["status"] == STAT_CONNECTING and simrt.sim.clock.seconds() >= self.st["connect_at"]:
+            self.st["status"] = STAT_GOT_IP
+            simrt.sim.net.online = simrt.sim.internet
+        return self.st["status"]
+
+    def isconnected(self):
+        if self.interface_id == AP_IF:
+            return self.st["active"]
+        return self.st["active"] and self.status() == STAT_GOT_IP
+
+    def ifconfig(self, *args):
+        if self.interface_id == AP_IF:
+            return (AP_IP, "255.255.255.0", AP_IP, AP_IP)
+        if self.isconnected():
+            return (STA_IP, "255.255.255.0", "10.0.0.1", "10.0.0.1")
+        return ("0.0.0.0", "0.0.0.0", "0.0.0.0", "0.0.0.0")
+
+    def config(self, *args, **kwargs):
+        if kwargs:
+            self.st.update(kwargs)
+            return None
+        if args and args[0] == "mac":
+            return bytes(simrt.sim.machine_id)
+        return self.st.get(args[0]) if args else None
+
+    def scan(self):
+        # (ssid, bssid, channel, RSSI, authmode, hidden)
+        return [(ssid.encode(), b"\x00" * 6, 1, -60, AUTH_WPA2_PSK, False) for ssid in simrt.sim.wifi_networks]
+
+
+def reset_sim_state():
+    WLAN._state.clear()
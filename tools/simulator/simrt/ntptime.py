@@ -0,0 +1,18 @@
+"""Simulated `ntptime`, sets the RTC of the virtual clock to the actual time"""
+import errno
+
+import simrt
+
+host = "pool.ntp.org"
+
+
+def time():
+    return simrt.sim.clock.wall_time()
+
+
+def settime():
+    if not simrt.sim.net.online:
+        raise OSError(-202)
+    if simrt.sim.net.ntp_blocked:
+        raise OSError(errno.ETIMEDOUT)
+    simrt.sim.clock.set_time(simrt.sim.clock.wall_time())
@@ -0,0 +1,26 @@
+"""
+Simulated MH-Z19 sensor (mhz19.MHZ19Sim from the frozen modules) following the CO2 trace of the simulation.
+"""
+import mhz19
+
+import simrt
+
+
+class TraceMHZ19(mhz19.MHZ19Sim):
+    """MHZ19Sim whose readings follow the trace of the running simulation"""
+
+    # a real sensor reports a slightly different value on every reading, which the firmware relies on to detect the
+    # end of warmup (see MHZ19.get_co2_reading), so readings of a flat trace get +-1ppm of jitter
+    JITTER_PPM = 1
+
+    def __init__(self, uart):
+        super().__init__(uart)
+        self.reading_ctr = 0
+
+    async def send_cmd(self, cmd, payload=None):
+        if cmd == self.CMD_GET_READING:
+            (co2_ppm, temperature) = simrt.sim.trace.at(simrt.sim.clock.seconds())
+            self.reading_ctr += 1
+            self.set_sim_co2(co2_ppm + (self.JITTER_PPM if self.reading_ctr % 2 else 0))
+            self.set_sim_temperature(temperature)
+        return await super().send_cmd(cmd, payload)
@@ -0,0 +1,49 @@
+"""
+Scripted CO2 traces for the simulated CO2 sensor.
+"""
+
+
+class Co2Trace:
+    """
+    CO2 concentration over time, read from a CSV file with "seconds,co2_ppm[,temperature_c]" rows. Values are
+    linearly interpolated between rows and the last row is held after the end of the trace.
+    """
+
+    DEFAULT_TEMPERATURE = 22
+
+    def __init__(self, points):
+        if not points:
+            raise ValueError("empty CO2 trace")
+        self.points = sorted(points)
+
+    @classmethod
+    def load(cls, fn):
+        points = []
+        with open(fn) as f:
+            for line in f:
+                line = line.split("#", 1)[0].strip()
+                if not line:
+                    continue
+                fields = [float(v) for v in line.split(",")]
+                temperature = fields[2] if len(fields) > 2 else cls.DEFAULT_TEMPERATURE
+                points.append((fields[0], fields[1], temperature))
+        return cls(points)
+
+    @classmethod
+    def constant(cls, co2_ppm, temperature=DEFAULT_TEMPERATURE):
+        return cls([(0, co2_ppm, temperature)])
+
+    def duration(self):
+        return self.points[-1][0]
+
+    def at(self, t):
+        """Returns (co2_ppm, temperature) at t seconds"""
+        prev = self.points[0]
+        if t <= prev[0]:
+            return int(prev[1]), int(prev[2])
+        for p in self.points[1:]:
+            if t <= p[0]:
+                f = (t - prev[0]) / (p[0] - prev[0])
+                return int(prev[1] + (p[1] - prev[1]) * f), int(prev[2] + (p[2] - prev[2]) * f)
+            prev = p
+        return int(prev[1]), int(prev[2])
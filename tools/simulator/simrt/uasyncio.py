@@ -0,0 +1,121 @@
+"""
+uasyncio v3 API on top of CPython asyncio running on the virtual-time event loop. Only what the firmware, the
+frozen modules and tinyweb use is provided.
+"""
+import asyncio
+import sys
+
+import simrt
+
+__version__ = (3, 0, 0)
+
+CancelledError = asyncio.CancelledError
+TimeoutError = asyncio.TimeoutError
+Task = asyncio.Task
+Event = asyncio.Event
+Lock = asyncio.Lock
+gather = asyncio.gather
+sleep = asyncio.sleep
+wait_for = asyncio.wait_for
+current_task = asyncio.current_task
+
+# tinyweb does `import uasyncio.core`
+core = sys.modules[__name__]
+
+
+def sleep_ms(t):
+    return asyncio.sleep(max(0, t) / 1000)
+
+
+def wait_for_ms(aw, timeout):
+    return asyncio.wait_for(aw, timeout / 1000)
+
+
+def get_event_loop(runq_len=0, waitq_len=0):
+    return simrt.sim.loop
+
+
+def new_event_loop():
+    return simrt.sim.loop
+
+
+def create_task(coro):
+    return simrt.sim.loop.create_task(coro)
+
+
+def run(coro):
+    return simrt.sim.loop.run_until_complete(coro)
+
+
+class ThreadSafeFlag:
+    """Self-clearing flag, set() may be called from IRQ handlers (micropython.schedule runs them on the loop)"""
+
+    def __init__(self):
+        self._event = asyncio.Event()
+
+    def set(self):
+        self._event.set()
+
+    def clear(self):
+        self._event.clear()
+
+    async def wait(self):
+        await self._event.wait()
+        self._event.clear()
+
+
+class StreamReader:
+    """Stream over a polled device such as machine.UART"""
+
+    POLL_PERIOD = 0.001
+
+    def __init__(self, s, e=None):
+        self.s = s
+
+    async def read(self, n=-1):
+        while True:
+            data = self.s.read(n)
+            if data:
+                return data
+            await asyncio.sleep(self.POLL_PERIOD)
+
+
+class StreamWriter:
+    def __init__(self, s, e=None):
+        self.s = s
+
+    def write(self, buf):
+        self.s.write(buf)
+
+    async def drain(self):
+        await asyncio.sleep(0)
+
+    async def awrite(self, buf, off=0, sz=-1):
+        if sz == -1:
+            sz = len(buf) - off
+        self.s.write(buf[off:off + sz])
+        await self.drain()
+
+
+async def open_connection(host, port):
+    return await simrt.sim.net.open_connection(host, port)
+
+
+class Server:
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+
+    def close(self):
+        simrt.sim.net.remove_host(self.host, self.port)
+
+    async def wait_closed(self):
+        await asyncio.sleep(0)
+
+
+async def start_server(cb, host, port, backlog=5):
+    async def handler(stream):
+        await cb(stream, stream)
+
+    simrt.sim.net.add_host(simrt.sim.device_ip(), port, handler)
+    return Server(simrt.sim.device_ip(), port)
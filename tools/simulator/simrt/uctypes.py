@@ -0,0 +1,29 @@
+"""
+Simulated `uctypes`, only byte arrays (e.g. uctypes.ARRAY | offset, uctypes.UINT8 | length) are supported, which is
+what the frozen utarfile uses to read tar headers. addressof() returns the buffer itself.
+"""
+LITTLE_ENDIAN = 0
+BIG_ENDIAN = 1
+NATIVE = 2
+
+ARRAY = 1 << 30
+UINT8 = 0
+
+
+def addressof(buf):
+    return buf
+
+
+def sizeof(desc, layout=NATIVE):
+    return max((field[0] & ~ARRAY) + (field[1] & 0xffff) for field in desc.values())
+
+
+class struct:
+    def __init__(self, addr, desc, layout=NATIVE):
+        self._buf = memoryview(addr)
+        self._desc = desc
+
+    def __getattr__(self, name):
+        (offset, length) = self._desc[name]
+        offset &= ~ARRAY
+        return self._buf[offset:offset + (length & 0xffff)]
@@ -0,0 +1,228 @@
+"""
+Simulated `umqtt.simple` and the MQTT broker. Instead of talking MQTT over a socket the umqtt client delivers
+messages to the simulation's broker, which records them. Connecting fails when the simulated device has no Internet
+connection. The broker also speaks MQTT 3.1.1 (QoS 0 and 1) to clients connecting over the simulated network, see
+Internet.add_mqtt_broker(). Like ThingsBoard it answers shared attribute requests from shared_attributes, pushes the
+changes made with set_shared_attributes() and sends commands with rpc().
+"""
+import errno
+import json
+import struct
+
+import simrt
+
+
+class MQTTException(Exception):
+    pass
+
+
+async def _read_packet(stream):
+    first_byte = (await stream.readexactly(1))[0]
+    (n, shift) = (0, 0)
+    while True:
+        b = (await stream.readexactly(1))[0]
+        n |= (b & 0x7f) << shift
+        if not b & 0x80:
+            break
+        shift += 7
+    return first_byte, (await stream.readexactly(n)) if n else b""
+
+
+def _string_at(data, pos):
+    (n,) = struct.unpack_from("!H", data, pos)
+    return bytes(data[pos + 2:pos + 2 + n]), pos + 2 + n
+
+
+def _packet(first_byte, body):
+    header = bytearray((first_byte,))
+    n = len(body)
+    while True:
+        header.append((n & 0x7f) | (0x80 if n > 0x7f else 0))
+        n >>= 7
+        if not n:
+            break
+    return bytes(header) + body
+
+
+def topic_matches(topic_filter, topic):
+    f = topic_filter.split(b"/")
+    t = topic.split(b"/")
+    for i, level in enumerate(f):
+        if level == b"#":
+            return True
+        if i >= len(t) or (level != b"+" and level != t[i]):
+            return False
+    return len(f) == len(t)
+
+
+ATTRIBUTES_TOPIC = b"v1/devices/me/attributes"
+ATTRIBUTES_REQUEST_PREFIX = b"v1/devices/me/attributes/request/"
+ATTRIBUTES_RESPONSE_PREFIX = b"v1/devices/me/attributes/response/"
+RPC_REQUEST_PREFIX = b"v1/devices/me/rpc/request/"
+
+
+class Broker:
+    def __init__(self):
+        # (ticks_ms, client_id, topic, message)
+        self.messages = []
+        self.connects = 0
+        self.pings = 0
+        self.subscribers = {}
+        # streams of the connected clients -> their topic filters
+        self.sessions = {}
+        self.shared_attributes = {}
+        self.next_rpc_id = 1
+
+    def publish(self, client_id, topic, msg):
+        self.messages.append((simrt.sim.clock.ticks_ms(), client_id, topic, msg))
+
+    def send(self, topic, msg):
+        """Publishes msg to the connected clients subscribed to topic"""
+        topic = _as_bytes(topic)
+        for stream, filters in list(self.sessions.items()):
+            if any(topic_matches(f, topic) for f in filters):
+                try:
+                    stream.write(_packet(0x30, struct.pack("!H", len(topic)) + topic + _as_bytes(msg)))
+                except OSError:
+                    self.sessions.pop(stream, None)
+
+    def set_shared_attributes(self, values):
+        self.shared_attributes.update(values)
+        self.send(ATTRIBUTES_TOPIC, json.dumps(values))
+
+    def rpc(self, method, params=None):
+        """Sends a command, the device's response is recorded in messages, returns the request id"""
+        request_id = self.next_rpc_id
+        self.next_rpc_id += 1
+        self.send(RPC_REQUEST_PREFIX + b"%d" % request_id, json.dumps({"method": method, "params": params}))
+        return request_id
+
+    def _attributes_request(self, topic, msg):
+        keys = json.loads(msg).get("sharedKeys", "").split(",")
+        shared = {k: v for k, v in self.shared_attributes.items() if k in keys}
+        self.send(ATTRIBUTES_RESPONSE_PREFIX + topic[len(ATTRIBUTES_REQUEST_PREFIX):], json.dumps({"shared": shared}))
+
+    async def handle(self, stream):
+        """Serves a client connected over the simulated network until it disconnects or the Internet goes away"""
+        client_id = None
+        try:
+            while True:
+                (first_byte, body) = await _read_packet(stream)
+                if not simrt.sim.net.online:
+                    # the packet is lost, the client finds out when the connection is closed
+                    break
+                packet_type = first_byte & 0xf0
+                if packet_type == 0x10:
+                    # CONNECT: protocol name, level, flags and keepalive come before the client id
+                    (client_id, _) = _string_at(body, 10)
+                    self.connects += 1
+                    stream.write(b"\x20\x02\x00\x00")
+                    self.sessions[stream] = []
+                elif packet_type == 0x30:
+                    (topic, pos) = _string_at(body, 0)
+                    if first_byte & 0x06:
+                        stream.write(b"\x40\x02" + bytes(body[pos:pos + 2]))
+                        pos += 2
+                    self.publish(client_id.decode(), topic, bytes(body[pos:]))
+                    if topic.startswith(ATTRIBUTES_REQUEST_PREFIX):
+                        self._attributes_request(topic, bytes(body[pos:]))
+                elif packet_type == 0x80:
+                    # SUBSCRIBE: packet id, then topic filters with their QoS
+                    (pos, granted) = (2, b"")
+                    while pos < len(body):
+                        (topic_filter, pos) = _string_at(body, pos)
+                        self.sessions[stream].append(topic_filter)
+                        granted += bytes((min(body[pos], 1),))
+                        pos += 1
+                    stream.write(_packet(0x90, bytes(body[:2]) + granted))
+                elif packet_type == 0xc0:
+                    self.pings += 1
+                    stream.write(b"\xd0\x00")
+                elif packet_type == 0xe0:
+                    break
+        except EOFError:
+            pass
+        finally:
+            self.sessions.pop(stream, None)
+            stream.close()
+
+
+class _Socket:
+    """The client's connection, closing it drops the connection without a DISCONNECT"""
+
+    def __init__(self, client):
+        self.client = client
+
+    def close(self):
+        self.client.connected = False
+
+
+def _as_bytes(v):
+    return v.encode() if isinstance(v, str) else bytes(v)
+
+
+class MQTTClient:
+    def __init__(self, client_id, server, port=0, user=None, password=None, keepalive=0, ssl=False,
+                 ssl_params={}):
+        self.client_id = client_id
+        self.server = server
+        self.port = port or (8883 if ssl else 1883)
+        self.user = user
+        self.pswd = password
+        self.keepalive = keepalive
+        self.cb = None
+        self.connected = False
+        self.sock = None
+        self.pending = []
+
+    def set_callback(self, f):
+        self.cb = f
+
+    def set_last_will(self, topic, msg, retain=False, qos=0):
+        pass
+
+    def connect(self, clean_session=True):
+        if not simrt.sim.net.online:
+            raise OSError(errno.EHOSTUNREACH)
+        simrt.sim.broker.connects += 1
+        self.connected = True
+        self.sock = _Socket(self)
+        return False
+
+    def disconnect(self):
+        self.connected = False
+
+    def ping(self):
+        self._check()
+        simrt.sim.broker.pings += 1
+
+    def _check(self):
+        if not self.connected:
+            raise OSError(errno.ENOTCONN)
+        if not simrt.sim.net.online:
+            self.connected = False
+            raise OSError(errno.ECONNRESET)
+
+    def publish(self, topic, msg, retain=False, qos=0):
+        self._check()
+        simrt.sim.broker.publish(self.client_id, _as_bytes(topic), _as_bytes(msg))
+
+    def subscribe(self, topic, qos=0):
+        self._check()
+        simrt.sim.broker.subscribers.setdefault(_as_bytes(topic), []).append(self)
+
+    def deliver(self, topic, msg):
+        """Queues a message from the broker, it's passed to the callback by the next check_msg()/wait_msg()"""
+        self.pending.append((_as_bytes(topic), _as_bytes(msg)))
+
+    def wait_msg(self):
+        self._check()
+        if self.pending:
+            (topic, msg) = self.pending.pop(0)
+            if self.cb:
+                self.cb(topic, msg)
+            return None
+        return None
+
+    def check_msg(self):
+        return self.wait_msg()
@@ -0,0 +1,18 @@
+"""Simulated `urequests`, blocking HTTP isn't simulated so every request fails like without Internet access"""
+import errno
+
+
+def request(method, url, data=None, json=None, headers={}, stream=None):
+    raise OSError(errno.EHOSTUNREACH)
+
+
+def get(url, **kw):
+    return request("GET", url, **kw)
+
+
+def post(url, **kw):
+    return request("POST", url, **kw)
+
+
+def put(url, **kw):
+    return request("PUT", url, **kw)
@@ -0,0 +1,139 @@
+"""
+Simulated `usocket`. Blocking TCP sockets connect to hosts of the simulated network by running the event loop until
+each operation completes, which only works while the loop isn't already running (e.g. OTA, which runs before
+uasyncio starts); inside the loop asynchronous code has to use uasyncio.open_connection(). Operations taking longer
+than settimeout() raise OSError(ETIMEDOUT) like on the device. UDP datagrams sent to port 53 get answers from the
+simulated network's DNS while it is online, and those sent to port 123 from an NTP server unless it's blocked.
+"""
+import asyncio
+import errno
+import os
+import socket as _socket
+
+import simrt
+
+AF_INET = _socket.AF_INET
+SOCK_STREAM = _socket.SOCK_STREAM
+SOCK_DGRAM = _socket.SOCK_DGRAM
+SOL_SOCKET = _socket.SOL_SOCKET
+SO_REUSEADDR = _socket.SO_REUSEADDR
+IPPROTO_TCP = _socket.IPPROTO_TCP
+
+# MicroPython on ESP32 reports DNS failures with this errno
+EAI_FAIL = -202
+
+DNS_PORT = 53
+NTP_PORT = 123
+
+
+def getaddrinfo(host, port, af=0, type=0, proto=0, flags=0):
+    address = simrt.sim.net.resolve(host)
+    if address is None:
+        raise OSError(EAI_FAIL)
+    return [(AF_INET, type or SOCK_STREAM, 0, "", (address, port))]
+
+
+def _error(code):
+    # CPython only sets errno when the message is given too, MicroPython always does
+    return OSError(code, os.strerror(code))
+
+
+def _block(coro, timeout=None):
+    loop = simrt.sim.loop
+    if loop.is_running():
+        coro.close()
+        raise OSError(errno.EWOULDBLOCK, "blocking sockets can't be simulated inside the event loop")
+    try:
+        return loop.run_until_complete(asyncio.wait_for(coro, timeout))
+    except asyncio.TimeoutError:
+        raise _error(errno.ETIMEDOUT)
+
+
+class socket:
+    def __init__(self, af=AF_INET, type=SOCK_STREAM, proto=0):
+        self.af = af
+        self.type = type
+        # (data, address) of datagrams received
+        self.received = []
+        self.stream = None
+        self.timeout = None
+
+    def settimeout(self, t):
+        self.timeout = t
+
+    def setblocking(self, flag):
+        pass
+
+    def setsockopt(self, level, opt, value):
+        pass
+
+    def connect(self, addr):
+        (self.stream, _) = _block(simrt.sim.net.open_connection(addr[0], addr[1]), self.timeout)
+
+    def _connected(self):
+        if self.stream is None:
+            raise _error(errno.ENOTCONN)
+        return self.stream
+
+    def write(self, data):
+        stream = self._connected()
+        stream.write(data)
+        _block(stream.drain(), self.timeout)
+        return len(data)
+
+    send = write
+    sendall = write
+
+    def read(self, n=-1):
+        """Reads until n bytes or the end of the stream, like a blocking MicroPython socket"""
+        stream = self._connected()
+        data = b""
+        while n < 0 or len(data) < n:
+            chunk = _block(stream.read(4096 if n < 0 else n - len(data)), self.timeout)
+            if not chunk:
+                break
+            data += chunk
+        return data
+
+    def readinto(self, buf, n=None):
+        data = self.read(len(buf) if n is None else n)
+        buf[:len(data)] = data
+        return len(data)
+
+    def readline(self):
+        return _block(self._connected().readline(), self.timeout)
+
+    def bind(self, addr):
+        pass
+
+    def listen(self, backlog=0):
+        pass
+
+    def sendto(self, data, addr):
+        if self.type != SOCK_DGRAM:
+            raise _error(errno.ENOTCONN)
+        if addr[1] == DNS_PORT and simrt.sim.net.online:
+            self.received.append((simrt.sim.net.dns_answer(bytes(data)), addr))
+        elif addr[1] == NTP_PORT and simrt.sim.net.online and not simrt.sim.net.ntp_blocked:
+            self.received.append((simrt.sim.net.ntp_answer(bytes(data), simrt.sim.clock.wall_time()), addr))
+        return len(data)
+
+    def recvfrom(self, n):
+        if not self.received:
+            if self.timeout:
+                # a blocking socket waits out its timeout
+                _block(asyncio.sleep(self.timeout))
+                raise _error(errno.ETIMEDOUT)
+            raise _error(errno.EAGAIN)
+        (data, addr) = self.received.pop(0)
+        return data[:n], addr
+
+    def recv(self, n):
+        if self.type == SOCK_STREAM:
+            return _block(self._connected().read(n))
+        return self.recvfrom(n)[0]
+
+    def close(self):
+        if self.stream:
+            self.stream.close()
+            self.stream = None
@@ -0,0 +1,12 @@
+"""
+Simulated `ussl`. Connections of the simulated network carry plain data, so wrapping a socket returns it unchanged
+and the simulated servers on port 443 speak plain HTTP.
+"""
+CERT_NONE = 0
+CERT_OPTIONAL = 1
+CERT_REQUIRED = 2
+
+
+def wrap_socket(sock, server_side=False, key=None, cert=None, cert_reqs=CERT_NONE, cadata=None,
+                server_hostname=None, do_handshake=True):
+    return sock
@@ -0,0 +1,51 @@
+"""Simulated `uzlib` on top of CPython's zlib, which takes the same wbits values"""
+import zlib
+
+CHUNK_SIZE = 512
+
+
+def decompress(data, wbits=0, bufsize=0):
+    return zlib.decompress(data, wbits)
+
+
+class DecompIO:
+    """
+    Decompressing stream. Like on MicroPython, wbits must be at least the window size used for compression,
+    otherwise decompression fails.
+    """
+
+    def __init__(self, stream, wbits=0):
+        self.stream = stream
+        self.decompressor = zlib.decompressobj(wbits)
+        self.buf = b""
+        self.eof = False
+
+    def _fill(self, n):
+        while (n < 0 or len(self.buf) < n) and not self.eof:
+            data = self.stream.read(CHUNK_SIZE)
+            if not data:
+                self.eof = True
+                self.buf += self.decompressor.flush()
+                break
+            self.buf += self.decompressor.decompress(data)
+            if self.decompressor.eof:
+                self.eof = True
+
+    def read(self, n=-1):
+        self._fill(n)
+        if n < 0:
+            n = len(self.buf)
+        data = self.buf[:n]
+        self.buf = self.buf[n:]
+        return data
+
+    def readinto(self, buf, n=None):
+        data = self.read(len(buf) if n is None else n)
+        buf[:len(data)] = data
+        return len(data)
+
+    def readline(self):
+        while b"\n" not in self.buf and not self.eof:
+            self._fill(len(self.buf) + CHUNK_SIZE)
+        idx = self.buf.find(b"\n")
+        return self.read(idx + 1 if idx >= 0 else -1)
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+Runs the Air Guard MicroPython firmware under CPython with simulated hardware and a virtual clock.
+
+Examples:
+    simulate.py --trace traces/classroom.csv --duration 3600
+    simulate.py --trace traces/classroom.csv --duration 600 --frames /tmp/frames --press 120 --press 130
+    simulate.py --firmware ../../build --duration 60 --quiet
+"""
+import argparse
+import json
+import os
+import sys
+
+import simrt
+from simrt.internet import LAN_MIRROR_URL, release_package
+from simrt.trace import Co2Trace
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--trace", help="CO2 trace CSV (seconds,co2_ppm[,temperature_c]), defaults to 450ppm")
+    parser.add_argument("--duration", type=float, default=600, help="virtual seconds to simulate (default 600)")
+    parser.add_argument("--firmware", default=simrt.FIRMWARE_DIR, help="firmware directory or build")
+    parser.add_argument("--flash", help="use (and keep) this directory as the simulated flash")
+    parser.add_argument("--frames", help="write every distinct display frame as PBM into this directory")
+    parser.add_argument("--press", type=float, action="append", default=[], metavar="T",
+                        help="short button press at T seconds, can be repeated")
+    parser.add_argument("--long-press", type=float, action="append", default=[], metavar="T",
+                        help="6 second button press starting at T seconds, can be repeated")
+    parser.add_argument("--wifi", metavar="SSID:PASSWORD", help="configure and provide this WiFi network")
+    parser.add_argument("--internet", action="store_true", help="the WiFi network has Internet access")
+    parser.add_argument("--latest-release", metavar="TAG",
+                        help="release the update server announces, e.g. micropython-1.2.3 (default: the firmware's)")
+    parser.add_argument("--release", metavar="TAG", action="append", default=[],
+                        help="publish the firmware as this GitHub release for OTA updates (repeatable)")
+    parser.add_argument("--lan-mirror", action="store_true",
+                        help="run an OTA mirror of the published releases on the local network and configure it")
+    parser.add_argument("--quiet", action="store_true", help="don't print firmware logs")
+    parser.add_argument("--json", action="store_true", help="print the summary as JSON")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    trace = Co2Trace.load(args.trace) if args.trace else Co2Trace.constant(450)
+
+    config = {"wifiEnabled": False}
+    wifi_networks = {}
+    if args.wifi:
+        (ssid, _, password) = args.wifi.partition(":")
+        config = {"wifiEnabled": True, "wifiSsid": ssid, "wifiPassword": password}
+        wifi_networks[ssid] = password
+    if args.lan_mirror:
+        config["otaMirrorUrl"] = LAN_MIRROR_URL
+
+    sim = simrt.Simulation(trace, firmware_dir=os.path.abspath(args.firmware),
+                           flash_dir=os.path.abspath(args.flash) if args.flash else None,
+                           config=config, wifi_networks=wifi_networks, internet=args.internet,
+                           latest_release=args.latest_release,
+                           frames_dir=os.path.abspath(args.frames) if args.frames else None,
+                           log_stream=None if args.quiet else sys.stderr)
+    sim.install()
+    for tag in args.release:
+        sim.servers.add_release(tag, release_package(sim.firmware_dir, tag))
+    if args.lan_mirror:
+        sim.servers.add_lan_mirror()
+    for t in args.press:
+        sim.press_button(t)
+    for t in args.long_press:
+        sim.press_button(t, hold_s=6)
+
+    summary = sim.run(args.duration)
+    if args.json:
+        print(json.dumps(summary, indent=2))
+    else:
+        for k, v in summary.items():
+            print("%-16s %s" % (k, v))
+
+
+if __name__ == "__main__":
+    main()